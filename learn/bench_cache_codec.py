@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Benchmark of the compact codec for cached query results.
+
+Compares size and latency of pickling a list of ORM instances, as
+:class:`pym.cache.CachingQuery` does by default, with pickling its
+:class:`pym.cache.CompactRows`. Latency includes ``merge_result()`` into a
+session, which is done on every cache hit.
+
+Run from the project dir::
+
+    python learn/bench_cache_codec.py
+"""
+import datetime
+import pickle
+import timeit
+
+import sqlalchemy as sa
+import sqlalchemy.orm
+from sqlalchemy.ext.declarative import declarative_base
+
+import pym.cache
+
+
+N = 1000
+
+DbBase = declarative_base()
+
+
+class Node(DbBase):
+    __tablename__ = 'node'
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    parent_id = sa.Column(sa.Integer(), sa.ForeignKey('node.id'))
+    owner_id = sa.Column(sa.Integer(), nullable=False)
+    ctime = sa.Column(sa.DateTime(), nullable=False)
+    name = sa.Column(sa.Unicode(255), nullable=False)
+    kind = sa.Column(sa.Unicode(255), nullable=False)
+    title = sa.Column(sa.Unicode(255))
+    iface = sa.Column(sa.Unicode(255))
+    sortix = sa.Column(sa.Integer())
+    children = sa.orm.relationship('Node')
+
+
+def main():
+    engine = sa.create_engine('sqlite://')
+    DbBase.metadata.create_all(engine)
+    Session = sa.orm.sessionmaker(bind=engine,
+        query_cls=pym.cache.query_callable({}))
+    sess = Session()
+    now = datetime.datetime.now()
+    for i in range(1, 101):
+        sess.add(Node(id=i, parent_id=1 if i > 1 else None, owner_id=2,
+            ctime=now, name='node{}'.format(i), kind='res',
+            title='Node {}'.format(i), iface='pym.res.models.IResourceNode',
+            sortix=i))
+    sess.commit()
+
+    for n in (1, 100):
+        rr = sess.query(Node).order_by(Node.id).limit(n).all()
+        p_full = pickle.dumps(rr, pickle.HIGHEST_PROTOCOL)
+        p_compact = pickle.dumps(pym.cache.CompactRows.encode(rr),
+            pickle.HIGHEST_PROTOCOL)
+
+        def full():
+            s = Session()
+            s.query(Node).merge_result(pickle.loads(p_full), load=False)
+            s.close()
+
+        def compact():
+            s = Session()
+            s.query(Node).merge_result(pickle.loads(p_compact).decode(),
+                load=False)
+            s.close()
+
+        t_full = timeit.timeit(full, number=N)
+        t_compact = timeit.timeit(compact, number=N)
+        print("{} rows".format(n))
+        print("  pickle:  {:8d} bytes, {:8.1f} usecs/hit".format(
+            len(p_full), t_full / N * 1e6))
+        print("  compact: {:8d} bytes, {:8.1f} usecs/hit".format(
+            len(p_compact), t_compact / N * 1e6))
+        print("  size:    {:8.1f}x smaller".format(len(p_full) / len(p_compact)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Benchmark of the cache key strategies of :class:`pym.cache.CachingQuery`.
+
+Compares :func:`pym.cache._key_from_query`, which compiles the statement for
+each query, with :func:`pym.cache._shape_key_from_query`, which uses a
+memoized fingerprint per query shape plus a hash of the bound parameters.
+
+Run from the project dir::
+
+    python learn/bench_cache_keys.py
+"""
+import timeit
+
+import sqlalchemy as sa
+import sqlalchemy.orm
+from sqlalchemy.ext.declarative import declarative_base
+
+import pym.cache
+
+
+N = 10000
+
+DbBase = declarative_base()
+
+
+class Node(DbBase):
+    __tablename__ = 'node'
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    parent_id = sa.Column(sa.Integer(), sa.ForeignKey('node.id'))
+    name = sa.Column(sa.Unicode(255))
+    kind = sa.Column(sa.Unicode(255))
+    parent = sa.orm.relationship('Node', remote_side=[id])
+
+
+def build_query(sess, i):
+    return sess.query(
+        Node
+    ).filter(
+        sa.and_(Node.parent_id == i, Node.name == 'node{}'.format(i))
+    )
+
+
+def main():
+    engine = sa.create_engine('sqlite://')
+    DbBase.metadata.create_all(engine)
+    sess = sa.orm.sessionmaker(bind=engine,
+        query_cls=pym.cache.query_callable({}))()
+
+    qq = [build_query(sess, i) for i in range(100)]
+
+    def compiled():
+        for q in qq:
+            pym.cache._key_from_query(q)
+
+    def shaped():
+        for q in qq:
+            pym.cache._shape_key_from_query(q, 'bench')
+
+    n = N // len(qq)
+    t_compiled = timeit.timeit(compiled, number=n)
+    t_shaped = timeit.timeit(shaped, number=n)
+    print("{} keys".format(n * len(qq)))
+    print("compiled: {:8.3f} secs, {:8.1f} usecs/key".format(
+        t_compiled, t_compiled / N * 1e6))
+    print("shaped:   {:8.3f} secs, {:8.1f} usecs/key".format(
+        t_shaped, t_shaped / N * 1e6))
+    print("speedup:  {:8.1f}x".format(t_compiled / t_shaped))
+
+
+if __name__ == '__main__':
+    main()
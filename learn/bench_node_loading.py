@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Benchmark of bulk loading nodes that carry an interface name in ``iface``.
+
+Compares the former load listener, which resolved the dotted name and called
+``alsoProvides()`` for each loaded node, with
+:func:`pym.res.models.resource_node_load_listener`, which assigns a provided-by
+spec that is built once per class and interface.
+
+Run from the project dir::
+
+    python learn/bench_node_loading.py
+"""
+import timeit
+
+import pyramid.util
+import sqlalchemy as sa
+import sqlalchemy.event
+import sqlalchemy.orm
+from sqlalchemy.ext.declarative import declarative_base
+import zope.interface
+
+import pym.res.models
+
+
+N = 20
+CHILDREN = 500
+IFACE = 'pym.res.models.IRootNode'
+
+DbBase = declarative_base()
+
+
+class Node(DbBase):
+    __tablename__ = 'node'
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    parent_id = sa.Column(sa.Integer(), sa.ForeignKey('node.id'))
+    name = sa.Column(sa.Unicode(255))
+    iface = sa.Column(sa.Unicode(255))
+
+
+def resolving_listener(target, context):
+    if target.iface:
+        iface = pyramid.util.DottedNameResolver(None).resolve(target.iface)
+        zope.interface.alsoProvides(target, iface)
+
+
+def no_listener(target, context):
+    pass
+
+
+def main():
+    engine = sa.create_engine('sqlite://')
+    DbBase.metadata.create_all(engine)
+    Session = sa.orm.sessionmaker(bind=engine)
+    sess = Session()
+    sess.add(Node(id=1, name='root'))
+    sess.add_all([Node(parent_id=1, name='n{}'.format(i), iface=IFACE)
+        for i in range(CHILDREN)])
+    sess.commit()
+    sess.close()
+
+    def load():
+        s = Session()
+        nn = s.query(Node).filter(Node.parent_id == 1).all()
+        assert len(nn) == CHILDREN
+        s.close()
+        return nn
+
+    results = []
+    for title, listener in (
+            ('no listener', no_listener),
+            ('resolving', resolving_listener),
+            ('spec cache', pym.res.models.resource_node_load_listener)):
+        sa.event.listen(Node, 'load', listener)
+        nn = load()
+        if listener is not no_listener:
+            assert pym.res.models.IRootNode.providedBy(nn[0])
+        t = timeit.timeit(load, number=N)
+        sa.event.remove(Node, 'load', listener)
+        results.append((title, t))
+
+    t_base = results[0][1]
+    print("{} loads of {} nodes".format(N, CHILDREN))
+    for title, t in results:
+        print("{:12} {:8.3f} secs, {:8.2f} usecs/node, listener {:8.2f}"
+              " usecs/node".format(title, t, t / N / CHILDREN * 1e6,
+                (t - t_base) / N / CHILDREN * 1e6))
+
+
+if __name__ == '__main__':
+    main()
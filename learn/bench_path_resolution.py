@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Benchmark of resolving resource paths of depth 1 to 20.
+
+Compares traversal as done by Pyramid, i.e. one
+:meth:`pym.res.models.ResourceNode.load_child` per path segment, with
+:meth:`pym.res.models.ResourceNode.load_path`, which loads the whole chain
+with one recursive CTE. Both run without the cache regions, so we measure
+the DB round trips.
+
+The test nodes are created below the root node, and rolled back at the end.
+
+Run from the project dir::
+
+    python learn/bench_path_resolution.py -c development.ini
+"""
+import argparse
+import logging
+import timeit
+
+import transaction
+
+import pym.cli
+import pym.auth.const
+from pym.res.models import ResourceNode
+
+
+N = 100
+MAX_DEPTH = 20
+
+
+def build_chain(sess, root):
+    p = root
+    for i in range(MAX_DEPTH):
+        p = p.add_child(sess, owner=pym.auth.const.SYSTEM_UID, kind='res',
+            name='bench-path-{}'.format(i))
+    sess.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    pym.cli.Cli.add_parser_args(parser, (('config', True),))
+    args = parser.parse_args()
+    runner = pym.cli.Cli()
+    runner.init_app(args, lgg=logging.getLogger(__name__),
+        setup_logging=False)
+    sess = runner._sess
+
+    transaction.begin()
+    try:
+        root = ResourceNode.load_root(sess, use_cache=False)
+        build_chain(sess, root)
+        print("depth  per-segment [ms]  one CTE [ms]  speedup")
+        for depth in range(1, MAX_DEPTH + 1):
+            path = ['bench-path-{}'.format(i) for i in range(depth)]
+
+            def per_segment():
+                n = root
+                for name in path:
+                    n = ResourceNode.load_child(sess, name, n.id,
+                        use_cache=False)
+                sess.expunge_all()
+                sess.add(root)
+
+            def cte():
+                nn = ResourceNode.load_path(sess, root, path, use_cache=False)
+                assert len(nn) == depth
+                sess.expunge_all()
+                sess.add(root)
+
+            t_seg = timeit.timeit(per_segment, number=N) / N * 1000
+            t_cte = timeit.timeit(cte, number=N) / N * 1000
+            print("{:5d}  {:16.2f}  {:12.2f}  {:7.1f}x".format(
+                depth, t_seg, t_cte, t_seg / t_cte))
+    finally:
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,12 @@ import pym.i18n
 import pym.models
 import pym.res
 import pym.res.models
+import pym.res.setup
 import pym.auth.manager
+import pym.auth.throttle
+import pym.auth.stats
 import pym.lib
+import pym.security
 
 from .rc import Rc
 
@@ -54,6 +58,8 @@ def main(global_config, **settings):
         settings=settings
     )
     config.include(includeme)
+    # Fail now rather than on each request
+    pym.res.setup.check_schema(models.DbEngine)
 
     return config.make_wsgi_app()
 
@@ -73,6 +79,8 @@ def includeme(config):
 
     # Init resource root
     config.set_root_factory(res.models.root_factory)
+    config.add_request_method(res.models.get_node_cache, 'node_cache',
+        reify=True)
 
     # Init session
     session_factory = session_factory_from_settings(config.registry.settings)
@@ -85,7 +93,11 @@ def includeme(config):
     auth_pol = SessionAuthenticationPolicy(
         callback=group_finder
     )
-    authz_pol = ACLAuthorizationPolicy()
+    if config.registry.settings['rc'].g('auth.authorization_policy',
+            'acl') == 'bitmask':
+        authz_pol = pym.security.BitmaskAuthorizationPolicy()
+    else:
+        authz_pol = ACLAuthorizationPolicy()
     config.add_request_method(get_current_user, 'user', reify=True)
     config.set_authentication_policy(auth_pol)
     config.set_authorization_policy(authz_pol)
@@ -109,7 +121,9 @@ def includeme(config):
     #config.include('pyramid_chameleon')
 
     # Init DB
-    models.init(config.registry.settings, 'db.pym.sa.', invalidate_caches=True)
+    models.init(config.registry.settings, 'db.pym.sa.',
+        invalidate_caches=config.registry.settings['rc'].g(
+            'cache.invalidate_on_startup', False))
 
     # Run scan() which also imports db models
     config.scan('pym')
@@ -118,7 +132,8 @@ def includeme(config):
     config.add_static_view('static-pym', 'pym:static')
     config.add_static_view('static-deform', 'deform:static')
 
-    init_auth(config.registry.settings['rc'])
+    init_auth(config.registry.settings['rc'], config.registry)
+    pym.res.models.register_ifaces()
 
     # View predicates from pyramid_duh
     config.include(duh_view)
@@ -126,6 +141,39 @@ def includeme(config):
     config.include('pyramid_redis')
 
 
-def init_auth(rc):
+def init_auth(rc, registry=None):
+    """
+    Initialises authentication from rc settings.
+
+    Resolves the classes of the auth provider and of the user once, and
+    stores them on the registry as ``auth.provider_class`` and
+    ``auth.user_class``.
+
+    :param rc: Instance of :class:`pym.rc.Rc`.
+    :param registry: Optional. Pyramid's registry.
+    """
     pym.auth.manager.PASSWORD_SCHEME = rc.g('auth.password_scheme',
         pym.auth.manager.PASSWORD_SCHEME).lower()
+    pym.security.configure_pwd_context(pym.auth.manager.PASSWORD_SCHEME,
+        rc.g('auth.password_rounds', 0))
+    pym.security.password_verifier.configure(
+        max_workers=rc.g('auth.verify_pool.size', 0),
+        max_pending=rc.g('auth.verify_pool.max_pending', 32),
+        timeout=rc.g('auth.verify_pool.timeout', 10),
+        rehash=rc.g('auth.rehash_on_login', False)
+    )
+    pym.auth.throttle.login_throttle.configure(
+        enabled=rc.g('auth.throttle.enabled', False),
+        window=rc.g('auth.throttle.window', 300),
+        max_per_login=rc.g('auth.throttle.max_per_login', 5),
+        max_per_ip=rc.g('auth.throttle.max_per_ip', 20),
+        redis_url=rc.g('redis.url', ''),
+        redis_db=rc.g('redis.db', 0)
+    )
+    pym.auth.stats.user_stats.flush_interval = rc.g(
+        'auth.stats.flush_interval', 10)
+    provider_class = pym.lib.dotted_names.register(rc.g('auth.provider'))
+    user_class = pym.lib.dotted_names.register(rc.g('auth.class.user'))
+    if registry is not None:
+        registry['auth.provider_class'] = provider_class
+        registry['auth.user_class'] = user_class
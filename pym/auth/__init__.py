@@ -9,6 +9,8 @@ from pym.cache import FromCache
 from .models import (Group, GroupMember)
 from .const import SYSTEM_UID, NOBODY_UID
 from .events import BeforeUserLoggedIn, UserLoggedIn, UserLoggedOut
+from .throttle import login_throttle
+from .stats import user_stats
 
 
 def group_finder(userid, request):
@@ -16,7 +18,8 @@ def group_finder(userid, request):
     Returns list of security principals of the currently logged in user.
 
     A principal starting with ``u:`` denotes the user, with ``g:`` denotes
-    a group. We use the IDs as identifier.
+    a group. We use the IDs as identifier. Groups include those we are member
+    of via nested groups, see :meth:`pym.auth.models.User.load_all_groups`.
 
     Nobody has no principals.
 
@@ -56,7 +59,9 @@ class AuthProvider():
         try:
             p = self.sess.query(self.user_class).options(
                 FromCache("auth_short_term",
-                    cache_key='auth:user:{}'.format(principal))
+                    cache_key='auth:user:{}'.format(principal),
+                    tags=lambda uu: ['user:{}'.format(u.id) for u in uu],
+                    compact=True)
             ).filter(
                 self.user_class.principal == principal
             ).one()
@@ -80,13 +85,19 @@ class AuthProvider():
         # preparations can take place before we actually log him in.
         request.registry.notify(BeforeUserLoggedIn(request, u))
         # Now log user in
-        if not pym.security.pwd_context.verify(pwd, u.pwd):
+        valid, new_hash = pym.security.password_verifier.verify(pwd, u.pwd)
+        if not valid:
             raise AuthError('Wrong credentials')
-        # And save some stats
-        u.login_time = datetime.datetime.now()
-        u.login_ip = remote_addr
-        u.logout_time = None
-        u.editor_id = SYSTEM_UID
+        if new_hash:
+            # Rehash with current scheme and rounds
+            u.pwd = new_hash
+            u.editor_id = SYSTEM_UID
+        # And save some stats, written behind
+        user_stats.update(u.id,
+            login_time=datetime.datetime.now(),
+            login_ip=remote_addr,
+            logout_time=None
+        )
         request.registry.notify(
             UserLoggedIn(request, u)
         )
@@ -97,11 +108,13 @@ class AuthProvider():
         Performs logout.
         """
         u = self.sess.query(self.user_class).filter(self.user_class.id == uid).one()
-        u.login_ip = None
-        u.login_time = None
-        u.access_time = None
-        u.logout_time = datetime.datetime.now()
-        u.editor_id = SYSTEM_UID
+        # Stats are written behind
+        user_stats.update(u.id,
+            login_ip=None,
+            login_time=None,
+            access_time=None,
+            logout_time=datetime.datetime.now()
+        )
         request.registry.notify(UserLoggedOut(request, u))
         return u
 
@@ -123,6 +136,7 @@ class AuthProvider():
         Raises exception :class:`pym.exc.AuthError` if user is not found.
         """
         self._check_credentials(principal, pwd)
+        login_throttle.check(principal, remote_addr)
         filter_ = [self.user_class.principal == principal]
         return self._login(request, filter_, pwd, remote_addr)
 
@@ -133,6 +147,7 @@ class AuthProvider():
         Raises exception :class:`pym.exc.AuthError` if user is not found.
         """
         self._check_credentials(email, pwd)
+        login_throttle.check(email, remote_addr)
         filter_ = [self.user_class.email == email]
         return self._login(request, filter_, pwd, remote_addr)
 
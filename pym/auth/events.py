@@ -7,6 +7,8 @@ from zope.interface import (
 from pyramid.events import subscriber
 import pyramid.i18n
 import pym.i18n
+from pym.exc import ThrottledError, VerifierOverloadedError
+from .throttle import login_throttle
 
 
 _ = pyramid.i18n.TranslationStringFactory(pym.i18n.DOMAIN)
@@ -136,6 +138,10 @@ def handle_user_auth_error(event):
         l=event.login.replace("'", r"\'"), p=event.pwd.replace("'", r"\'"),
         a=event.remote_addr
     ))
+    # Rejected attempts do not prolong the throttling, nor do attempts whose
+    # password was not verified at all
+    if not isinstance(event.exc, (ThrottledError, VerifierOverloadedError)):
+        login_throttle.add_failure(event.login, event.remote_addr)
 
 
 # noinspection PyUnusedLocal
@@ -149,10 +155,9 @@ def handle_before_user_logged_in(event):
     pass
 
 
-# noinspection PyUnusedLocal
 @subscriber(IUserLoggedIn)
 def handle_user_logged_in(event):
-    pass
+    login_throttle.reset(event.user.principal, event.user.email)
 
 
 # noinspection PyUnusedLocal
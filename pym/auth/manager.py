@@ -4,6 +4,7 @@ from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import and_
 
 from pym.exc import AuthError
+from pym.cache import invalidate_tags_on_commit
 import pym.security
 from .models import (User, Group, GroupMember)
 
@@ -112,6 +113,7 @@ def update_user(sess, user, editor, **kwargs):
     if not u.display_name:
         u.display_name = u.principal
     sess.flush()
+    invalidate_tags_on_commit('user:{}'.format(u.id))
     return u
 
 
@@ -127,6 +129,7 @@ def delete_user(sess, user, deleter, delete_from_db=False):
     :return: None if really deleted, else instance of tagged user.
     """
     usr = User.find(sess, user)
+    invalidate_tags_on_commit('user:{}'.format(usr.id))
     if delete_from_db:
         sess.delete(usr)
         usr = None
@@ -182,6 +185,7 @@ def update_group(sess, group, editor, **kwargs):
     for k, v in kwargs.items():
         setattr(gr, k, v)
     sess.flush()
+    invalidate_tags_on_commit('group:{}'.format(gr.id))
     return gr
 
 
@@ -197,6 +201,7 @@ def delete_group(sess, group, deleter, delete_from_db=False):
     :return: None if really deleted, else instance of tagged group.
     """
     gr = Group.find(sess, group)
+    invalidate_tags_on_commit('group:{}'.format(gr.id))
     if delete_from_db:
         sess.delete(gr)
         gr = None
@@ -251,6 +256,7 @@ def create_group_member(sess, owner, group, member_user=None,
         for k, v in kwargs.items():
             setattr(gm, k, v)
         sess.flush()
+        invalidate_tags_on_commit(*_group_member_tags(gm))
         return gm
 
 
@@ -265,5 +271,16 @@ def delete_group_member(sess, group_member):
     :param group_member: ID, or instance of a group member.
     """
     gm = GroupMember.find(sess, group_member)
+    invalidate_tags_on_commit(*_group_member_tags(gm))
     sess.delete(gm)
     sess.flush()
+
+
+def _group_member_tags(gm):
+    """Returns cache tags that depend on given group membership."""
+    tags = ['group:{}'.format(gm.group_id)]
+    if gm.member_user_id:
+        tags.append('user:{}'.format(gm.member_user_id))
+    if gm.member_group_id:
+        tags.append('group:{}'.format(gm.member_group_id))
+    return tags
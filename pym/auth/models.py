@@ -1,6 +1,6 @@
+import uuid
 import babel
 import pyramid.security
-import pyramid.util
 import sqlalchemy as sa
 from sqlalchemy.dialects.postgresql import INET, HSTORE, ARRAY
 from sqlalchemy.orm import relationship
@@ -16,9 +16,11 @@ from pym.models import (
 from pym.models.types import CleanUnicode
 import pym.lib
 import pym.exc
-from pym.cache import region_auth_long_term
+from pym.cache import (region_auth_long_term, tag_key,
+    invalidate_tags_on_commit, creator_session)
 
 from .events import UserAuthError
+from .stats import user_stats
 from .const import (NOBODY_UID, NOBODY_PRINCIPAL, NOBODY_EMAIL,
     NOBODY_DISPLAY_NAME, WHEEL_RID)
 
@@ -26,9 +28,6 @@ from .const import (NOBODY_UID, NOBODY_PRINCIPAL, NOBODY_EMAIL,
 _ = pyramid.i18n.TranslationStringFactory(pym.i18n.DOMAIN)
 
 
-_dnr = pyramid.util.DottedNameResolver(None)
-
-
 class IAuthMgrNode(zope.interface.Interface):
     pass
 
@@ -197,7 +196,8 @@ class User(DbBase, DefaultMixin):
     """Reason why block was established."""
 
     principal = sa.Column(CleanUnicode(255), nullable=False,
-        info={'colanderalchemy': {'title': _("Principal")}})
+        info={'colanderalchemy': {'title': _("Principal")},
+            'search': True})
     """Principal or user name."""
     pwd = sa.Column(CleanUnicode(255),
         info={'colanderalchemy': {'title': _("Password")}})
@@ -209,16 +209,20 @@ class User(DbBase, DefaultMixin):
         info={'colanderalchemy': {'title': _("Identity URL")}})
     """Used for login by OpenID."""
     email = sa.Column(CleanUnicode(128), nullable=False,
-        info={'colanderalchemy': {'title': _("Email")}})
+        info={'colanderalchemy': {'title': _("Email")},
+            'search': True})
     """Email address. Always lower cased."""
     first_name = sa.Column(CleanUnicode(64),
-        info={'colanderalchemy': {'title': _("First Name")}})
+        info={'colanderalchemy': {'title': _("First Name")},
+            'search': True})
     """User's first name."""
     last_name = sa.Column(CleanUnicode(64),
-        info={'colanderalchemy': {'title': _("Last Name")}})
+        info={'colanderalchemy': {'title': _("Last Name")},
+            'search': True})
     """User's last name."""
     display_name = sa.Column(CleanUnicode(255), nullable=False,
-        info={'colanderalchemy': {'title': _("Display Name")}})
+        info={'colanderalchemy': {'title': _("Display Name")},
+            'search': True})
     """User is displayed like this. Usually 'first_name last_name' or
     'principal'."""
 
@@ -256,12 +260,74 @@ class User(DbBase, DefaultMixin):
     get all."""
 
     def load_all_groups(self):
+        """
+        Loads all groups we are member of, directly or via nested groups.
+
+        Groups are resolved transitively by a single recursive query. The
+        result is cached per user and tagged with the user and each of its
+        groups, so that any change of a membership along the way invalidates
+        it.
+
+        :return: List of tuples (ID, name) of the groups.
+        """
         def creator():
-            # TODO Load nested groups
-            return [(x.id, x.name) for x in self.groups]
-        key = 'auth:groups_for_user:{}'.format(self.id)
+            with creator_session(sess) as s:
+                gg = [(x.id, x.name) for x in s.query(
+                    Group.id, Group.name
+                ).join(
+                    all_groups, all_groups.c.group_id == Group.id
+                ).order_by(
+                    Group.id
+                )]
+            tag_key('auth_long_term', key, 'user:{}'.format(uid),
+                *['group:{}'.format(x[0]) for x in gg])
+            return gg
+        # Creator may run in another thread, do not touch self there.
+        uid = self.id
+        sess = sa.inspect(self).session or DbSession()
+        key = 'auth:groups_for_user:{}'.format(uid)
+        gm = GroupMember.__table__
+        all_groups = sa.select(
+            [gm.c.group_id]
+        ).where(
+            gm.c.member_user_id == uid
+        ).cte(
+            'all_groups', recursive=True
+        )
+        # UNION, not UNION ALL, terminates on cyclic memberships
+        all_groups = all_groups.union(
+            sa.select(
+                [gm.c.group_id]
+            ).where(
+                gm.c.member_group_id == all_groups.c.group_id
+            )
+        )
         return region_auth_long_term.get_or_create(key, creator)
 
+    @staticmethod
+    def version(uid, group_ids=None):
+        """
+        Returns version of given user's record and group memberships.
+
+        The version changes whenever the user or one of its groups is
+        invalidated, i.e. the user record or a membership along the way
+        changed. :class:`CurrentUser` compares it with the version of its
+        session snapshot.
+
+        :param uid: ID of the user.
+        :param group_ids: Optional. IDs of all groups of the user. The version
+            is additionally tagged with these groups.
+        """
+        def creator():
+            tag_key('auth_long_term', key, 'user:{}'.format(uid))
+            return uuid.uuid4().hex
+        key = 'auth:user:version:{}'.format(uid)
+        v = region_auth_long_term.get_or_create(key, creator)
+        if group_ids:
+            tag_key('auth_long_term', key,
+                *['group:{}'.format(gid) for gid in group_ids])
+        return v
+
     def __repr__(self):
         return "<{name}(id={id}, principal='{p}', email='{e}'>".format(
             id=self.id, p=self.principal, e=self.email, name=self.__class__.__name__)
@@ -300,7 +366,8 @@ class Group(DbBase, DefaultMixin):
         nullable=True
     )
     """Optional reference to the tenant to which this group belongs."""
-    name = sa.Column(CleanUnicode(255), nullable=False)
+    name = sa.Column(CleanUnicode(255), nullable=False,
+        info={'search': True})
     """Name of the group. Must be unique within a tenant."""
     kind = sa.Column(CleanUnicode(255), nullable=True)
     """An optional classifier to bundle groups together."""
@@ -399,8 +466,9 @@ class Permission(DbBase, DefaultMixin):
         :param perm: Instance of a permission
         """
         perm.parent = self
+        invalidate_tags_on_commit('permissions')
 
-    @region_auth_long_term.cache_on_arguments()
+    @staticmethod
     def load_all(sess):
         """
         Returns detailed info about permissions.
@@ -447,6 +515,33 @@ class Permission(DbBase, DefaultMixin):
                 },
             }
         """
+        def creator():
+            with creator_session(sess) as s:
+                tree = Permission._load_all(s)
+            tag_key('auth_long_term', key, 'permissions')
+            return tree
+        key = 'auth:permissions'
+        return region_auth_long_term.get_or_create(key, creator)
+
+    @staticmethod
+    def version():
+        """
+        Returns version of the permission tree.
+
+        The version changes whenever the cached tree of :meth:`load_all` is
+        invalidated, i.e. the permissions changed.
+        """
+        def creator():
+            tag_key('auth_long_term', key, 'permissions')
+            return uuid.uuid4().hex
+        key = 'auth:permissions:version'
+        return region_auth_long_term.get_or_create(key, creator)
+
+    @staticmethod
+    def _load_all(sess):
+        """
+        Loads info about permissions from DB, see :meth:`load_all`.
+        """
         tree = {}
         # This query returns all permissions with their parents.
         # Some permissions may have no parents.
@@ -645,16 +740,51 @@ class CurrentUser(object):
         self._groups = []
         self.uid = None
         self.principal = None
-        self.sess = sess
+        self._sess = sess
+        self._user_class = user_class
+        self._auth_provider = None
         self.init_nobody()
-        rc = request.registry.settings['rc']
-        cls = _dnr.resolve(rc.g('auth.provider'))
-        self.auth_provider = cls(self.sess, user_class)
+
+    @property
+    def sess(self):
+        """DB session, created on first access."""
+        if self._sess is None:
+            self._sess = DbSession()
+        return self._sess
+
+    @property
+    def auth_provider(self):
+        """Instance of the auth provider, created on first access."""
+        if self._auth_provider is None:
+            cls = self._request.registry['auth.provider_class']
+            self._auth_provider = cls(self.sess, self._user_class)
+        return self._auth_provider
 
     def load_by_principal(self, principal):
         u = self.auth_provider.load_by_principal(principal)
         self.init_from_user(u)
 
+    def load_from_snapshot(self, principal):
+        """
+        Initialises user from the snapshot in the session.
+
+        Neither the DB nor the auth provider are used. The snapshot is only
+        valid if it is of given principal and its version is still the
+        current version of the user, see :meth:`User.version`.
+
+        :return: True if initialised, False if snapshot is missing or stale.
+        """
+        snap = self._request.session.get(self.__class__.SESS_KEY + '/snapshot')
+        if not snap or snap['principal'] != principal:
+            return False
+        if snap['version'] != User.version(snap['uid']):
+            return False
+        self.uid = snap['uid']
+        self.principal = snap['principal']
+        self.groups = snap['groups']
+        self._metadata = dict(snap['metadata'])
+        return True
+
     def init_nobody(self):
         self.uid = NOBODY_UID
         self.principal = NOBODY_PRINCIPAL
@@ -667,7 +797,13 @@ class CurrentUser(object):
     def init_from_user(self, u):
         """
         Initialises authenticated user.
+
+        Also stores a snapshot of the user in the session, see
+        :meth:`load_from_snapshot`.
         """
+        # Get version before loading the groups: if something changes
+        # meanwhile, the version changes too, and the next request reloads.
+        version = User.version(u.id)
         self.uid = u.id
         self.principal = u.principal
         self.groups = u.load_all_groups()
@@ -675,6 +811,14 @@ class CurrentUser(object):
         self._metadata['first_name'] = u.first_name
         self._metadata['last_name'] = u.last_name
         self._metadata['display_name'] = u.display_name
+        User.version(u.id, [g[0] for g in self.groups])
+        self._request.session[self.__class__.SESS_KEY + '/snapshot'] = dict(
+            uid=self.uid,
+            principal=self.principal,
+            groups=self.groups,
+            metadata=dict(self._metadata),
+            version=version
+        )
 
     def is_auth(self):
         """Tells whether user is authenticated, i.e. is not nobody
@@ -685,7 +829,7 @@ class CurrentUser(object):
         if not self._groups:
             return False
         for g in self._groups:
-            if g.id == WHEEL_RID:
+            if g[0] == WHEEL_RID:
                 return True
         return False
 
@@ -797,11 +941,11 @@ def get_current_user(request):
     """
     #mlgg.debug("get user: {}".format(request.path))
     principal = pyramid.security.unauthenticated_userid(request)
-    sess = DbSession()
-    rc = request.registry.settings['rc']
-    user_class = _dnr.resolve(
-        rc.g('auth.class.user'))
-    cusr = CurrentUser(sess, request, user_class)
+    user_class = request.registry['auth.user_class']
+    # DB session is created lazily, an unchanged user does not need it.
+    cusr = CurrentUser(None, request, user_class)
     if principal is not None:
-        cusr.load_by_principal(principal)
+        if not cusr.load_from_snapshot(principal):
+            cusr.load_by_principal(principal)
+        user_stats.touch(cusr.uid)
     return cusr
@@ -0,0 +1,116 @@
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+import sqlalchemy as sa
+
+import pym.models
+
+
+mlgg = logging.getLogger(__name__)
+
+
+class UserStatsBuffer():
+    """
+    Write-behind buffer of user statistics.
+
+    Collects values of ``access_time`` and of the login and logout stats per
+    user in process memory, and writes them to ``pym.user`` every
+    ``flush_interval`` seconds. Per column set, all buffered users are
+    updated by one statement. If a user is updated several times between
+    flushes, the last values win.
+
+    Statistics are written by a daemon thread outside of the request's
+    transaction, so a request never waits for the lock of a user row that
+    its own transaction holds. They do not change ``mtime`` or
+    ``editor_id`` of the user.
+    """
+
+    def __init__(self, flush_interval=10):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def touch(self, uid):
+        """
+        Sets ``access_time`` of given user to now.
+        """
+        self.update(uid, access_time=datetime.datetime.now())
+
+    def update(self, uid, **values):
+        """
+        Buffers new values of given user.
+
+        :param uid: ID of the user.
+        :param values: Column names and values.
+        """
+        self._ensure_flusher()
+        with self._lock:
+            self._pending.setdefault(uid, {}).update(values)
+
+    def _ensure_flusher(self):
+        # The thread does not survive a fork, so start one in each process.
+        # Values buffered before the fork belong to the parent.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self._pending = {}
+            self._pid = os.getpid()
+            t = threading.Thread(target=self._run, name='pym-user-stats',
+                daemon=True)
+            t.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except Exception:
+                mlgg.exception("Failed to flush user stats")
+
+    def flush(self):
+        """
+        Writes the buffered values to the DB.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or pym.models.DbEngine is None:
+            return
+        from .models import User
+        t = User.__table__
+        by_cols = {}
+        for uid, vv in pending.items():
+            by_cols.setdefault(tuple(sorted(vv)), []).append(uid)
+        try:
+            with pym.models.DbEngine.begin() as conn:
+                for cols, uids in by_cols.items():
+                    values = {}
+                    for c in cols:
+                        values[c] = sa.cast(
+                            sa.case({uid: pending[uid][c] for uid in uids},
+                                value=t.c.id),
+                            t.c[c].type
+                        )
+                    # Keep mtime from DefaultMixin's onupdate
+                    values['mtime'] = t.c.mtime
+                    conn.execute(
+                        t.update().where(t.c.id.in_(uids)).values(**values)
+                    )
+        except sa.exc.SQLAlchemyError as exc:
+            mlgg.warning("Failed to write user stats: {}".format(exc))
+
+
+user_stats = UserStatsBuffer()
+"""
+Process-wide buffer of user statistics, configured by :func:`pym.init_auth`.
+"""
+
+atexit.register(user_stats.flush)
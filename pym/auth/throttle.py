@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+import uuid
+
+import redis
+
+from pym.exc import ThrottledError
+
+
+mlgg = logging.getLogger(__name__)
+
+
+class LoginThrottle():
+    """
+    Throttles logins by counting failed attempts in Redis.
+
+    Failed attempts are counted per login (principal or email) and per remote
+    address in a sliding window of ``window`` seconds. If either count has
+    reached its maximum, :meth:`check` raises a
+    :class:`~pym.exc.ThrottledError` before the DB or the password hash is
+    touched.
+
+    A login found to be throttled is remembered in-process until its window
+    frees a slot, so that repeated attempts are rejected without asking Redis.
+
+    If Redis is not available, logins are not throttled.
+    """
+
+    KEY = 'pym:auth:throttle:{kind}:{ident}'
+
+    def __init__(self, enabled=False, window=300, max_per_login=5,
+            max_per_ip=20, redis_url=None, redis_db=0):
+        self._client = None
+        self._blocked = {}
+        self._lock = threading.Lock()
+        self.enabled = None
+        self.window = None
+        self.max_per_login = None
+        self.max_per_ip = None
+        self.redis_url = None
+        self.redis_db = None
+        self.configure(enabled, window, max_per_login, max_per_ip, redis_url,
+            redis_db)
+
+    def configure(self, enabled=False, window=300, max_per_login=5,
+            max_per_ip=20, redis_url=None, redis_db=0):
+        """
+        Configures the throttle.
+
+        :param enabled: Throttle only if True.
+        :param window: Length of the sliding window in seconds.
+        :param max_per_login: Max failed attempts per login within window.
+        :param max_per_ip: Max failed attempts per remote address within
+            window.
+        :param redis_url: URL of Redis.
+        :param redis_db: Number of Redis DB.
+        """
+        self.enabled = enabled and bool(redis_url)
+        self.window = window
+        self.max_per_login = max_per_login
+        self.max_per_ip = max_per_ip
+        self.redis_url = redis_url
+        self.redis_db = redis_db
+        with self._lock:
+            self._client = None
+            self._blocked.clear()
+
+    def check(self, login, remote_addr):
+        """
+        Raises :class:`~pym.exc.ThrottledError` if login is throttled.
+
+        :param login: Principal or email.
+        :param remote_addr: Remote address of the client.
+        """
+        if not self.enabled:
+            return
+        keys = self._keys(login, remote_addr)
+        now = time.time()
+        for k, _ in keys:
+            if self._blocked.get(k, 0) > now:
+                raise ThrottledError('Too many failed logins, please try '
+                                     'again later')
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for k, _ in keys:
+                pipe.zremrangebyscore(k, 0, now - self.window)
+                pipe.zrange(k, 0, 0, withscores=True)
+                pipe.zcard(k)
+            rs = pipe.execute()
+        except redis.RedisError as exc:
+            mlgg.warning("Failed to check login throttle: {}".format(exc))
+            return
+        for i, (k, max_) in enumerate(keys):
+            oldest, n = rs[i * 3 + 1], rs[i * 3 + 2]
+            if n >= max_:
+                until = oldest[0][1] + self.window if oldest else \
+                    now + self.window
+                with self._lock:
+                    if len(self._blocked) >= 10000:
+                        self._blocked.clear()
+                    self._blocked[k] = until
+                raise ThrottledError('Too many failed logins, please try '
+                                     'again later')
+
+    def add_failure(self, login, remote_addr):
+        """
+        Counts a failed attempt.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for k, _ in self._keys(login, remote_addr):
+                pipe.zadd(k, now, uuid.uuid4().hex)
+                pipe.zremrangebyscore(k, 0, now - self.window)
+                pipe.expire(k, int(self.window) + 1)
+            pipe.execute()
+        except redis.RedisError as exc:
+            mlgg.warning("Failed to count failed login: {}".format(exc))
+
+    def reset(self, *logins):
+        """
+        Resets counters of given logins, e.g. after a successful login.
+
+        Counters of remote addresses are kept.
+        """
+        if not self.enabled:
+            return
+        keys = [self.KEY.format(kind='login', ident=self._norm(x))
+            for x in logins if x]
+        if not keys:
+            return
+        with self._lock:
+            for k in keys:
+                self._blocked.pop(k, None)
+        try:
+            self.client.delete(*keys)
+        except redis.RedisError as exc:
+            mlgg.warning("Failed to reset login throttle: {}".format(exc))
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = redis.StrictRedis.from_url(self.redis_url,
+                    db=self.redis_db)
+            return self._client
+
+    def _keys(self, login, remote_addr):
+        keys = [(self.KEY.format(kind='login', ident=self._norm(login)),
+            self.max_per_login)]
+        if remote_addr:
+            keys.append((self.KEY.format(kind='ip', ident=remote_addr),
+                self.max_per_ip))
+        return keys
+
+    @staticmethod
+    def _norm(login):
+        return (login or '').strip().lower()
+
+
+login_throttle = LoginThrottle()
+"""
+Process-wide login throttle, configured by :func:`pym.init_auth`.
+"""
@@ -1,14 +1,32 @@
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+
 import sqlalchemy as sa
+import sqlalchemy.orm.attributes
 import sqlalchemy.orm.interfaces
 import sqlalchemy.orm.query as saqry
 import sqlalchemy.orm.session
+import sqlalchemy.sql.visitors
+from sqlalchemy.orm.path_registry import PathRegistry
+import transaction
 
 # noinspection PyPackageRequirements
 from dogpile.cache import make_region
 # noinspection PyPackageRequirements
 from dogpile.cache.api import NO_VALUE
+# noinspection PyPackageRequirements
+from dogpile.cache.proxy import ProxyBackend
+
 
-# TODO Fetch config settings from RC
+mlgg = logging.getLogger(__name__)
 
 
 def _stringify(s):
@@ -53,51 +71,1016 @@ def auth_long_term_keygen(namespace, fn, **kwargs):
     return generate_key
 
 
+class LocalLruProxy(ProxyBackend):
+    """
+    In-process LRU tier in front of a remote (Redis) backend.
+
+    Values found in the local tier are served without a round trip to Redis.
+    The local tier is bounded by ``max_size`` entries, each of which lives at
+    most ``ttl`` seconds. Keep ``ttl`` well below the expiration time of the
+    region.
+
+    We store the pickled value, not the object itself: cached ORM instances
+    are merged into the current session, and instances shared between
+    requests (and threads) would be attached to, and expired by, foreign
+    sessions.
+
+    Every ``set()`` and ``delete()`` is published on Redis channel
+    ``channel``, the ``*_multi()`` variants publish all their keys in one
+    message. Each worker process listens on this channel in a daemon
+    thread and drops the announced keys from its local tier, so that all
+    gunicorn workers see the change. If the proxied backend has no Redis
+    client, the local tier is only invalidated by its TTL.
+
+    Attribute ``stats`` counts hits and misses per tier.
+    """
+
+    CHANNEL = 'pym:cache:invalidate'
+    """Default Redis pub/sub channel for invalidation messages."""
+
+    ALL_KEYS = '*'
+    """Invalidation message to clear the whole local tier."""
+
+    def __init__(self, max_size=1000, ttl=60, channel=None):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.channel = channel if channel else self.__class__.CHANNEL
+        self.stats = dict.fromkeys(('local_hits', 'local_misses',
+            'remote_hits', 'remote_misses'), 0)
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._pid = None
+        self._origin = None
+
+    @property
+    def client(self):
+        """Redis client of the proxied backend, or None."""
+        return getattr(_actual_backend(self.proxied), 'client', None)
+
+    def _ensure_listener(self):
+        # The listener thread does not survive a fork, and a forked local
+        # tier is a copy of the parent's. So (re)initialise in each process.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._origin = '{}.{}'.format(uuid.uuid4().hex, self._pid)
+            self._data.clear()
+            client = self.client
+            if client is None:
+                return
+            t = threading.Thread(target=self._listen, args=(client, ),
+                name='pym-cache-invalidation', daemon=True)
+            t.start()
+
+    def _listen(self, client):
+        while True:
+            # noinspection PyBroadException
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for msg in pubsub.listen():
+                    if msg['type'] != 'message':
+                        continue
+                    data = msg['data']
+                    if isinstance(data, bytes):
+                        data = data.decode('utf-8')
+                    origin, _, keys = data.partition(' ')
+                    if origin == self._origin:
+                        continue
+                    keys = json.loads(keys)
+                    if self.__class__.ALL_KEYS in keys:
+                        self._clear_local()
+                    else:
+                        for key in keys:
+                            self._delete_local(key)
+            except Exception:
+                mlgg.exception("Cache invalidation listener failed,"
+                    " clearing local tier and reconnecting")
+                self._clear_local()
+                time.sleep(1)
+
+    def _publish(self, *keys):
+        client = self.client
+        if client is None or not keys:
+            return
+        client.publish(self.channel, '{} {}'.format(self._origin,
+            json.dumps(keys)))
+
+    def _count(self, name, n=1):
+        # Requests of a worker may run in several threads
+        with self._lock:
+            self.stats[name] += n
+
+    def _get_local(self, key):
+        with self._lock:
+            try:
+                expires, blob = self._data[key]
+            except KeyError:
+                return NO_VALUE
+            if expires < time.time():
+                del self._data[key]
+                return NO_VALUE
+            self._data.move_to_end(key)
+        return pickle.loads(blob)
+
+    def _set_local(self, key, value):
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, blob)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def _delete_local(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _clear_local(self):
+        with self._lock:
+            self._data.clear()
+
+    def get(self, key):
+        self._ensure_listener()
+        value = self._get_local(key)
+        if value is not NO_VALUE:
+            self._count('local_hits')
+            return value
+        self._count('local_misses')
+        value = self.proxied.get(key)
+        if value is NO_VALUE:
+            self._count('remote_misses')
+        else:
+            self._count('remote_hits')
+            self._set_local(key, value)
+        return value
+
+    def get_multi(self, keys):
+        self._ensure_listener()
+        values = [self._get_local(key) for key in keys]
+        misses = [i for i, v in enumerate(values) if v is NO_VALUE]
+        self._count('local_hits', len(keys) - len(misses))
+        if not misses:
+            return values
+        self._count('local_misses', len(misses))
+        # Fetch all local misses in one round trip
+        remote = self.proxied.get_multi([keys[i] for i in misses])
+        for i, value in zip(misses, remote):
+            if value is not NO_VALUE:
+                self._set_local(keys[i], value)
+            values[i] = value
+        remote_misses = sum(1 for v in remote if v is NO_VALUE)
+        self._count('remote_misses', remote_misses)
+        self._count('remote_hits', len(misses) - remote_misses)
+        return values
+
+    def set(self, key, value):
+        self._ensure_listener()
+        self.proxied.set(key, value)
+        self._set_local(key, value)
+        self._publish(key)
+
+    def set_multi(self, mapping):
+        self._ensure_listener()
+        self.proxied.set_multi(mapping)
+        for key, value in mapping.items():
+            self._set_local(key, value)
+        self._publish(*mapping)
+
+    def delete(self, key):
+        self._ensure_listener()
+        self.proxied.delete(key)
+        self._delete_local(key)
+        self._publish(key)
+
+    def delete_multi(self, keys):
+        self._ensure_listener()
+        self.proxied.delete_multi(keys)
+        for key in keys:
+            self._delete_local(key)
+        self._publish(*keys)
+
+    def clear(self):
+        """
+        Clears the local tier of all worker processes.
+
+        The remote tier is left untouched.
+        """
+        self._ensure_listener()
+        self._clear_local()
+        self._publish(self.__class__.ALL_KEYS)
+
+
+class StaleWhileRevalidateProxy(ProxyBackend):
+    """
+    Serves stale values while they are regenerated in the background.
+
+    The region's ``expiration_time`` is a soft expiration. When a value is
+    older, dogpile calls :meth:`run_async` for the one request that got the
+    creation lock. All requests, including that one, are immediately served
+    the stale value, and a background thread regenerates it.
+
+    The value must still be present in the backend for this to work, i.e.
+    the hard expiration of the backend must be greater than the soft one.
+    See :func:`configure_region`.
+
+    Attribute ``stats`` counts how often stale values were served, and how
+    often regeneration ran and failed. Stale values are counted when they
+    are read, by all requests, regeneration is counted by :meth:`run_async`.
+    """
+
+    def __init__(self, expiration_time):
+        super().__init__()
+        self.expiration_time = expiration_time
+        self.stats = {
+            'stale_served': 0,
+            'revalidations': 0,
+            'revalidation_errors': 0
+        }
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _count(self, name):
+        # Requests of a worker may run in several threads
+        with self._lock:
+            self.stats[name] += 1
+
+    def _count_stale(self, key, value):
+        if value is NO_VALUE \
+                or time.time() - value.metadata['ct'] <= self.expiration_time:
+            self._local.stale = None
+            self._local.reread = False
+            return
+        stale = (key, value.metadata['ct'])
+        self._local.reread = getattr(self._local, 'stale', None) == stale
+        self._local.stale = stale
+        self._count('stale_served')
+
+    def get(self, key):
+        value = self.proxied.get(key)
+        self._count_stale(key, value)
+        return value
+
+    def get_multi(self, keys):
+        values = self.proxied.get_multi(keys)
+        for key, value in zip(keys, values):
+            self._count_stale(key, value)
+        return values
+
+    def run_async(self, cache, somekey, creator, mutex):
+        """
+        Regenerates a value in a background thread.
+
+        Use this as ``async_creation_runner`` of the region.
+
+        :param cache: The region
+        :param somekey: Unmangled key
+        :param creator: Creator function of the value
+        :param mutex: The acquired creation lock, we must release it.
+        """
+        # Older dogpile reads the value again after it got the creation
+        # lock. That request was served the stale value only once.
+        if getattr(self._local, 'reread', False):
+            with self._lock:
+                self.stats['stale_served'] -= 1
+        self._local.stale = None
+        self._local.reread = False
+        self._count('revalidations')
+        # redis-py keeps the lock token thread-local. Hand it over, or the
+        # background thread cannot release the lock.
+        token = getattr(getattr(mutex, 'local', None), 'token', None)
+
+        def run():
+            _background.active = True
+            try:
+                if token is not None:
+                    mutex.local.token = token
+                cache.set(somekey, creator())
+            except Exception:
+                self._count('revalidation_errors')
+                mlgg.exception("Failed to revalidate cache key '{}'".format(
+                    somekey))
+            finally:
+                mutex.release()
+
+        t = threading.Thread(target=run, name='pym-cache-revalidate')
+        t.daemon = True
+        t.start()
+
+
+class StatsProxy(ProxyBackend):
+    """
+    Collects statistics of a region per key prefix.
+
+    Counts hits, misses, sets and deletes, and sums the latency of gets. The
+    size of set values is measured by pickling a sample of them, every
+    :attr:`SET_SAMPLE_RATE`-th, the backend pickles them again anyway. The
+    prefix of a key is determined by :func:`key_prefix`.
+
+    If the backend is Redis, the counters are periodically added to the hash
+    :attr:`STATS_KEY`, so that they are aggregated over all worker
+    processes, and can be read by other processes, e.g. ``pym cache-stats``.
+    Otherwise they are only kept in-process.
+    """
+
+    STATS_KEY = 'pym:cache:stats:{region}'
+    FIELDS = ('hits', 'misses', 'get_time', 'sets', 'set_samples',
+        'set_bytes', 'deletes')
+    SET_SAMPLE_RATE = 16
+    """Measure the size of every n-th set value."""
+    MAX_PREFIXES = 500
+    """Count more prefixes than these as :attr:`OTHER_PREFIX`."""
+    OTHER_PREFIX = '*other*'
+
+    def __init__(self, region_name, flush_interval=10):
+        super().__init__()
+        self.region_name = region_name
+        self.flush_interval = flush_interval
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._sets = 0
+
+    @property
+    def client(self):
+        """Redis client of the proxied backend, or None."""
+        return getattr(_actual_backend(self.proxied), 'client', None)
+
+    @property
+    def stats_key(self):
+        return self.__class__.STATS_KEY.format(region=self.region_name)
+
+    def _count(self, key, **kw):
+        cls = self.__class__
+        prefix = key_prefix(key)
+        with self._lock:
+            cc = self._counters.get(prefix)
+            if cc is None:
+                if len(self._counters) >= cls.MAX_PREFIXES:
+                    prefix = cls.OTHER_PREFIX
+                cc = self._counters.setdefault(prefix,
+                    dict.fromkeys(cls.FIELDS, 0))
+            for k, v in kw.items():
+                cc[k] += v
+        if time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def get(self, key):
+        t = time.perf_counter()
+        value = self.proxied.get(key)
+        t = time.perf_counter() - t
+        if value is NO_VALUE:
+            self._count(key, misses=1, get_time=t)
+        else:
+            self._count(key, hits=1, get_time=t)
+        return value
+
+    def get_multi(self, keys):
+        t = time.perf_counter()
+        values = self.proxied.get_multi(keys)
+        t = (time.perf_counter() - t) / (len(keys) or 1)
+        for key, value in zip(keys, values):
+            if value is NO_VALUE:
+                self._count(key, misses=1, get_time=t)
+            else:
+                self._count(key, hits=1, get_time=t)
+        return values
+
+    def _count_set(self, key, value):
+        with self._lock:
+            self._sets += 1
+            sample = (self._sets - 1) % self.__class__.SET_SAMPLE_RATE == 0
+        if sample:
+            self._count(key, sets=1, set_samples=1,
+                set_bytes=_pickled_size(value))
+        else:
+            self._count(key, sets=1)
+
+    def set(self, key, value):
+        self.proxied.set(key, value)
+        self._count_set(key, value)
+
+    def set_multi(self, mapping):
+        self.proxied.set_multi(mapping)
+        for key, value in mapping.items():
+            self._count_set(key, value)
+
+    def delete(self, key):
+        self.proxied.delete(key)
+        self._count(key, deletes=1)
+
+    def delete_multi(self, keys):
+        self.proxied.delete_multi(keys)
+        for key in keys:
+            self._count(key, deletes=1)
+
+    def flush(self):
+        """
+        Adds the local counters to the counters in Redis.
+
+        Does nothing if the backend is not Redis.
+        """
+        self._last_flush = time.time()
+        client = self.client
+        if client is None:
+            return
+        with self._lock:
+            counters, self._counters = self._counters, {}
+        if not counters:
+            return
+        pipe = client.pipeline(transaction=False)
+        for prefix, cc in counters.items():
+            for k, v in cc.items():
+                if not v:
+                    continue
+                field = '{}|{}'.format(prefix, k)
+                if isinstance(v, float):
+                    pipe.hincrbyfloat(self.stats_key, field, v)
+                else:
+                    pipe.hincrby(self.stats_key, field, v)
+        try:
+            pipe.execute()
+        except Exception as exc:
+            mlgg.warning("Failed to flush cache stats of region '{}': "
+                "{}".format(self.region_name, exc))
+
+    def stats(self):
+        """
+        Returns the statistics by key prefix.
+
+        Besides the counters, each prefix contains ``hit_ratio``,
+        ``avg_get_ms`` and ``avg_set_bytes``.
+        """
+        cls = self.__class__
+        self.flush()
+        with self._lock:
+            counters = {p: dict(cc) for p, cc in self._counters.items()}
+        client = self.client
+        if client is not None:
+            for field, v in client.hgetall(self.stats_key).items():
+                prefix, k = field.decode('utf-8').rsplit('|', 1)
+                cc = counters.setdefault(prefix, dict.fromkeys(cls.FIELDS, 0))
+                cc[k] += float(v) if k == 'get_time' else int(v)
+        for cc in counters.values():
+            gets = cc['hits'] + cc['misses']
+            cc['hit_ratio'] = cc['hits'] / gets if gets else None
+            cc['avg_get_ms'] = cc['get_time'] / gets * 1000 if gets else None
+            cc['avg_set_bytes'] = (cc['set_bytes'] / cc['set_samples']
+                if cc['set_samples'] else None)
+        return counters
+
+    def reset(self):
+        """Resets the statistics, also in Redis."""
+        with self._lock:
+            self._counters = {}
+        client = self.client
+        if client is not None:
+            client.delete(self.stats_key)
+
+
+def key_prefix(key):
+    """
+    Returns the prefix of a cache key for the statistics.
+
+    The prefix consists of the leading colon-separated parts of the key
+    that look like names, at most two. E.g. ``auth:user:alice`` yields
+    ``auth:user``, and ``resource:5:None`` yields ``resource``.
+
+    Keys of queries, ``q:<entity>:<fingerprint>...``, yield ``q:<entity>``.
+    Their remaining parts are hashes or SQL, never part of the prefix.
+    """
+    pp = []
+    for p in str(key).split(':', 2)[:2]:
+        if not p.isidentifier() or p == 'None':
+            break
+        pp.append(p)
+    return ':'.join(pp) if pp else '*'
+
+
+def _pickled_size(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+_background = threading.local()
+"""
+Flags the thread that regenerates a stale value.
+"""
+
+
+@contextlib.contextmanager
+def creator_session(sess):
+    """
+    Yields the DB session a creator function should use.
+
+    A creator may run in a background thread to regenerate a stale value,
+    see :class:`StaleWhileRevalidateProxy`. It must not use the session of
+    the request there, so we yield a new session bound to the same engine
+    and close it afterwards. In the foreground, we just yield ``sess``.
+
+    :param sess: The DB session of the caller.
+    """
+    if not getattr(_background, 'active', False):
+        yield sess
+        return
+    bg_sess = sa.orm.session.Session(bind=sess.get_bind())
+    try:
+        yield bg_sess
+    finally:
+        bg_sess.close()
+
+
+def _actual_backend(backend):
+    """Returns the backend that is wrapped by given chain of proxies."""
+    while isinstance(backend, ProxyBackend):
+        backend = backend.proxied
+    return backend
+
+
+def _find_proxy(region, cls):
+    backend = region.backend
+    while isinstance(backend, ProxyBackend):
+        if isinstance(backend, cls):
+            return backend
+        backend = backend.proxied
+    return None
+
+
+def get_local_tier(region):
+    """
+    Returns the :class:`LocalLruProxy` of given region, or None.
+    """
+    return _find_proxy(region, LocalLruProxy)
+
+
+def get_stats_proxy(region):
+    """
+    Returns the :class:`StatsProxy` of given region, or None.
+    """
+    return _find_proxy(region, StatsProxy)
+
+
+def get_revalidator(region):
+    """
+    Returns the :class:`StaleWhileRevalidateProxy` of given region, or None.
+    """
+    return _find_proxy(region, StaleWhileRevalidateProxy)
+
+
 region_default = make_region(
+    name='default',
     function_key_generator=default_keygen
-).configure(
-    'dogpile.cache.redis',
-    arguments={
-        'url': 'redis:///var/run/redis/redis.sock',
-        #'host': 'localhost',
-        #'port': 6379,
-        'db': 0,
-        'redis_expiration_time': 60 * 5,   # 5 minutes
-        'distributed_lock': True
-    }
 )
 
 
 region_auth_short_term = make_region(
+    name='auth_short_term',
     function_key_generator=auth_short_term_keygen
-).configure(
-    'dogpile.cache.redis',
-    arguments={
-        'url': 'redis:///var/run/redis/redis.sock',
-        #'host': 'localhost',
-        #'port': 6379,
-        'db': 0,
-        'redis_expiration_time': 60 * 10,   # 10 minutes
-        'distributed_lock': True
-    }
 )
 
 
 region_auth_long_term = make_region(
+    name='auth_long_term',
     function_key_generator=auth_long_term_keygen
-).configure(
-    'dogpile.cache.redis',
-    arguments={
-        'url': 'redis:///var/run/redis/redis.sock',
-        #'host': 'localhost',
-        #'port': 6379,
-        'db': 0,
-        'redis_expiration_time': 60 * 60 * 2,   # 2 hours
-        'distributed_lock': True
-    }
 )
 
 
+REGIONS = {
+    'default': region_default,
+    'auth_short_term': region_auth_short_term,
+    'auth_long_term': region_auth_long_term
+}
+"""
+Our cache regions by name. They are configured by :func:`configure_regions`.
+"""
+
+REDIS_BACKEND = 'dogpile.cache.redis'
+
+REGION_DEFAULTS = {
+    'default': {
+        'expiration_time': None,
+        'arguments.redis_expiration_time': 60 * 5,   # 5 minutes
+        'arguments.distributed_lock': True,
+        'local.max_size': 1000,
+        'local.ttl': 30
+    },
+    'auth_short_term': {
+        'expiration_time': None,
+        'arguments.redis_expiration_time': 60 * 10,   # 10 minutes
+        'arguments.distributed_lock': True,
+        'local.max_size': 1000,
+        'local.ttl': 60
+    },
+    'auth_long_term': {
+        'expiration_time': None,
+        'arguments.redis_expiration_time': 60 * 60 * 2,   # 2 hours
+        'arguments.distributed_lock': True,
+        'local.max_size': 5000,
+        'local.ttl': 60 * 5,
+        'stale.grace': 60 * 10
+    }
+}
+"""
+Settings of the Redis backed regions, if not overridden in rc.
+"""
+
+_INT_SETTINGS = ('expiration_time', 'arguments.redis_expiration_time',
+    'arguments.db', 'arguments.port', 'arguments.lock_timeout',
+    'arguments.max_connections', 'local.max_size', 'local.ttl',
+    'stale.grace', 'stats.flush_interval')
+_FLOAT_SETTINGS = ('arguments.lock_sleep', 'arguments.socket_timeout')
+_BOOL_SETTINGS = ('arguments.distributed_lock', 'stats.enabled')
+
+
+def _region_settings(settings, name, prefix):
+    """
+    Returns dict with the settings of a single region.
+
+    Keys are stripped of ``prefix + name + '.'``. If backend is Redis, the
+    missing keys are taken from :data:`REGION_DEFAULTS`, and the URL and
+    DB from ``cache.redis.url`` and ``cache.redis.db``.
+    """
+    pfx = prefix + name + '.'
+    lp = len(pfx)
+    rs = {k[lp:]: v for k, v in settings.items() if k.startswith(pfx)}
+    rs.setdefault('backend', REDIS_BACKEND)
+    if rs['backend'] == REDIS_BACKEND:
+        for k, v in REGION_DEFAULTS.get(name, {}).items():
+            rs.setdefault(k, v)
+        rs.setdefault('arguments.url', settings.get('cache.redis.url',
+            'redis:///var/run/redis/redis.sock'))
+        rs.setdefault('arguments.db', settings.get('cache.redis.db', 0))
+    for k, v in rs.items():
+        if v is None or not isinstance(v, str):
+            continue
+        if k in _INT_SETTINGS:
+            rs[k] = int(v)
+        elif k in _FLOAT_SETTINGS:
+            rs[k] = float(v)
+        elif k in _BOOL_SETTINGS:
+            rs[k] = sa.util.asbool(v)
+    return rs
+
+
+def configure_region(region, rs):
+    """
+    Configures a single region.
+
+    If ``stale.grace`` is set, stale values are served while they are
+    regenerated, see :class:`StaleWhileRevalidateProxy`. For Redis, the
+    expiration time of the keys then becomes the soft expiration time of
+    the region, and the keys are kept for another ``stale.grace`` seconds.
+
+    :param region: Instance of a dogpile region
+    :param rs: Dict with settings as returned by :func:`_region_settings`
+    """
+    arguments = {k[len('arguments.'):]: v for k, v in rs.items()
+        if k.startswith('arguments.')}
+    expiration_time = rs.get('expiration_time')
+    grace = rs.get('stale.grace')
+    if grace and rs['backend'] == REDIS_BACKEND:
+        if expiration_time is None:
+            expiration_time = arguments.get('redis_expiration_time')
+        if expiration_time:
+            arguments['redis_expiration_time'] = expiration_time + grace
+    max_connections = arguments.pop('max_connections', None)
+    if max_connections:
+        # noinspection PyPackageRequirements
+        import redis
+        arguments['connection_pool'] = redis.ConnectionPool.from_url(
+            arguments['url'], db=arguments.get('db', 0),
+            max_connections=max_connections)
+    wrap = []
+    if rs.get('local.max_size'):
+        wrap.append(LocalLruProxy(max_size=rs['local.max_size'],
+            ttl=rs.get('local.ttl', 60), channel=rs.get('local.channel')))
+    if grace and expiration_time:
+        revalidator = StaleWhileRevalidateProxy(expiration_time)
+        # Outermost, to also see the hits of the local tier
+        wrap.insert(0, revalidator)
+        region.async_creation_runner = revalidator.run_async
+    if rs.get('stats.enabled', True):
+        wrap.insert(0, StatsProxy(region.name,
+            flush_interval=rs.get('stats.flush_interval', 10)))
+    region.configure(
+        rs['backend'],
+        expiration_time=expiration_time,
+        arguments=arguments,
+        wrap=wrap
+    )
+
+
+def configure_regions(settings, prefix='cache.region.'):
+    """
+    Configures our cache regions from settings.
+
+    Configuration is done here and not at import time, so importing this
+    module stays cheap, and each environment may use its own backends.
+    Regions that are already configured are left untouched.
+
+    Each region is configured by these keys (``NAME`` being the key in
+    :data:`REGIONS`)::
+
+        cache.region.NAME.backend: dogpile.cache.redis
+        cache.region.NAME.expiration_time: ~
+        cache.region.NAME.arguments.url: 'redis:///var/run/redis/redis.sock'
+        cache.region.NAME.arguments.db: 0
+        cache.region.NAME.arguments.redis_expiration_time: 300
+        cache.region.NAME.arguments.distributed_lock: true
+        cache.region.NAME.arguments.lock_timeout: ~
+        cache.region.NAME.arguments.max_connections: ~
+        cache.region.NAME.local.max_size: 1000
+        cache.region.NAME.local.ttl: 30
+        cache.region.NAME.stale.grace: 0
+        cache.region.NAME.stats.enabled: true
+        cache.region.NAME.stats.flush_interval: 10
+
+    Key ``backend`` is the name of a dogpile backend, e.g.
+    ``dogpile.cache.memory`` for tests and benchmarks. The ``arguments``
+    are passed to the backend, except ``max_connections``, which sets the
+    size of the Redis connection pool. Keys ``local`` configure the
+    in-process tier (:class:`LocalLruProxy`); set ``local.max_size`` to 0 to
+    disable it. Key ``stale.grace`` enables serving of stale values
+    (:class:`StaleWhileRevalidateProxy`), keys ``stats`` configure the
+    statistics (:class:`StatsProxy`).
+
+    :param settings: Dict with settings, e.g. the merged rc data.
+    :param prefix: Prefix of the region settings.
+    """
+    for name, region in REGIONS.items():
+        if 'backend' in region.__dict__:
+            continue
+        configure_region(region, _region_settings(settings, name, prefix))
+
+
+def get_stats(region_name=None):
+    """
+    Returns statistics of the configured regions.
+
+    Per region, we return the statistics by key prefix (see
+    :meth:`StatsProxy.stats`), and the counters of the local tier and of
+    stale serving. The latter two are of the current process only.
+
+    :param region_name: Name of a single region, all if None.
+    """
+    stats = {}
+    for name, region in REGIONS.items():
+        if region_name and name != region_name:
+            continue
+        if 'backend' not in region.__dict__:
+            continue
+        rs = {'backend': _actual_backend(region.backend).__class__.__name__}
+        p = get_stats_proxy(region)
+        rs['prefixes'] = p.stats() if p else None
+        p = get_local_tier(region)
+        rs['local_tier'] = dict(p.stats, size=len(p._data)) if p else None
+        p = get_revalidator(region)
+        rs['stale'] = dict(p.stats) if p else None
+        stats[name] = rs
+    return stats
+
+
+def reset_stats(region_name=None):
+    """
+    Resets the statistics by key prefix.
+
+    :param region_name: Name of a single region, all if None.
+    """
+    for name, region in REGIONS.items():
+        if region_name and name != region_name:
+            continue
+        if 'backend' not in region.__dict__:
+            continue
+        p = get_stats_proxy(region)
+        if p:
+            p.reset()
+
+
+TAG_KEY = 'pym:cache:tag:{region}:{tag}'
+"""
+Redis key of the set of cache keys that are tagged with ``tag``.
+"""
+
+_tags = collections.defaultdict(set)
+"""
+Tagged keys of regions whose backend is not Redis, by (region name, tag).
+"""
+_tags_lock = threading.Lock()
+
+
+def tag_key(region_name, key, *tags):
+    """
+    Tags a cache key.
+
+    Call this when the value is created, not on each read. A tag is a string
+    naming something the cached value depends on, e.g. ``'user:7'``. Calling
+    :func:`invalidate_tags` with that tag deletes the key.
+
+    For Redis backends, the tags are stored in Redis as sets of keys, which
+    expire with the values of the region. Otherwise they are kept in-process.
+
+    :param region_name: Name of the region, see :data:`REGIONS`.
+    :param key: The cache key, unmangled.
+    :param tags: One or more tags.
+    """
+    region = REGIONS[region_name]
+    backend = _actual_backend(region.backend)
+    client = getattr(backend, 'client', None)
+    if client is None:
+        with _tags_lock:
+            for t in tags:
+                _tags[(region_name, t)].add(key)
+        return
+    ttl = getattr(backend, 'redis_expiration_time', 0)
+    pipe = client.pipeline(transaction=False)
+    for t in tags:
+        k = TAG_KEY.format(region=region_name, tag=t)
+        pipe.sadd(k, key)
+        if ttl:
+            pipe.expire(k, ttl)
+    pipe.execute()
+
+
+def invalidate_tags(*tags):
+    """
+    Deletes all cache keys that are tagged with any of the given tags.
+
+    Only the dependent keys are deleted, the regions are not flushed. This
+    includes the local tiers of all worker processes.
+
+    :param tags: One or more tags.
+    """
+    for region_name, region in REGIONS.items():
+        if 'backend' not in region.__dict__:
+            continue
+        client = getattr(_actual_backend(region.backend), 'client', None)
+        keys = set()
+        if client is None:
+            with _tags_lock:
+                for t in tags:
+                    keys |= _tags.pop((region_name, t), set())
+        else:
+            pipe = client.pipeline(transaction=True)
+            for t in tags:
+                k = TAG_KEY.format(region=region_name, tag=t)
+                pipe.smembers(k)
+                pipe.delete(k)
+            rs = pipe.execute()
+            for members in rs[::2]:
+                keys |= {x.decode('utf-8') for x in members}
+        if keys:
+            region.delete_multi(list(keys))
+
+
+def invalidate_tags_on_commit(*tags):
+    """
+    Invalidates given tags after the current transaction has been committed.
+
+    Invalidating earlier would allow concurrent requests to cache the old
+    state again before our changes become visible.
+
+    :param tags: One or more tags.
+    """
+    def hook(success):
+        if success:
+            invalidate_tags(*tags)
+    transaction.get().addAfterCommitHook(hook)
+
+
+def _tagging_creator(creator, region_name, key, tags):
+    """
+    Wraps creator function to tag the key of the created value.
+
+    :param tags: List of tags, or callable that takes the created value and
+        returns list of tags.
+    """
+    def create():
+        value = creator()
+        tt = tags(value) if callable(tags) else tags
+        if tt:
+            tag_key(region_name, key, *tt)
+        return value
+    return create
+
+
+class CompactRows(object):
+    """
+    Compact form of a cached list of ORM instances.
+
+    Pickling an ORM instance includes SQLAlchemy's instance state, and
+    repeats equal values of each instance. Here we keep only the mapped
+    class, the keys of its column attributes and the values column-wise.
+    A column that has the same value in all rows, e.g. ``owner_id`` or
+    ``kind``, is stored once.
+
+    :meth:`decode` rebuilds clean, persistent instances, which can be
+    merged into a session with ``load=False``. Relationships are not
+    stored, they are lazy loaded again. The load options and load path of
+    the instances are kept, so that these lazy loads honour e.g. a
+    :class:`RelationshipCache`, as they do with pickled instances.
+    """
+
+    __slots__ = ('cls', 'keys', 'length', 'columns', 'constants',
+        'load_options', 'load_path')
+
+    _MISSING = object()
+
+    def __init__(self, cls, keys, length, columns, constants,
+            load_options=None, load_path=None):
+        self.cls = cls
+        self.keys = keys
+        self.length = length
+        self.columns = columns
+        self.constants = constants
+        self.load_options = load_options
+        self.load_path = load_path
+
+    @classmethod
+    def encode(cls, value):
+        """
+        Returns compact form of given value.
+
+        Only lists of instances of the same mapped class with all column
+        attributes loaded, and with the same load options and path, can be
+        encoded. Other values are returned unchanged.
+        """
+        if not isinstance(value, list) or not value:
+            return value
+        klass = type(value[0])
+        try:
+            mapper = sa.inspect(klass)
+        except sa.exc.NoInspectionAvailable:
+            return value
+        if any(type(obj) is not klass for obj in value):
+            return value
+        state = sa.inspect(value[0])
+        if any(sa.inspect(obj).load_options != state.load_options
+                or sa.inspect(obj).load_path != state.load_path
+                for obj in value):
+            return value
+        keys = []
+        columns = []
+        constants = {}
+        dd = [obj.__dict__ for obj in value]
+        for k in (p.key for p in mapper.column_attrs):
+            col = [d.get(k, cls._MISSING) for d in dd]
+            v = col[0]
+            if all(x == v for x in col):
+                if v is cls._MISSING:
+                    return value
+                constants[k] = v
+                continue
+            if any(x is cls._MISSING for x in col):
+                return value
+            keys.append(k)
+            columns.append(tuple(col))
+        return cls(klass, tuple(keys), len(value), tuple(columns), constants,
+            load_options=state.load_options or None,
+            load_path=state.load_path.serialize() if state.load_path else None)
+
+    def decode(self):
+        """Returns list of instances rebuilt from the compact form."""
+        mapper = sa.inspect(self.cls)
+        new_instance = mapper.class_manager.new_instance
+        instance_state = sa.orm.attributes.instance_state
+        keys = self.keys
+        # Values cached before load options were kept lack these slots
+        load_options = getattr(self, 'load_options', None)
+        load_path = getattr(self, 'load_path', None)
+        if load_path:
+            load_path = PathRegistry.deserialize(load_path)
+        rows = zip(*self.columns) if self.columns else [()] * self.length
+        result = []
+        for row in rows:
+            obj = new_instance()
+            state = instance_state(obj)
+            # Like the ORM loader does: populate the dict directly, there
+            # is no history for committed values.
+            d = state.dict
+            d.update(self.constants)
+            d.update(zip(keys, row))
+            state.key = mapper._identity_key_from_state(state)
+            # Session.merge() copies these to the merged instance
+            if load_options:
+                state.load_options = load_options
+            if load_path:
+                state.load_path = load_path
+            result.append(obj)
+        return result
+
+
+def _compacting_creator(creator):
+    """Wraps creator function to return the compact form of its value."""
+    def create():
+        return CompactRows.encode(creator())
+    return create
+
+
 class CachingQuery(saqry.Query):
     """A Query subclass which optionally loads full results from a dogpile
     cache region.
@@ -135,17 +1118,25 @@ class CachingQuery(saqry.Query):
 
         """
         if hasattr(self, '_cache_region'):
-            return self.get_value(createfunc=lambda: list(
-                saqry.Query.__iter__(self)))
+            return self.get_value(createfunc=self._create_value)
         else:
             return saqry.Query.__iter__(self)
 
+    # noinspection PyCallByClass
+    def _create_value(self):
+        """Loads the result from DB, to be cached."""
+        with creator_session(self.session) as sess:
+            q = self if sess is self.session else self.with_session(sess)
+            return list(saqry.Query.__iter__(q))
+
     def _get_cache_plus_key(self):
         """Return a cache region plus key."""
 
         dogpile_region = self.cache_regions[self._cache_region.region]
         if self._cache_region.cache_key:
             key = self._cache_region.cache_key
+        elif getattr(self, '_cache_shape', None):
+            key = _shape_key_from_query(self, self._cache_shape)
         else:
             key = _key_from_query(self)
         return dogpile_region, key
@@ -163,6 +1154,12 @@ class CachingQuery(saqry.Query):
         Raise KeyError if no value present and no
         createfunc specified.
 
+        If the region serves stale values (see
+        :class:`StaleWhileRevalidateProxy`), an expired value is
+        returned immediately, and createfunc regenerates it in a
+        background thread.  Use :func:`creator_session` in createfunc
+        if it needs a DB session.
+
         """
         dogpile_region, cache_key = self._get_cache_plus_key()
 
@@ -173,6 +1170,12 @@ class CachingQuery(saqry.Query):
         assert not ignore_expiration or not createfunc, \
             "Can't ignore expiration and also provide createfunc"
 
+        if createfunc and self._cache_region.tags:
+            createfunc = _tagging_creator(createfunc,
+                self._cache_region.region, cache_key, self._cache_region.tags)
+        if createfunc and self._cache_region.compact:
+            createfunc = _compacting_creator(createfunc)
+
         if ignore_expiration or not createfunc:
             cached_value = dogpile_region.get(cache_key,
                                 expiration_time=expiration_time,
@@ -185,6 +1188,8 @@ class CachingQuery(saqry.Query):
             )
         if cached_value is NO_VALUE:
             raise KeyError(cache_key)
+        if isinstance(cached_value, CompactRows):
+            cached_value = cached_value.decode()
         if merge:
             cached_value = self.merge_result(cached_value, load=False)
         return cached_value
@@ -193,6 +1198,8 @@ class CachingQuery(saqry.Query):
         """Set the value in the cache for this query."""
 
         dogpile_region, cache_key = self._get_cache_plus_key()
+        if self._cache_region.compact:
+            value = CompactRows.encode(value)
         dogpile_region.set(cache_key, value)
 
 
@@ -222,7 +1229,73 @@ def _key_from_query(query, qualifier=None):
 
     # here we return the key as a long string.  our "key mangler"
     # set up with the region will boil it down to an md5.
-    return " ".join([str(compiled)] + [str(params[k]) for k in sorted(params)])
+    return 'q:{}:'.format(_entity_name(query)) + " ".join(
+        [str(compiled)] + [str(params[k]) for k in sorted(params)])
+
+
+def _entity_name(query):
+    """
+    Returns name of the first mapped class the query loads, or '-'.
+
+    Used in the cache keys of queries, so that the statistics count them
+    by entity, see :func:`key_prefix`.
+    """
+    try:
+        ent = query.column_descriptions[0]['entity']
+    except (IndexError, KeyError):
+        ent = None
+    name = getattr(ent, '__name__', None)
+    return name if name and name.isidentifier() else '-'
+
+
+_fingerprints = {}
+"""
+Memoized statement fingerprints, keyed by query shape.
+"""
+
+
+def _shape_key_from_query(query, shape):
+    """Given a Query and its shape, create a cache key without compiling SQL.
+
+    A shape is a hashable that identifies the structure of a query, e.g. the
+    call site that builds it. Queries of the same shape differ only in the
+    values of the bound parameters of their criterion (WHERE clause), in
+    the parameters given by ``Query.params()``, and in limit and offset.
+
+    The SQL statement of a shape is compiled only once, and its md5 is
+    memoized as the fingerprint of that shape. For each query we merely
+    collect the values of those parameters, which is much cheaper than
+    building and compiling the statement. The key is the fingerprint plus an
+    md5 of the parameter tuple.
+
+    The names of the bound parameters are part of the shape, so that a
+    shape that is (inadvertently) used for structurally different queries,
+    e.g. a filter by ID vs. a filter by name, gets different fingerprints.
+
+    """
+    binds = []
+    # noinspection PyProtectedMember
+    if query._criterion is not None:
+        # noinspection PyProtectedMember
+        sa.sql.visitors.traverse(query._criterion, {},
+            {'bindparam': binds.append})
+    shape = (shape, tuple(getattr(b, '_orig_key', b.key) for b in binds))
+    try:
+        fingerprint = _fingerprints[shape]
+    except KeyError:
+        sql = str(query.with_labels().statement.compile())
+        fingerprint = '{}:{}'.format(_entity_name(query),
+            hashlib.md5(sql.encode('utf-8')).hexdigest())
+        _fingerprints[shape] = fingerprint
+    # noinspection PyProtectedMember
+    params = (
+        tuple(b.effective_value for b in binds),
+        tuple(sorted(query._params.items())),
+        query._limit,
+        query._offset
+    )
+    params_hash = hashlib.md5(repr(params).encode('utf-8')).hexdigest()
+    return 'q:{}:{}'.format(fingerprint, params_hash)
 
 
 class FromCache(sa.orm.interfaces.MapperOption):
@@ -230,7 +1303,8 @@ class FromCache(sa.orm.interfaces.MapperOption):
 
     propagate_to_loaders = False
 
-    def __init__(self, region="default", cache_key=None):
+    def __init__(self, region="default", cache_key=None, shape=None,
+            tags=None, compact=False):
         """Construct a new FromCache.
 
         :param region: the cache region.  Should be a
@@ -243,13 +1317,32 @@ class FromCache(sa.orm.interfaces.MapperOption):
         as when using in_()) which correspond more simply to
         some other identifier.
 
+        :param shape: optional.  A hashable that identifies
+        the structure of the query, e.g. a string naming the
+        call site.  If given, the key is built from a memoized
+        fingerprint of the statement plus the bound parameters,
+        without compiling the statement each time.  Do not
+        use the same shape for structurally different queries.
+
+        :param tags: optional.  List of tags for the cached
+        result, or a callable that takes the loaded list of
+        instances and returns the tags.  See
+        :func:`invalidate_tags`.
+
+        :param compact: optional.  If True, cache only the column
+        values of the loaded instances, see :class:`CompactRows`.
+
         """
         self.region = region
         self.cache_key = cache_key
+        self.shape = shape
+        self.tags = tags
+        self.compact = compact
 
     def process_query(self, query):
         """Process a Query during normal loading operation."""
         query._cache_region = self
+        query._cache_shape = self.shape
 
 
 class RelationshipCache(sa.orm.interfaces.MapperOption):
@@ -258,7 +1351,8 @@ class RelationshipCache(sa.orm.interfaces.MapperOption):
 
     propagate_to_loaders = True
 
-    def __init__(self, attribute, region="default", cache_key=None):
+    def __init__(self, attribute, region="default", cache_key=None,
+            tags=None, compact=False):
         """Construct a new RelationshipCache.
 
         :param attribute: A Class.attribute which
@@ -271,9 +1365,17 @@ class RelationshipCache(sa.orm.interfaces.MapperOption):
         that will serve as the key to the query, bypassing
         the usual means of forming a key from the Query itself.
 
+        :param tags: optional.  List of tags, or callable, as
+        for :class:`FromCache`.
+
+        :param compact: optional.  If True, cache only the column
+        values, as for :class:`FromCache`.
+
         """
         self.region = region
         self.cache_key = cache_key
+        self.tags = tags
+        self.compact = compact
         self._relationship_options = {
             (attribute.property.parent.class_, attribute.property.key): self
         }
@@ -295,6 +1397,9 @@ class RelationshipCache(sa.orm.interfaces.MapperOption):
                 if (cls, key) in self._relationship_options:
                     relationship_option = self._relationship_options[(cls, key)]
                     query._cache_region = relationship_option
+                    # A lazy load of a given relationship always has the
+                    # same structure, so we can use a shape key.
+                    query._cache_shape = ('lazyload', mapper.class_, key)
                     break
 
     def and_(self, option):
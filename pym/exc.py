@@ -12,6 +12,21 @@ class AuthError(PymError):
     pass
 
 
+class ThrottledError(AuthError):
+    """
+    Signals that a login was rejected because of too many failed attempts.
+    """
+    pass
+
+
+class VerifierOverloadedError(AuthError):
+    """
+    Signals that a password could not be verified in time because the
+    verifier is overloaded. Says nothing about the credentials.
+    """
+    pass
+
+
 class SassError(PymError):
 
     def __init__(self, msg, resp=None):
@@ -14,6 +14,7 @@ import decimal
 import slugify as python_slugify
 import sqlalchemy as sa
 import magic
+import pyramid.util
 import colander
 import yaml
 import pym.exc
@@ -490,6 +491,36 @@ def truncate_html_words(s, num, end_text='&hellip;'):
     return out
 
 
+def keyset_filter(cols, values, direction='asc'):
+    """
+    Returns filter expression for keyset (seek) pagination.
+
+    Instead of skipping ``offset`` rows, the next page starts after the last
+    row of the previous page: with ascending order these are the rows whose
+    sort key is greater than the key of that row, e.g.
+    ``(order_field, id) > (:order_value, :id)``. With an index on the sort
+    key, each page costs the same, however deep.
+
+    The last column must make the key unique, typically the ID. Sort key
+    columns must not be NULL.
+
+    :param cols: List of columns that make up the sort key.
+    :param values: Values of these columns in the last seen row.
+    :param direction: Sort direction, 'asc' or 'desc'.
+    :return: SQLAlchemy expression.
+    """
+    if len(cols) != len(values):
+        raise ValueError("Keyset has {} values for {} columns".format(
+            len(values), len(cols)))
+    if len(cols) == 1:
+        lhs, rhs = cols[0], values[0]
+    else:
+        lhs, rhs = sa.tuple_(*cols), tuple(values)
+    if direction.lower() == 'desc':
+        return lhs < rhs
+    return lhs > rhs
+
+
 def rreplace(s, old, new, occurrence):
     """
     Replaces the last n occurrences of a thing.
@@ -598,10 +629,13 @@ def build_breadcrumbs(request):
 
     from pyramid.location import lineage
     # If context has no session, this raises a DetachedInstanceError:
-    linea = list(lineage(request.context))
+    linea = list(reversed(list(lineage(request.context))))
+    # Link only to nodes the user may visit
+    import pym.security
+    may_visit = pym.security.has_permissions(request, linea, 'visit')
     bcs = []
-    for i, elem in enumerate(reversed(linea)):
-        bc = [request.resource_url(elem)]
+    for i, elem in enumerate(linea):
+        bc = [request.resource_url(elem) if may_visit[i] else None]
         if i == 0:
             bc.append('Home')
         else:
@@ -729,3 +763,47 @@ class SingletonType(type):
         except AttributeError:
             cls.__instance = super(SingletonType, cls).__call__(*args, **kwargs)
             return cls.__instance
+
+
+class DottedNames():
+    """
+    Registry of resolved dotted names.
+
+    Resolving a dotted name imports its module and walks its attributes. Names
+    used on hot paths are registered once at startup, and lookups only hit a
+    dict. A name that was not registered is resolved on first lookup and then
+    kept as well.
+    """
+
+    def __init__(self):
+        self._resolver = pyramid.util.DottedNameResolver(None)
+        self._objects = {}
+
+    def register(self, name):
+        """
+        Resolves given dotted name and keeps the result.
+
+        :param name: Dotted name, e.g. ``'pym.auth.models.User'``.
+        :return: The resolved object.
+        """
+        obj = self._resolver.resolve(name)
+        self._objects[name] = obj
+        return obj
+
+    def resolve(self, name):
+        """
+        Returns the object of given dotted name.
+        """
+        try:
+            return self._objects[name]
+        except KeyError:
+            return self.register(name)
+
+    def __contains__(self, name):
+        return name in self._objects
+
+
+dotted_names = DottedNames()
+"""
+Process-wide registry of resolved dotted names.
+"""
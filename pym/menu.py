@@ -3,6 +3,7 @@ import pyramid.i18n
 import pyramid.location
 
 import pym.i18n
+import pym.security
 from pym.tenants.const import DEFAULT_TENANT_NAME
 from pym.sys.const import NODE_NAME_SYS, NODE_NAME_SYS_CACHE_MGMT
 from pym.auth.const import (NODE_NAME_SYS_AUTH_MGR, NODE_NAME_SYS_AUTH_USER_MGR,
@@ -40,74 +41,83 @@ _ = pyramid.i18n.TranslationStringFactory(pym.i18n.DOMAIN)
 
 
 def sys_menu(root_node, url_to, tenant=DEFAULT_TENANT_NAME,
-        translate=lambda s: s):
-    # Sys
+        translate=lambda s: s, request=None):
     node_sys = root_node[NODE_NAME_SYS]
-    id_ = resource_path(node_sys)
+    node_auth_mgr = node_sys[NODE_NAME_SYS_AUTH_MGR]
+    auth_entries = [
+        (node_auth_mgr[NODE_NAME_SYS_AUTH_USER_MGR], _("Users")),
+        (node_auth_mgr[NODE_NAME_SYS_AUTH_GROUP_MGR], _("Groups")),
+        (node_auth_mgr[NODE_NAME_SYS_AUTH_GROUP_MEMBER_MGR],
+            _("Group Members")),
+        (node_auth_mgr[NODE_NAME_SYS_AUTH_PERMISSION_MGR], _("Permissions")),
+    ]
+    node_cache_mgmt = node_sys[NODE_NAME_SYS_CACHE_MGMT]
+    may_visit = _visit_checker(request, [node_sys, node_auth_mgr,
+        node_cache_mgmt] + [e[0] for e in auth_entries])
+
+    # Sys
+    if not may_visit(node_sys):
+        return None
     menu_sys = {
-        'id': id_,
+        'id': resource_path(node_sys),
         'text': translate(_("System")),
         'href': url_to(node_sys),
         'children': []
     }
     # Sys / AuthMgr
-    node_auth_mgr = node_sys[NODE_NAME_SYS_AUTH_MGR]
-    id_ = resource_path(node_auth_mgr)
-    menu_sys['children'].append({
-        'id': id_,
-        'text': translate(_("AuthMgmt")),
-        'href': url_to(node_auth_mgr),
-        'children': []
-    })
-    # Sys / AuthMgr / Users
-    node = node_auth_mgr[NODE_NAME_SYS_AUTH_USER_MGR]
-    id_ = resource_path(node)
-    menu_sys['children'][-1]['children'].append({
-        'id': id_,
-        'text': translate(_("Users")),
-        'href': url_to(node)
-    })
-    # Sys / AuthMgr / Groups
-    node = node_auth_mgr[NODE_NAME_SYS_AUTH_GROUP_MGR]
-    id_ = resource_path(node)
-    menu_sys['children'][-1]['children'].append({
-        'id': id_,
-        'text': translate(_("Groups")),
-        'href': url_to(node)
-    })
-    # Sys / AuthMgr / GroupMembers
-    node = node_auth_mgr[NODE_NAME_SYS_AUTH_GROUP_MEMBER_MGR]
-    id_ = resource_path(node)
-    menu_sys['children'][-1]['children'].append({
-        'id': id_,
-        'text': translate(_("Group Members")),
-        'href': url_to(node)
-    })
-    # Sys / AuthMgr / Perms
-    node = node_auth_mgr[NODE_NAME_SYS_AUTH_PERMISSION_MGR]
-    id_ = resource_path(node)
-    menu_sys['children'][-1]['children'].append({
-        'id': id_,
-        'text': translate(_("Permissions")),
-        'href': url_to(node)
-    })
+    if may_visit(node_auth_mgr):
+        menu_sys['children'].append({
+            'id': resource_path(node_auth_mgr),
+            'text': translate(_("AuthMgmt")),
+            'href': url_to(node_auth_mgr),
+            'children': []
+        })
+        # Sys / AuthMgr / Users, Groups, GroupMembers, Perms
+        for node, text in auth_entries:
+            if not may_visit(node):
+                continue
+            menu_sys['children'][-1]['children'].append({
+                'id': resource_path(node),
+                'text': translate(text),
+                'href': url_to(node)
+            })
     # Sys / CacheMgmt
-    node = node_sys[NODE_NAME_SYS_CACHE_MGMT]
-    id_ = resource_path(node)
-    menu_sys['children'].append({
-        'id': id_,
-        'text': translate(_("Cache Management")),
-        'href': url_to(node)
-    })
+    if may_visit(node_cache_mgmt):
+        menu_sys['children'].append({
+            'id': resource_path(node_cache_mgmt),
+            'text': translate(_("Cache Management")),
+            'href': url_to(node_cache_mgmt)
+        })
     return menu_sys
 
 
 def main_menu(root_node, url_to, tenant=DEFAULT_TENANT_NAME,
-        translate=lambda s: s):
+        translate=lambda s: s, request=None):
+    """
+    Builds the main menu.
+
+    If ``request`` is given, the menu contains only entries the current user
+    may visit.
+    """
     menu = [
-        sys_menu(root_node, url_to, tenant, translate),
+        sys_menu(root_node, url_to, tenant, translate, request),
     ]
-    return menu
+    return [m for m in menu if m]
+
+
+def _visit_checker(request, nodes):
+    """
+    Returns a function that tells whether the current user may visit a node.
+
+    Permissions of all given nodes are checked at once by
+    :func:`pym.security.has_permissions`. Without a request, all nodes may
+    be visited.
+    """
+    if request is None:
+        return lambda node: True
+    allowed = {id(n) for n, ok in zip(nodes,
+        pym.security.has_permissions(request, nodes, 'visit')) if ok}
+    return lambda node: id(node) in allowed
 
 
 def resource_path(resource, *elements):
@@ -48,6 +48,7 @@ import pym.exc
 import pym.lib
 import pym.i18n
 import pym.cache
+import pym.search
 
 
 _ = pyramid.i18n.TranslationStringFactory(pym.i18n.DOMAIN)
@@ -290,6 +291,7 @@ def init(settings, prefix, invalidate_caches=False):
 
     :param settings: Dict with settings
     :param prefix: Prefix for SQLAlchemy settings
+    :param invalidate_caches: If True, flush all cache regions.
     """
     global DbEngine
     DbEngine = engine_from_config(settings, prefix,
@@ -299,6 +301,12 @@ def init(settings, prefix, invalidate_caches=False):
     DbSession.configure(bind=DbEngine)
     DbBase.metadata.bind = DbEngine
 
+    pym.search.search_backend.configure(
+        backend=settings.get('search.backend', 'none'),
+        ts_config=settings.get('search.ts_config', 'simple')
+    )
+
+    pym.cache.configure_regions(settings)
     add_cache_region('default', pym.cache.region_default)
     add_cache_region('auth_short_term', pym.cache.region_auth_short_term)
     add_cache_region('auth_long_term', pym.cache.region_auth_long_term)
@@ -1,4 +1,6 @@
-import pyramid.util
+import logging
+import pyramid.threadlocal
+import pyramid.traversal
 import sqlalchemy as sa
 import sqlalchemy.event
 from sqlalchemy.orm import (relationship, backref)
@@ -9,13 +11,17 @@ from sqlalchemy.orm.exc import NoResultFound
 import zope.interface
 
 import pym.lib
+import pym.models
 import pym.exc
 import pym.cache
+import pym.security
 import pym.auth.models as pam
 from pym.models import (DbBase, DefaultMixin, DbSession)
 from pym.models.types import CleanUnicode
 
 
+mlgg = logging.getLogger(__name__)
+
 class IRootNode(zope.interface.Interface):
     pass
 
@@ -28,10 +34,26 @@ class ISystemNode(zope.interface.Interface):
     pass
 
 
+MAX_PRELOAD_DEPTH = 30
+"""
+Traversal paths are preloaded up to this many segments.
+"""
+
+
 def root_factory(request):
     #return root_node
     sess = DbSession()
     n = ResourceNode.load_root(sess, 'root')
+    # Load the nodes traversal will need in one query. They are put into the
+    # node cache of the request, where __getitem__ finds them.
+    if request.matched_route is None:
+        path = []
+        for seg in pyramid.traversal.split_path_info(request.path_info):
+            if seg.startswith('@@') or len(path) >= MAX_PRELOAD_DEPTH:
+                break
+            path.append(seg)
+        if len(path) > 1:
+            ResourceNode.load_path(sess, n, path)
     return n
 
 
@@ -63,13 +85,15 @@ class ResourceNode(DbBase, DefaultMixin):
         ),
         nullable=True
     )
-    _name = sa.Column('name', CleanUnicode(255), nullable=False)
+    _name = sa.Column('name', CleanUnicode(255), nullable=False,
+        info={'search': True})
     """
     Name of the resource.
     Will be used in traversal as ``__name__``. May be set even for root
     resources, roots are recognized by ``parent_id`` being None.
     """
-    _title = sa.Column('title', CleanUnicode(255), nullable=True)
+    _title = sa.Column('title', CleanUnicode(255), nullable=True,
+        info={'search': True})
     """
     Title of the resource.
 
@@ -107,6 +131,24 @@ class ResourceNode(DbBase, DefaultMixin):
 
     E.g. 'pym.res:IRes'
     """
+    acl_version = sa.Column(sa.Integer(), nullable=False, default=0,
+        server_default='0')
+    """
+    Version of the ACL, incremented on each change by :meth:`allow` or
+    :meth:`deny`. Part of the key of the effective ACL cache, see
+    :meth:`__acl__`. Existing databases get the column by
+    ``pym upgrade-schema``, see :func:`pym.res.setup.add_acl_version_column`.
+    """
+    path = sa.Column(sa.UnicodeText(), nullable=True)
+    """
+    Materialized path of IDs from the root down to this node, e.g.
+    ``/1/5/17/``.
+
+    Maintained by listeners on insert and on move, deleted nodes take their
+    subtree with them by DB cascade. Ancestors, descendants and the root
+    can so be loaded with a single indexed query. Existing databases get the
+    column and its values by ``pym upgrade-schema``.
+    """
 
     children = relationship("ResourceNode",
         order_by=lambda: [ResourceNode.sortix, ResourceNode.name],
@@ -211,6 +253,12 @@ class ResourceNode(DbBase, DefaultMixin):
             setattr(ace, k, v)
 
         self.acl.append(ace)
+        # Increment in SQL, so that concurrent changes get distinct versions.
+        # The attribute is expired by the flush and reloaded on next access.
+        # New nodes keep version 0, no ACL of them is cached yet.
+        if sa.inspect(self).persistent:
+            self.acl_version = ResourceNode.acl_version + 1
+        self.invalidate_cache()
 
     def allow(self, sess, owner, permission, user=None, group=None,
             **kwargs):
@@ -256,8 +304,52 @@ class ResourceNode(DbBase, DefaultMixin):
         owner_id = pam.User.find(sess, owner).id
         n = ResourceNode(owner_id=owner_id, kind=kind, name=name, **kwargs)
         n.parent = self
+        self.invalidate_cache()
+        # We may have cached that this child does not exist
+        pym.cache.invalidate_tags_on_commit(
+            self.__class__.cache_tag(parent_id=self.id, name=name))
         return n
 
+    @staticmethod
+    def cache_tag(id=None, parent_id=None, name=None):
+        """
+        Returns tag for cache entries of a node.
+
+        Give either ``id``, or ``parent_id`` and ``name``. The latter is how
+        a node is loaded during traversal, ``parent_id`` is None for a root
+        node.
+        """
+        if id is not None:
+            return 'resource:{}'.format(id)
+        return 'resource:{}:{}'.format(parent_id, name)
+
+    @classmethod
+    def _cache_tags(cls, *tags):
+        """
+        Returns callable for the ``tags`` parameter of the cache options.
+
+        The cached result is tagged with the given static tags, and with the
+        tags of all nodes it contains.
+        """
+        def f(rr):
+            return list(tags) + [cls.cache_tag(id=r.id) for r in rr
+                if isinstance(r, ResourceNode)]
+        return f
+
+    def invalidate_cache(self):
+        """
+        Invalidates cache entries of this node after commit.
+
+        Call this whenever you change a node, its ACL or its children.
+        """
+        nc = current_node_cache()
+        if nc:
+            nc.discard(self)
+        pym.cache.invalidate_tags_on_commit(
+            self.__class__.cache_tag(id=self.id),
+            self.__class__.cache_tag(parent_id=self.parent_id, name=self.name)
+        )
+
     @classmethod
     def find(cls, sess, parent, **kwargs):
         """
@@ -310,21 +402,32 @@ class ResourceNode(DbBase, DefaultMixin):
         """
         # CAVEAT: Setup fails if we use cache here!
         if use_cache:
+            nc = current_node_cache()
+            if nc:
+                r = nc.get(sess, name, None)
+                if r is not None:
+                    return r
+            tags = cls._cache_tags(cls.cache_tag(parent_id=None, name=name))
             r = sess.query(
                 cls
             ).options(
                 pym.cache.FromCache("auth_long_term",
-                cache_key='resource:{}:None'.format(name))
+                cache_key='resource:{}:None'.format(name), tags=tags,
+                compact=True)
             ).options(
                 pym.cache.RelationshipCache(cls.children, "auth_long_term",
-                cache_key='resource:{}:None:children'.format(name))
+                cache_key='resource:{}:None:children'.format(name), tags=tags,
+                compact=True)
             ).options(
                 # CAVEAT: Program hangs if we use our own cache key here!
-                pym.cache.RelationshipCache(cls.acl, "auth_long_term")  # ,
+                pym.cache.RelationshipCache(cls.acl, "auth_long_term",
+                tags=tags, compact=True)  # ,
                 #cache_key='resource:{}:None:acl'.format(name))
             ).filter(
                 sa.and_(cls.parent_id == None, cls.name == name)
             ).one()
+            if nc:
+                nc.add(r, fetched=True)
         else:
             r = sess.query(
                 cls
@@ -333,17 +436,178 @@ class ResourceNode(DbBase, DefaultMixin):
             ).one()
         return r
 
+    @classmethod
+    def load_path(cls, sess, parent, path, use_cache=True):
+        """
+        Loads the nodes along a path with a single query.
+
+        The chain of nodes is found by a recursive CTE. Their ACLs are joined
+        in, and their parents are set, so neither ``__parent__`` nor
+        ``__acl__`` need further loads. If there is a node cache for the
+        current request, the nodes are put there, so traversal finds them.
+
+        :param sess: A DB session
+        :param parent: Node where the path starts, e.g. the root node.
+        :param path: List of names, as used in traversal.
+        :param use_cache: Whether to cache the result.
+        :return: List of the nodes along the path, starting with the child
+            of ``parent``. It stops before the first name that was not found.
+        """
+        path = list(path)
+        if not path:
+            return []
+        chain = sess.query(
+            cls.id, sa.literal(1).label('depth')
+        ).filter(
+            sa.and_(cls.parent_id == parent.id, cls.name == path[0])
+        ).cte('path_chain', recursive=True)
+        if len(path) > 1:
+            t = sa.orm.aliased(cls)
+            # Name of the next node, given the depth of the current one
+            next_name = sa.case(
+                {depth: name for depth, name in enumerate(path) if depth},
+                value=chain.c.depth
+            )
+            chain = chain.union_all(
+                sess.query(
+                    t.id, chain.c.depth + 1
+                ).filter(
+                    sa.and_(
+                        t.parent_id == chain.c.id,
+                        chain.c.depth < len(path),
+                        t.name == next_name
+                    )
+                )
+            )
+        q = sess.query(cls).join(chain, cls.id == chain.c.id)
+        if use_cache:
+            def tags(rr):
+                nn = cls._path_chain(parent.id, path, rr)
+                pids = [parent.id] + [n.id for n in nn]
+                # Adding the next missing node must invalidate us as well.
+                return [cls.cache_tag(parent_id=pid, name=name)
+                        for pid, name in zip(pids, path)] \
+                    + [cls.cache_tag(id=n.id) for n in rr]
+            q = q.options(
+                pym.cache.FromCache("auth_long_term",
+                    cache_key='resource:path:{}:{}'.format(
+                        parent.id, '/'.join(path)), tags=tags)
+            )
+        nodes = cls._path_chain(parent.id, path, q.all())
+        nc = current_node_cache()
+        set_committed_value = sa.orm.attributes.set_committed_value
+        p = parent
+        for i, n in enumerate(nodes):
+            set_committed_value(n, 'parent', p)
+            if nc:
+                nc.add(n, fetched=i == 0)
+            p = n
+        return nodes
+
+    @staticmethod
+    def _path_chain(parent_id, path, nodes):
+        """
+        Returns the nodes that form the path, in order.
+
+        Stops at a missing or ambiguous name.
+        """
+        chain = []
+        for name in path:
+            nn = [n for n in nodes if n.parent_id == parent_id
+                and n.name == name]
+            if len(nn) != 1:
+                break
+            chain.append(nn[0])
+            parent_id = nn[0].id
+        return chain
+
     def is_root(self):
         return self.parent_id is None
 
     def dumps(self, _indent=0):
+        if self.path and not _indent:
+            # Load whole subtree at once
+            nn = self.descendants()
+            children = {}
+            for n in sorted(nn, key=lambda n: (n.sortix or 0, n.name)):
+                children.setdefault(n.parent_id, []).append(n)
+
+            def _dumps(n, indent):
+                return "   " * indent + repr(n) + "\n" + "".join(
+                    [_dumps(c, indent + 1) for c in children.get(n.id, [])])
+            return _dumps(self, 0)
         return "   " * _indent \
             + repr(self) + "\n" \
             + "".join([c.dumps(_indent + 1) for c in self.children.values()])
 
-    def __acl__(self):
+    def path_ids(self):
+        """
+        Returns list of IDs from the root down to this node, from ``path``.
+        """
+        return [int(x) for x in self.path.strip('/').split('/')]
+
+    def ancestors(self):
+        """
+        Returns list of ancestors, root first, loaded with one query.
+
+        Needs ``path``, otherwise walks up by ``__parent__``.
+        """
+        if not self.path:
+            aa = []
+            n = self.__parent__
+            while n is not None:
+                aa.insert(0, n)
+                n = n.__parent__
+            return aa
+        cls = self.__class__
+        sess = sa.inspect(self).session
+        ids = self.path_ids()[:-1]
+        if not ids:
+            return []
+        nn = {n.id: n for n in sess.query(cls).filter(cls.id.in_(ids))}
+        nc = current_node_cache()
+        if nc:
+            for n in nn.values():
+                nc.add(n)
+        return [nn[i] for i in ids]
+
+    def descendants(self, kind=None):
+        """
+        Returns list of all descendants, loaded with one query.
+
+        Needs ``path``, otherwise walks down by ``children``. The query uses
+        the prefix index on ``path``.
+
+        :param kind: Optional. Return only descendants of this kind.
+        """
+        if not self.path:
+            dd = []
+            todo = [self]
+            while todo:
+                n = todo.pop(0)
+                cc = list(n.children.values())
+                dd.extend(c for c in cc if not kind or c.kind == kind)
+                todo.extend(cc)
+            return dd
+        cls = self.__class__
+        sess = sa.inspect(self).session
+        q = sess.query(cls).filter(
+            sa.and_(cls.path.like(self.path + '%'), cls.id != self.id)
+        )
+        if kind:
+            q = q.filter(cls.kind == kind)
+        return q.all()
+
+    def __acl__(self, version=None):
         """
         ACL for Pyramid's authorization policy.
+
+        The ACL is expanded by the parents and children of the permissions.
+        The effective ACL is cached in-process by node ID, ACL version and
+        version of the permission tree. Do not modify the returned tuple.
+
+        :param version: Optional. Version of the permission tree, if caller
+            already has it.
         """
         sess = sa.inspect(self).session
         # Bind ourselves to a new session in case we'd lost our session. This
@@ -355,6 +619,78 @@ class ResourceNode(DbBase, DefaultMixin):
         if not sess:
             sess = DbSession()
             sess.add(self)
+        if self.id is None:
+            return self._build_acl(sess)
+        if version is None:
+            version = permission_version()
+        key = (self.id, self.acl_version, version)
+        acl = _effective_acls.get(key)
+        if acl is None:
+            acl = self._build_acl(sess)
+            if len(_effective_acls) >= EFFECTIVE_ACL_CACHE_SIZE:
+                _effective_acls.clear()
+            _effective_acls[key] = acl
+        return acl
+
+    def __acl_masks__(self, version=None):
+        """
+        Allow and deny masks of the effective ACL.
+
+        Used by :class:`pym.security.BitmaskAuthorizationPolicy`. Masks are
+        cached like the effective ACL.
+
+        :param version: Optional. Version of the permission tree, if caller
+            already has it.
+        """
+        if self.id is None:
+            return pym.security.AclMasks.from_acl(self.__acl__())
+        if version is None:
+            version = permission_version()
+        key = (self.id, self.acl_version, version)
+        try:
+            return _acl_masks[key]
+        except KeyError:
+            masks = pym.security.AclMasks.from_acl(self.__acl__(version))
+            if len(_acl_masks) >= EFFECTIVE_ACL_CACHE_SIZE:
+                _acl_masks.clear()
+            _acl_masks[key] = masks
+            return masks
+
+    @classmethod
+    def acl_masks_of(cls, nodes):
+        """
+        Returns masks of the effective ACLs of many nodes at once.
+
+        Used by :func:`pym.security.has_permissions`. The version of the
+        permission tree is looked up once per request, and the ACEs of nodes
+        whose ACL is neither cached nor loaded are fetched in a single query.
+
+        :param nodes: List of nodes.
+        :return: List of :class:`pym.security.AclMasks` in order of
+            ``nodes``.
+        """
+        version = permission_version()
+        unloaded = [n for n in nodes
+            if n.id is not None
+            and (n.id, n.acl_version, version) not in _acl_masks
+            and 'acl' in sa.inspect(n).unloaded]
+        if unloaded:
+            sess = sa.inspect(unloaded[0]).session or DbSession()
+            aces = {}
+            for ace in sess.query(
+                pam.Ace
+            ).filter(
+                pam.Ace.resource_id.in_([n.id for n in unloaded])
+            ).order_by(
+                pam.Ace.resource_id, pam.Ace.allow, pam.Ace.sortix
+            ):
+                aces.setdefault(ace.resource_id, []).append(ace)
+            for n in unloaded:
+                sa.orm.attributes.set_committed_value(n, 'acl',
+                    aces.get(n.id, []))
+        return [n.__acl_masks__(version) for n in nodes]
+
+    def _build_acl(self, sess):
         acl = []
         perms = pam.Permission.load_all(sess)
         # Convert self.acl into Pyramid's ACL
@@ -369,42 +705,54 @@ class ResourceNode(DbBase, DefaultMixin):
                         acl.append(pyr_ace2)
             # If deny, deny all children
             else:
-                for ch in perms[ace.permission_id]['children']:
+                for ch in perms[ace.permission_id]['children'] or []:
                     pyr_ace2 = (pyr_ace[0], pyr_ace[1], ch[1])
                     acl.append(pyr_ace2)
-        return acl
+        return tuple(acl)
 
     @classmethod
     def load_child(cls, sess, id_or_name, parent_id=None, use_cache=True):
         if isinstance(id_or_name, int):
             fil = [cls.id == id_or_name]
+            tag = cls.cache_tag(id=id_or_name)
         else:
             fil = [
                 cls.parent_id == parent_id,
                 cls.name == id_or_name,
             ]
+            tag = cls.cache_tag(parent_id=parent_id, name=id_or_name)
         if use_cache:
-            return sess.query(
+            nc = current_node_cache()
+            if nc:
+                n = nc.get(sess, id_or_name, parent_id)
+                if n is not None:
+                    return n
+            tags = cls._cache_tags(tag)
+            n = sess.query(
                 cls
             ).options(
                 pym.cache.FromCache("auth_long_term",
                     cache_key='resource:{}:{}'.format(
-                        id_or_name, parent_id))
+                        id_or_name, parent_id), tags=tags, compact=True)
             ).options(
                 pym.cache.RelationshipCache(cls.children, "auth_long_term",
                     cache_key='resource:{}:{}:children'.format(
-                        id_or_name, parent_id))
+                        id_or_name, parent_id), tags=tags, compact=True)
             ).options(
                 pym.cache.RelationshipCache(cls.acl, "auth_long_term",
                     cache_key='resource:{}:{}:acl'.format(
-                        id_or_name, parent_id))
+                        id_or_name, parent_id), tags=tags, compact=True)
             ).options(
-                pym.cache.RelationshipCache(cls.parent, "auth_long_term")#,
+                pym.cache.RelationshipCache(cls.parent, "auth_long_term",
+                    tags=tags, compact=True)#,
                     #cache_key='presource:{}:{}:parent'.format(
                     #    id_or_name, parent_id))
             ).filter(
                 sa.and_(*fil)
             ).one()
+            if nc:
+                nc.add(n, fetched=True)
+            return n
         else:
             return sess.query(
                 cls
@@ -441,7 +789,17 @@ class ResourceNode(DbBase, DefaultMixin):
         """
         if self.parent_id is None:
             return None
-        return self.parent
+        nc = current_node_cache()
+        if not nc:
+            return self.parent
+        sess = sa.inspect(self).session
+        p = nc.get(sess, self.parent_id)
+        if p is None:
+            fetched = 'parent' in sa.inspect(self).unloaded
+            p = self.parent
+            if p is not None:
+                nc.add(p, fetched=fetched)
+        return p
 
     @hybrid_property
     def name(self):
@@ -497,9 +855,18 @@ class ResourceNode(DbBase, DefaultMixin):
 
     @property
     def root(self):
+        if self.parent_id is None:
+            return self
+        if self.path:
+            sess = sa.inspect(self).session
+            root_id = self.path_ids()[0]
+            nc = current_node_cache()
+            n = nc.get(sess, root_id) if nc else None
+            return n if n is not None else sess.query(
+                self.__class__).get(root_id)
         n = self
-        while n.parent:
-            n = n.parent
+        while n.parent_id is not None:
+            n = n.__parent__
         return n
 
     @property
@@ -509,11 +876,255 @@ class ResourceNode(DbBase, DefaultMixin):
         return self.root.__user__
 
 
+EFFECTIVE_ACL_CACHE_SIZE = 10000
+"""
+Max number of effective ACLs cached in-process.
+"""
+
+_effective_acls = {}
+"""
+Effective ACLs by (node ID, ACL version, permission tree version).
+"""
+
+_acl_masks = {}
+"""
+Instances of :class:`pym.security.AclMasks` by the same keys as
+:data:`_effective_acls`.
+"""
+
+
+class NodeCache(object):
+    """
+    Request-local cache of resource nodes.
+
+    Traversal, ``lineage()``, breadcrumbs and menus walk the same nodes many
+    times during a request. Nodes that were loaded are kept here by ID and
+    by (parent ID, name), so that each one is materialized only once per
+    request. Only nodes of the given session are returned, e.g. an error
+    page with a new session loads its own nodes.
+
+    The version of the permission tree is also looked up once per request,
+    see :meth:`permission_version`.
+
+    Attribute ``stats`` counts hits here and the fetches from DB or cache
+    regions that were still needed. With log level DEBUG, they are logged
+    at the end of the request.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.stats = {
+            'hits': 0,
+            'fetches': 0
+        }
+        self._permission_version = None
+
+    def permission_version(self):
+        """
+        Returns version of the permission tree, see
+        :meth:`pym.auth.models.Permission.version`.
+
+        Looked up on first call, later calls of this request get the same
+        version, even if the permissions changed meanwhile.
+        """
+        if self._permission_version is None:
+            self._permission_version = pam.Permission.version()
+        return self._permission_version
+
+    def get(self, sess, id_or_name, parent_id=None):
+        """
+        Returns a node, or None if it is not cached.
+
+        :param sess: The DB session the node must belong to.
+        :param id_or_name: ID, or name of node.
+        :param parent_id: ID of parent, if looked up by name.
+        """
+        if isinstance(id_or_name, int):
+            n = self.by_id.get(id_or_name)
+        else:
+            n = self.by_name.get((parent_id, id_or_name))
+        if n is None or sa.inspect(n).session is not sess:
+            return None
+        self.stats['hits'] += 1
+        return n
+
+    def add(self, n, fetched=False):
+        """
+        Adds a node.
+
+        :param n: The node.
+        :param fetched: Whether we had to fetch the node to get it.
+        """
+        self.by_id[n.id] = n
+        self.by_name[(n.parent_id, n.name)] = n
+        if fetched:
+            self.stats['fetches'] += 1
+
+    def discard(self, n):
+        """Removes a node, e.g. because it was changed."""
+        self.by_id.pop(n.id, None)
+        if self.by_name.get((n.parent_id, n.name)) is n:
+            del self.by_name[(n.parent_id, n.name)]
+
+
+def get_node_cache(request):
+    """
+    Returns a new :class:`NodeCache` for the request.
+
+    This is used as a reified request method ``request.node_cache``.
+    """
+    nc = NodeCache()
+    if mlgg.isEnabledFor(logging.DEBUG):
+        def log_stats(req):
+            mlgg.debug("Traversal of '{}': {}".format(req.path, nc.stats))
+        request.add_finished_callback(log_stats)
+    return nc
+
+
+def current_node_cache():
+    """
+    Returns the :class:`NodeCache` of the current request, or None.
+
+    Outside of a request, e.g. in scripts, there is no node cache.
+    """
+    request = pyramid.threadlocal.get_current_request()
+    if request is None:
+        return None
+    return getattr(request, 'node_cache', None)
+
+
+def permission_version():
+    """
+    Returns version of the permission tree, once per request.
+
+    Uses the :class:`NodeCache` of the current request. Outside of a request,
+    the version is looked up each time.
+    """
+    nc = current_node_cache()
+    if not nc:
+        return pam.Permission.version()
+    return nc.permission_version()
+
+
+def register_ifaces():
+    """
+    Resolves the interfaces of all resource nodes once at startup.
+
+    Registers them in :data:`pym.lib.dotted_names`, so that
+    :func:`resource_node_load_listener` needs not resolve them per request.
+    Interfaces of nodes created later are resolved on first load.
+    """
+    t = ResourceNode.__table__
+    try:
+        with pym.models.DbEngine.connect() as conn:
+            rs = conn.execute(
+                sa.select([t.c.iface]).where(t.c.iface != None).distinct()
+            ).fetchall()
+    except sa.exc.SQLAlchemyError as exc:
+        # E.g. during setup, when the table does not exist yet
+        mlgg.warning("Failed to load interfaces of resources: {}".format(exc))
+        return
+    for r in rs:
+        try:
+            pym.lib.dotted_names.register(r.iface)
+        except ImportError as exc:
+            mlgg.warning("Failed to resolve interface '{}': {}".format(
+                r.iface, exc))
+
+
+_provides_specs = {}
+"""
+Provided-by specs of loaded resource nodes by (class, iface).
+"""
+
+
 # When we load a node from DB attach the stored interface to the instance.
 # noinspection PyUnusedLocal
 def resource_node_load_listener(target, context):
-    if target.iface:
-        iface = pyramid.util.DottedNameResolver(None).resolve(target.iface)
-        zope.interface.alsoProvides(target, iface)
+    """
+    Lets a loaded node provide the interface named in its ``iface``.
+
+    Same as ``alsoProvides()``, but the spec is built once per class and
+    interface, and then just assigned to each instance.
+    """
+    if not target.iface:
+        return
+    if '__provides__' in target.__dict__:
+        # Instance already provides something, let zope merge it.
+        zope.interface.alsoProvides(target,
+            pym.lib.dotted_names.resolve(target.iface))
+        return
+    key = (target.__class__, target.iface)
+    try:
+        spec = _provides_specs[key]
+    except KeyError:
+        iface = pym.lib.dotted_names.resolve(target.iface)
+        spec = zope.interface.declarations.Provides(target.__class__, iface)
+        _provides_specs[key] = spec
+    target.__provides__ = spec
 
 sa.event.listen(ResourceNode, 'load', resource_node_load_listener)
+
+
+sa.Index("resource_tree_path_ix", ResourceNode.__table__.c.path,
+    postgresql_ops={'path': 'text_pattern_ops'})
+
+
+def _parent_path(connection, target):
+    if target.parent_id is None:
+        return '/'
+    p = target.__dict__.get('parent')
+    if p is not None and p.path:
+        return p.path
+    t = ResourceNode.__table__
+    return connection.execute(
+        sa.select([t.c.path]).where(t.c.id == target.parent_id)
+    ).scalar()
+
+
+# Maintain the materialized path.
+# noinspection PyUnusedLocal
+def resource_node_after_insert_listener(mapper, connection, target):
+    parent_path = _parent_path(connection, target)
+    if parent_path is None:
+        # Parent has no path yet, needs backfill
+        return
+    path = parent_path + '{}/'.format(target.id)
+    t = ResourceNode.__table__
+    connection.execute(t.update().where(t.c.id == target.id).values(
+        path=path))
+    sa.orm.attributes.set_committed_value(target, 'path', path)
+
+
+# noinspection PyUnusedLocal
+def resource_node_after_update_listener(mapper, connection, target):
+    attrs = sa.inspect(target).attrs
+    if not (attrs.parent_id.history.has_changes()
+            or attrs.parent.history.has_changes()):
+        return
+    old_path = target.path
+    parent_path = _parent_path(connection, target)
+    if old_path is None or parent_path is None:
+        return
+    path = parent_path + '{}/'.format(target.id)
+    if path == old_path:
+        return
+    # Move the whole subtree
+    t = ResourceNode.__table__
+    connection.execute(t.update().where(t.c.path.like(old_path + '%')).values(
+        path=sa.literal(path) + sa.func.substr(t.c.path, len(old_path) + 1)))
+    # Keep the loaded nodes of the subtree in sync
+    sess = sa.orm.object_session(target)
+    for obj in list(sess.identity_map.values()) if sess else [target]:
+        if not isinstance(obj, ResourceNode):
+            continue
+        p = obj.__dict__.get('path')
+        if p and p.startswith(old_path):
+            sa.orm.attributes.set_committed_value(obj, 'path',
+                path + p[len(old_path):])
+
+sa.event.listen(ResourceNode, 'after_insert',
+    resource_node_after_insert_listener, propagate=True)
+sa.event.listen(ResourceNode, 'after_update',
+    resource_node_after_update_listener, propagate=True)
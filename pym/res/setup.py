@@ -1,6 +1,8 @@
 import os
 import logging
+import sqlalchemy as sa
 from pym.auth.const import SYSTEM_UID, WHEEL_RID
+import pym.exc
 import pym.models
 from .models import ResourceNode
 from .const import *
@@ -40,6 +42,139 @@ def create_schema(sess, rc):
     pass
 
 
+def _add_column(sess, name, ddl):
+    q = sa.text("""
+        SELECT 1
+        FROM   information_schema.columns
+        WHERE  table_schema = 'pym'
+        AND    table_name = 'resource_tree'
+        AND    column_name = :name
+    """)
+    if sess.execute(q, {'name': name}).scalar():
+        return False
+    mlgg.info('Adding column pym.resource_tree.{}'.format(name))
+    sess.execute('ALTER TABLE pym.resource_tree ADD COLUMN {} {}'.format(
+        name, ddl))
+    return True
+
+
+def upgrade_schema(sess):
+    """
+    Adds newer columns to an existing table resource_tree.
+
+    New databases get them from ``create_all()``. If column ``path`` is
+    added, the paths are also backfilled. Afterwards, commit and call
+    :func:`create_path_index`.
+
+    Run by ``pym upgrade-schema``.
+    """
+    if add_path_column(sess):
+        backfill_paths(sess)
+    add_acl_version_column(sess)
+
+
+def add_acl_version_column(sess):
+    """
+    Adds column ``acl_version`` to an existing table resource_tree.
+
+    Existing nodes start with version 0. Run by ``pym upgrade-schema``, the
+    application only checks for the column, see :func:`check_schema`.
+
+    :return: True if column was added.
+    """
+    return _add_column(sess, 'acl_version', 'integer NOT NULL DEFAULT 0')
+
+
+def check_schema(engine):
+    """
+    Checks that table resource_tree has all columns of the mapped class.
+
+    Else each query of resource nodes would fail. Called when the web
+    application starts. The schema itself is upgraded explicitly by
+    ``pym upgrade-schema``.
+
+    Does nothing if the DB is not PostgreSQL, or if the table does not
+    exist yet.
+
+    :param engine: The DB engine.
+    :raise pym.exc.PymError: If columns are missing.
+    """
+    if engine is None or engine.dialect.name != 'postgresql':
+        return
+    tbl = ResourceNode.__table__
+    insp = sa.inspect(engine)
+    if tbl.name not in insp.get_table_names(schema=tbl.schema):
+        return
+    have = set(c['name'] for c in insp.get_columns(tbl.name,
+        schema=tbl.schema))
+    missing = [c.name for c in tbl.columns if c.name not in have]
+    if missing:
+        raise pym.exc.PymError("Table {}.{} lacks columns {}, run"
+            " 'pym upgrade-schema'".format(tbl.schema, tbl.name,
+                ', '.join(missing)))
+
+
+def add_path_column(sess):
+    """
+    Adds column ``path`` to an existing table resource_tree.
+
+    Its index is created by :func:`create_path_index`.
+
+    :return: True if column was added.
+    """
+    return _add_column(sess, 'path', 'text')
+
+
+def create_path_index(engine):
+    """
+    Creates the missing index of column ``path``.
+
+    Builds the index concurrently, so that writes are not blocked. That
+    cannot run inside a transaction, so we use a separate connection in
+    autocommit mode.
+
+    :param engine: The DB engine.
+    :return: True if index was created.
+    """
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        if pym.models.exists(conn, name='resource_tree_path_ix',
+                schema='pym'):
+            return False
+        mlgg.info('Creating index pym.resource_tree_path_ix')
+        conn.execute('CREATE INDEX CONCURRENTLY resource_tree_path_ix '
+            'ON pym.resource_tree (path text_pattern_ops)')
+        return True
+    finally:
+        conn.close()
+
+
+def backfill_paths(sess):
+    """
+    Sets the materialized path of all resource nodes.
+
+    :param sess: A DB session
+    :return: Number of updated nodes
+    """
+    q = sa.text("""
+        WITH RECURSIVE t (id, path) AS (
+            SELECT id, '/' || id || '/'
+            FROM   pym.resource_tree
+            WHERE  parent_id IS NULL
+            UNION ALL
+            SELECT c.id, t.path || c.id || '/'
+            FROM   pym.resource_tree c
+            JOIN   t ON c.parent_id = t.id
+        )
+        UPDATE pym.resource_tree r
+        SET    path = t.path
+        FROM   t
+        WHERE  r.id = t.id
+        AND    r.path IS DISTINCT FROM t.path
+    """)
+    return sess.execute(q).rowcount
+
+
 def setup(sess, rc):
     _create_views(sess, rc)
     n_root = _setup_resources(sess)
@@ -16,6 +16,7 @@ import pym.cli
 import pym.exc
 from pym.models import DbSession
 import pym.cache
+import pym.search
 import pym.res.setup
 import pym.sys.setup
 import pym.auth.setup
@@ -51,6 +52,8 @@ class Runner(pym.cli.Cli):
         with transaction.manager:
             # Create all models
             pym.models.create_all()
+            pym.search.search_backend.create_indexes(sess,
+                pym.search.searchable_columns(pym.models.DbBase.metadata))
             # Users and stuff we need to setup the modules
             pym.auth.setup.populate(sess, root_pwd=root_pwd, rc=self.rc)
             if not self.args.schema_only:
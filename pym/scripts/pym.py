@@ -18,6 +18,10 @@ The sub-commands are::
     list-rolemembers    List rolemembers
     create-rolemember      Create rolemember
     delete-rolemember   Delete rolemember with given ID
+    cache-stats         Show statistics of the cache regions
+    upgrade-schema      Add missing columns to existing tables
+    backfill-resource-paths  Fill materialized path of resource nodes
+    create-search-indexes    Create indexes of the search backend
 
 Type ``pym -h`` for general help and a list of the sub-commands,
 ``pym sub-command -h`` to get help for that sub-command.
@@ -82,6 +86,7 @@ import logging
 import os
 import sys
 import transaction
+from zope.sqlalchemy import mark_changed
 import argparse
 import yaml
 import time
@@ -91,6 +96,9 @@ import datetime
 import pym.models
 import pym.lib
 import pym.cli
+import pym.cache
+import pym.search
+import pym.res.setup
 import pym.auth.manager as authmgr
 import pym.auth.const
 
@@ -215,6 +223,48 @@ class PymCli(pym.cli.Cli):
     def delete_group_member(self):
         authmgr.delete_group_member(self.args.id)
 
+    def cache_stats(self):
+        if self.args.reset:
+            pym.cache.reset_stats(self.args.region)
+            return
+        self._print(pym.cache.get_stats(self.args.region))
+
+    def upgrade_schema(self):
+        sess = pym.models.DbSession()
+        pym.res.setup.upgrade_schema(sess)
+        mark_changed(sess)
+        self._create_path_index()
+        self.lgg.info('Upgraded schema of resource tree.')
+
+    def backfill_resource_paths(self):
+        sess = pym.models.DbSession()
+        pym.res.setup.add_path_column(sess)
+        n = pym.res.setup.backfill_paths(sess)
+        mark_changed(sess)
+        self._create_path_index()
+        self.lgg.info('Updated path of {} resource nodes.'.format(n))
+
+    def _create_path_index(self):
+        if self.args.dry_run:
+            return
+        # The index is built concurrently, which needs the column committed
+        # and runs outside a transaction.
+        transaction.commit()
+        pym.res.setup.create_path_index(pym.models.DbEngine)
+        transaction.begin()
+
+    def create_search_indexes(self):
+        sess = pym.models.DbSession()
+        backend = pym.search.search_backend
+        if backend.backend == 'none':
+            self.lgg.warning("Search backend is 'none', set rc key"
+                " 'search.backend'.")
+            return
+        created = backend.create_indexes(sess,
+            pym.search.searchable_columns(pym.models.DbBase.metadata))
+        mark_changed(sess)
+        self.lgg.info('Created {} indexes.'.format(len(created)))
+
     def _build_query(self, entity):
         sess = pym.models.DbSession()
         if isinstance(entity, list):
@@ -361,6 +411,50 @@ def parse_args(app_class, runner):
         help="Delete group-member with given ID")
     parser_delete_group_member.set_defaults(func=runner.delete_group_member)
 
+    # Parser cmd cache-stats
+    parser_cache_stats = subparsers.add_parser('cache-stats',
+        help="Show statistics of the cache regions",
+        epilog="""Counters by key prefix are aggregated over all processes
+            that use Redis. The counters of the local tier and of stale
+            serving are those of this process only."""
+    )
+    parser_cache_stats.add_argument('--region',
+        help="Show only this region, e.g. 'auth_long_term'")
+    parser_cache_stats.add_argument('--reset', action="store_true",
+        help="Reset the counters by key prefix")
+    parser_cache_stats.set_defaults(func=runner.cache_stats)
+
+    # Parser cmd upgrade-schema
+    parser_upgrade_schema = subparsers.add_parser('upgrade-schema',
+        help="Add missing columns to existing tables",
+        epilog="""Adds the materialized path and the ACL version to the
+            resource tree, fills the path and builds its index. Run this
+            when deploying, the application refuses to start while columns
+            are missing."""
+    )
+    parser_upgrade_schema.set_defaults(func=runner.upgrade_schema)
+
+    # Parser cmd backfill-resource-paths
+    parser_backfill_resource_paths = subparsers.add_parser(
+        'backfill-resource-paths',
+        help="Add and fill the materialized path of resource nodes",
+        epilog="""Refills the path of all nodes, e.g. after nodes were
+            moved by plain SQL. Otherwise the path is maintained
+            automatically."""
+    )
+    parser_backfill_resource_paths.set_defaults(
+        func=runner.backfill_resource_paths)
+
+    # Parser cmd create-search-indexes
+    parser_create_search_indexes = subparsers.add_parser(
+        'create-search-indexes',
+        help="Create indexes of the search backend",
+        epilog="""Creates the missing indexes of the backend in rc key
+            'search.backend' for all searchable columns."""
+    )
+    parser_create_search_indexes.set_defaults(
+        func=runner.create_search_indexes)
+
     return parser.parse_args()
 
 
@@ -0,0 +1,164 @@
+"""
+Optional search backend for text filters of grids and validators.
+
+Without a backend, text filters cast the column to text and match with
+``ILIKE '%a%b%'``, which scans the whole table. A backend lets PostgreSQL
+answer such filters from a GIN index:
+
+``trgm``
+    A ``pg_trgm`` index with ``gin_trgm_ops`` per searchable column. The
+    filter stays ``col ILIKE '%a%b%'``, but on the bare column, so that the
+    index is used. Matches are the same as without backend.
+
+``fts``
+    An expression index on ``to_tsvector(ts_config, coalesce(col, ''))`` per
+    searchable column, queried by ``@@ to_tsquery()``. Each word of the
+    filter text matches as a word prefix, not as an arbitrary substring.
+
+A column is searchable if its ``info`` has ``search: True``, e.g.::
+
+    principal = sa.Column(CleanUnicode(255), nullable=False,
+        info={'colanderalchemy': {'title': _("Principal")}, 'search': True})
+
+Fields of a grid's data dictionary are searchable if they have key
+``search`` set to True.
+
+The indexes are created by :meth:`SearchBackend.create_indexes`, e.g. by
+``pym create-search-indexes``.
+"""
+
+import logging
+import re
+
+import sqlalchemy as sa
+
+
+mlgg = logging.getLogger(__name__)
+
+
+BACKENDS = ('none', 'trgm', 'fts')
+
+
+def is_searchable(col):
+    """
+    Tells whether given column, or mapped attribute, is marked searchable.
+    """
+    try:
+        return bool(col.info.get('search'))
+    except AttributeError:
+        return False
+
+
+def searchable_columns(metadata):
+    """
+    Returns list of all searchable columns in given metadata.
+    """
+    cols = []
+    for tbl in metadata.sorted_tables:
+        cols.extend(c for c in tbl.columns if is_searchable(c))
+    return cols
+
+
+class SearchBackend():
+    """
+    Builds text filters and their indexes according to the configured
+    backend.
+    """
+
+    RE_WORD = re.compile(r'\w+', re.UNICODE)
+    RE_TS_CONFIG = re.compile(r'^\w+$')
+
+    def __init__(self, backend='none', ts_config='simple'):
+        self.backend = None
+        self.ts_config = None
+        self.configure(backend, ts_config)
+
+    def configure(self, backend='none', ts_config='simple'):
+        """
+        Configures the backend.
+
+        :param backend: One of :data:`BACKENDS`.
+        :param ts_config: Text search configuration of backend ``fts``, e.g.
+            'simple' or 'german'.
+        """
+        backend = (backend or 'none').lower()
+        if backend not in BACKENDS:
+            raise ValueError("Invalid search backend: '{}'".format(backend))
+        if not self.__class__.RE_TS_CONFIG.match(ts_config):
+            raise ValueError("Invalid text search config: '{}'".format(
+                ts_config))
+        self.backend = backend
+        self.ts_config = ts_config
+
+    def filter(self, col, text, searchable=True):
+        """
+        Returns filter expression that matches given text in given column.
+
+        :param col: The column, or mapped attribute.
+        :param text: The filter text. Blanks separate words that must all
+            occur. Without backend and with ``trgm`` they must occur in this
+            order, with ``fts`` in any order.
+        :param searchable: If False, uses the plain filter regardless of
+            backend.
+        :return: SQL expression.
+        """
+        text = text.strip()
+        if searchable and self.backend == 'fts':
+            words = self.__class__.RE_WORD.findall(text)
+            if words:
+                return self._tsvector(col).op('@@')(sa.func.to_tsquery(
+                    self._ts_config(), ' & '.join(w + ':*' for w in words)))
+        pattern = '%' + text.replace(' ', '%') + '%'
+        if searchable and self.backend == 'trgm':
+            return col.ilike(pattern)
+        return sa.cast(col, sa.UnicodeText).ilike(pattern)
+
+    def create_indexes(self, sess, columns):
+        """
+        Creates missing indexes of the backend for given columns.
+
+        Backend ``trgm`` also creates extension ``pg_trgm``, which needs
+        the respective privilege.
+
+        :param sess: A DB session.
+        :param columns: List of columns, e.g. by :func:`searchable_columns`.
+        :return: List of names of created indexes.
+        """
+        import pym.models
+        if self.backend == 'none':
+            return []
+        if self.backend == 'trgm':
+            sess.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        created = []
+        for col in columns:
+            tbl = col.table
+            name = '{}_{}_{}_ix'.format(tbl.name, col.name, self.backend)
+            schema = tbl.schema or 'public'
+            if pym.models.exists(sess, name=name, schema=schema):
+                continue
+            if self.backend == 'trgm':
+                expr = '"{}" gin_trgm_ops'.format(col.name)
+            else:
+                expr = """to_tsvector('{}', coalesce("{}", ''))""".format(
+                    self.ts_config, col.name)
+            mlgg.info('Creating index {}.{}'.format(schema, name))
+            sess.execute('CREATE INDEX {} ON "{}"."{}" USING gin ({})'.format(
+                name, schema, tbl.name, expr))
+            created.append(name)
+        return created
+
+    def _ts_config(self):
+        # Literals, not bind params, so that the expression is the same as
+        # that of the index
+        return sa.literal_column("'{}'".format(self.ts_config))
+
+    def _tsvector(self, col):
+        return sa.func.to_tsvector(self._ts_config(),
+            sa.func.coalesce(col, sa.literal_column("''")))
+
+
+search_backend = SearchBackend()
+"""
+Process-wide search backend, configured by :func:`pym.models.init` from rc
+keys ``search.backend`` and ``search.ts_config``.
+"""
@@ -1,5 +1,9 @@
+import concurrent.futures
+import concurrent.futures.process
 import os
 import logging
+import multiprocessing
+import threading
 
 import passlib.context
 import pyramid.security
@@ -8,6 +12,13 @@ import pyramid.i18n
 from pyramid.httpexceptions import HTTPForbidden, HTTPNotFound
 from pyramid.view import forbidden_view_config, notfound_view_config
 from pyramid.events import subscriber, NewRequest
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
+from pyramid.location import lineage
+from pyramid.security import (Allow, ACLAllowed, ACLDenied, ALL_PERMISSIONS)
+from pyramid.util import is_nonstr_iter
+import zope.interface
+import pym.exc
 import pym.i18n
 import Crypto
 
@@ -65,6 +76,473 @@ pwd_context = passlib.context.CryptContext(
 )
 
 
+def configure_pwd_context(scheme, rounds=None):
+    """
+    Sets default scheme and rounds of :data:`pwd_context`.
+
+    Existing hashes of other schemes, or with fewer rounds, still verify, but
+    are then reported by ``needs_update()``, see
+    :class:`PasswordVerifier`.
+
+    :param scheme: Name of the default scheme.
+    :param rounds: Optional. Rounds of the default scheme.
+    """
+    kw = dict(default=scheme, deprecated=['auto'])
+    if rounds:
+        kw[scheme + '__default_rounds'] = rounds
+        kw[scheme + '__min_rounds'] = rounds
+    pwd_context.update(**kw)
+
+
+def _init_verifier_process(config):
+    """
+    Loads the configuration of :data:`pwd_context` into a worker process of
+    :class:`PasswordVerifier`.
+    """
+    pwd_context.load(config)
+
+
+def _verify_password(pwd, hashed, rehash):
+    """
+    Verifies a password, runs in a worker process of
+    :class:`PasswordVerifier`.
+    """
+    if rehash:
+        return pwd_context.verify_and_update(pwd, hashed)
+    return pwd_context.verify(pwd, hashed), None
+
+
+class PasswordVerifier():
+    """
+    Verifies passwords in a bounded process pool.
+
+    Hashing with many rounds takes tens of milliseconds of CPU, which would
+    block the worker and, in threaded servers, the GIL. Verifications are
+    therefore run by a pool of ``max_workers`` processes. At most
+    ``max_pending`` verifications may be queued or running; further callers
+    wait up to ``timeout`` seconds for a slot and then fail with a
+    :class:`~pym.exc.VerifierOverloadedError`, as do verifications that time
+    out or whose worker process died.
+
+    Worker processes are spawned, not forked, on first use, so they do not
+    inherit locks, threads or connections of the server process. They load the
+    configuration of :data:`pwd_context` at that time. Call :meth:`configure`
+    and :func:`configure_pwd_context` before.
+
+    With ``max_workers`` 0, passwords are verified in the calling process.
+    """
+
+    def __init__(self, max_workers=0, max_pending=32, timeout=10, rehash=False):
+        self._executor = None
+        self._lock = threading.Lock()
+        self.max_workers = None
+        self.max_pending = None
+        self.timeout = None
+        self.rehash = None
+        self._slots = None
+        self.configure(max_workers, max_pending, timeout, rehash)
+
+    def configure(self, max_workers=0, max_pending=32, timeout=10,
+            rehash=False):
+        """
+        Configures the verifier, shuts down a running pool.
+
+        :param max_workers: Number of worker processes.
+        :param max_pending: Max number of queued or running verifications.
+        :param timeout: Seconds to wait for a free slot and for the result.
+        :param rehash: If True, :meth:`verify` also returns a new hash if the
+            password's hash does not match the current scheme and rounds.
+        """
+        self.shutdown()
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, max_workers, 1)
+        self.timeout = timeout
+        self.rehash = rehash
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def verify(self, pwd, hashed):
+        """
+        Verifies a password.
+
+        :param pwd: The password in plain text.
+        :param hashed: The stored hash.
+        :return: Tuple (valid, new_hash). ``new_hash`` is None, unless rehash
+            is enabled and the hash needs an update.
+        """
+        if not self.max_workers:
+            return _verify_password(pwd, hashed, self.rehash)
+        # Keep our semaphore, configure() may replace it meanwhile
+        slots = self._slots
+        if not slots.acquire(timeout=self.timeout):
+            mlgg.warning("Too many pending password verifications")
+            raise pym.exc.VerifierOverloadedError(
+                'Too many logins, please try again later')
+        executor = None
+        try:
+            try:
+                executor = self._get_executor()
+                fut = executor.submit(_verify_password, pwd, hashed,
+                    self.rehash)
+            except BaseException:
+                slots.release()
+                raise
+            # A running verification cannot be cancelled and keeps its worker
+            # busy after we stopped waiting. Free the slot only when it is done.
+            fut.add_done_callback(lambda f: slots.release())
+            try:
+                return fut.result(self.timeout)
+            except concurrent.futures.TimeoutError:
+                fut.cancel()
+                raise pym.exc.VerifierOverloadedError(
+                    'Too many logins, please try again later')
+        except concurrent.futures.process.BrokenProcessPool:
+            mlgg.exception("Password verification pool is broken, restarting")
+            self._discard_executor(executor)
+            raise pym.exc.VerifierOverloadedError(
+                'Too many logins, please try again later')
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _discard_executor(self, executor):
+        # Next call starts a new pool, unless another thread already did
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_verifier_process,
+                    initargs=(pwd_context.to_string(),))
+            return self._executor
+
+
+password_verifier = PasswordVerifier()
+"""
+Process-wide verifier, configured by :func:`pym.init_auth`.
+"""
+
+
+# ====================================================
+#   Authorization
+# ====================================================
+
+
+class PermissionBits():
+    """
+    Assigns each permission name its own bit.
+
+    Bits are assigned on first use and stay fixed for the life time of the
+    process. :data:`pyramid.security.ALL_PERMISSIONS` has all bits set.
+    """
+
+    ALL = -1
+
+    def __init__(self):
+        self._bits = {}
+        self._lock = threading.Lock()
+
+    def bit(self, permission):
+        """
+        Returns bit of given permission name.
+        """
+        b = self._bits.get(permission)
+        if b is None:
+            with self._lock:
+                b = self._bits.setdefault(permission, 1 << len(self._bits))
+        return b
+
+    def mask(self, permissions):
+        """
+        Returns mask of given permission(s) of an ACE.
+
+        :param permissions: A permission name, a list of them, or
+            ``ALL_PERMISSIONS``.
+        """
+        if permissions is ALL_PERMISSIONS:
+            return self.ALL
+        if not is_nonstr_iter(permissions):
+            return self.bit(permissions)
+        m = 0
+        for p in permissions:
+            # Pyramid does not match ALL_PERMISSIONS inside a list
+            if p is not ALL_PERMISSIONS:
+                m |= self.bit(p)
+        return m
+
+
+permission_bits = PermissionBits()
+"""
+Process-wide permission bits, used by :class:`AclMasks` and
+:class:`BitmaskAuthorizationPolicy`.
+"""
+
+
+class AclMasks():
+    """
+    Allow and deny masks per principal of an ACL.
+
+    Masks decide exactly as Pyramid's linear ACL scan, if all deny ACEs
+    precede all allow ACEs. This is the order in which
+    :class:`pym.res.models.ResourceNode` builds its ACL. Use
+    :meth:`from_acl` which returns None for ACLs in other order.
+    """
+
+    __slots__ = ('acl', 'allow', 'deny')
+
+    def __init__(self, acl):
+        self.acl = acl
+        self.allow = {}
+        self.deny = {}
+
+    @classmethod
+    def from_acl(cls, acl, bits=None):
+        """
+        Builds masks of given ACL.
+
+        :param acl: The ACL, a list of ACEs.
+        :param bits: Instance of :class:`PermissionBits`, defaults to
+            :data:`permission_bits`.
+        :return: Instance of :class:`AclMasks`, or None if an allow ACE
+            precedes a deny ACE.
+        """
+        if bits is None:
+            bits = permission_bits
+        masks = cls(acl)
+        allowing = False
+        for action, principal, permissions in acl:
+            if action == Allow:
+                allowing = True
+                mm = masks.allow
+            else:
+                if allowing:
+                    return None
+                mm = masks.deny
+            mm[principal] = mm.get(principal, 0) | bits.mask(permissions)
+        return masks
+
+    def decide(self, principals, bit):
+        """
+        Returns True if allowed, False if denied, None if no ACE matches.
+        """
+        deny = self.deny
+        if deny:
+            for p in principals:
+                if deny.get(p, 0) & bit:
+                    return False
+        allow = self.allow
+        for p in principals:
+            if allow.get(p, 0) & bit:
+                return True
+        return None
+
+
+@zope.interface.implementer(IAuthorizationPolicy)
+class BitmaskAuthorizationPolicy():
+    """
+    Authorization policy which decides by permission bits.
+
+    Drop-in replacement of Pyramid's
+    :class:`~pyramid.authorization.ACLAuthorizationPolicy`: it walks the
+    lineage of the context in the same way, and the first location whose ACL
+    names one of the principals with the permission decides.
+
+    Instead of scanning the ACEs of each location, it tests the permission's
+    bit against precomputed masks per principal. A location may provide
+    them by method ``__acl_masks__()``, which returns an instance of
+    :class:`AclMasks` or None, and should cache them. Otherwise masks are
+    built from ``__acl__``. Locations whose ACLs are not in deny-first order
+    are scanned linearly.
+    """
+
+    def __init__(self, bits=None):
+        self.bits = bits if bits is not None else permission_bits
+        self._acl_policy = ACLAuthorizationPolicy()
+
+    def permits(self, context, principals, permission):
+        bit = self.bits.bit(permission)
+        acl = '<No ACL found on any object in resource lineage>'
+        for location in lineage(context):
+            get_masks = getattr(location, '__acl_masks__', None)
+            if get_masks is not None and self.bits is permission_bits:
+                masks = get_masks()
+            else:
+                try:
+                    acl = location.__acl__
+                except AttributeError:
+                    continue
+                if acl and callable(acl):
+                    acl = acl()
+                masks = AclMasks.from_acl(acl, self.bits)
+            if masks is None:
+                r = self._scan(location, principals, permission)
+                if r is not None:
+                    return r
+                continue
+            acl = masks.acl
+            decision = masks.decide(principals, bit)
+            if decision is None:
+                continue
+            if decision:
+                return ACLAllowed('<bitmask>', acl, permission, principals,
+                    location)
+            return ACLDenied('<bitmask>', acl, permission, principals,
+                location)
+        return ACLDenied('<default deny>', acl, permission, principals,
+            context)
+
+    # noinspection PyMethodMayBeStatic
+    def _scan(self, location, principals, permission):
+        acl = location.__acl__
+        if acl and callable(acl):
+            acl = acl()
+        for ace in acl:
+            ace_action, ace_principal, ace_permissions = ace
+            if ace_principal in principals:
+                if not is_nonstr_iter(ace_permissions):
+                    ace_permissions = [ace_permissions]
+                if permission in ace_permissions:
+                    if ace_action == Allow:
+                        return ACLAllowed(ace, acl, permission, principals,
+                            location)
+                    return ACLDenied(ace, acl, permission, principals,
+                        location)
+        return None
+
+    def principals_allowed_by_permission(self, context, permission):
+        return self._acl_policy.principals_allowed_by_permission(context,
+            permission)
+
+
+def has_permissions(request, nodes, permission):
+    """
+    Tells for each node whether the current user has given permission.
+
+    Evaluates many nodes in one pass and decides as
+    ``request.has_permission()`` does for each node with an ACL based
+    policy. The principals are determined once, and the lineages of all
+    nodes are walked together, so that a shared ancestor is evaluated only
+    once. Masks are fetched per class of the locations: if a class provides
+    a class method ``acl_masks_of(locations)``, it is called once with all
+    its locations, which allows to batch the DB and cache accesses, see
+    :meth:`pym.res.models.ResourceNode.acl_masks_of`.
+
+    With a custom authorization policy, this falls back to calling its
+    ``permits()`` for each node.
+
+    :param request: Current request.
+    :param nodes: List of resources.
+    :param permission: Name of the permission.
+    :return: List of booleans in the order of ``nodes``.
+    """
+    reg = request.registry
+    authn_policy = reg.queryUtility(IAuthenticationPolicy)
+    if authn_policy is None:
+        return [True] * len(nodes)
+    authz_policy = reg.queryUtility(IAuthorizationPolicy)
+    if authz_policy is None:
+        raise ValueError('Authentication policy registered without '
+                         'authorization policy')
+    principals = authn_policy.effective_principals(request)
+    if not isinstance(authz_policy,
+            (ACLAuthorizationPolicy, BitmaskAuthorizationPolicy)):
+        return [bool(authz_policy.permits(n, principals, permission))
+            for n in nodes]
+
+    # Collect the locations of all lineages, each once
+    locations = {}
+    for n in nodes:
+        for loc in lineage(n):
+            if id(loc) in locations:
+                break
+            locations[id(loc)] = loc
+    masks = _masks_of(list(locations.values()))
+
+    bit = permission_bits.bit(permission)
+    decisions = {}
+    result = []
+    for n in nodes:
+        path = []
+        decision = False
+        for loc in lineage(n):
+            k = id(loc)
+            if k in decisions:
+                decision = decisions[k]
+                break
+            path.append(k)
+            mm = masks[k]
+            if mm is _NO_ACL:
+                continue
+            if mm is None:
+                d = _scan_decision(loc, principals, permission)
+            else:
+                d = mm.decide(principals, bit)
+            if d is not None:
+                decision = d
+                break
+        for k in path:
+            decisions[k] = decision
+        result.append(decision)
+    return result
+
+
+_NO_ACL = object()
+
+
+def _masks_of(locations):
+    """
+    Returns masks of given locations by their ``id()``.
+
+    Value is an instance of :class:`AclMasks`, None if the ACL must be
+    scanned, or ``_NO_ACL``.
+    """
+    by_class = {}
+    for loc in locations:
+        by_class.setdefault(loc.__class__, []).append(loc)
+    masks = {}
+    for cls, locs in by_class.items():
+        acl_masks_of = getattr(cls, 'acl_masks_of', None)
+        if acl_masks_of is not None:
+            for loc, mm in zip(locs, acl_masks_of(locs)):
+                masks[id(loc)] = mm
+            continue
+        for loc in locs:
+            get_masks = getattr(loc, '__acl_masks__', None)
+            if get_masks is not None:
+                masks[id(loc)] = get_masks()
+                continue
+            try:
+                acl = loc.__acl__
+            except AttributeError:
+                masks[id(loc)] = _NO_ACL
+                continue
+            if acl and callable(acl):
+                acl = acl()
+            masks[id(loc)] = AclMasks.from_acl(acl)
+    return masks
+
+
+def _scan_decision(location, principals, permission):
+    acl = location.__acl__
+    if acl and callable(acl):
+        acl = acl()
+    for ace_action, ace_principal, ace_permissions in acl:
+        if ace_principal in principals:
+            if not is_nonstr_iter(ace_permissions):
+                ace_permissions = [ace_permissions]
+            if permission in ace_permissions:
+                return ace_action == Allow
+    return None
+
+
 # ====================================================
 #   Views
 # ====================================================
@@ -4,6 +4,8 @@ from pyramid.view import view_config
 import logging
 
 import pym.res.models
+import pym.sys.models
+import pym.cache
 
 L = logging.getLogger('Pym')
 
@@ -18,3 +20,16 @@ def index(context, request):
     return dict()
 
 
+@view_config(
+    name='stats',
+    context=pym.sys.models.ISysCacheMgmtNode,
+    renderer='json',
+    permission='admin'
+)
+def cache_stats(context, request):
+    """
+    Returns statistics of the cache regions.
+
+    Use ``?region=NAME`` for a single region.
+    """
+    return pym.cache.get_stats(request.GET.get('region'))
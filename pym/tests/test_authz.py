@@ -0,0 +1,270 @@
+import random
+import unittest
+
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
+from pyramid.security import (Allow, Deny, Everyone, Authenticated,
+    ALL_PERMISSIONS)
+import transaction
+
+import pym.testing
+import pym.models
+from pym.auth.const import UNIT_TESTER_UID
+from pym.res.models import ResourceNode
+from pym.security import (AclMasks, BitmaskAuthorizationPolicy,
+    PermissionBits, has_permissions)
+
+
+PRINCIPALS = [Everyone, Authenticated, 'u:1', 'u:2', 'g:1', 'g:2', 'g:3']
+PERMISSIONS = ['view', 'visit', 'edit', 'create', 'delete', 'admin']
+
+
+class Node():
+
+    def __init__(self, name, parent, acl):
+        self.__name__ = name
+        self.__parent__ = parent
+        self.__acl__ = acl
+
+
+class CallableAclNode(Node):
+
+    def __init__(self, name, parent, acl):
+        super().__init__(name, parent, None)
+        self._acl = acl
+        self.__acl__ = lambda: self._acl
+
+
+class MaskedNode(Node):
+
+    def __init__(self, name, parent, acl):
+        super().__init__(name, parent, acl)
+        self.masks_built = 0
+        self._masks = None
+
+    def __acl_masks__(self):
+        if self._masks is None:
+            self.masks_built += 1
+            self._masks = AclMasks.from_acl(self.__acl__)
+        return self._masks
+
+
+def random_ace(rnd, action):
+    r = rnd.random()
+    if r < 0.1:
+        perms = ALL_PERMISSIONS
+    elif r < 0.3:
+        perms = rnd.sample(PERMISSIONS, rnd.randint(1, 3))
+    else:
+        perms = rnd.choice(PERMISSIONS)
+    return action, rnd.choice(PRINCIPALS), perms
+
+
+def random_acl(rnd, deny_first=True):
+    denies = [random_ace(rnd, Deny) for _ in range(rnd.randint(0, 2))]
+    allows = [random_ace(rnd, Allow) for _ in range(rnd.randint(0, 4))]
+    acl = denies + allows
+    if not deny_first:
+        rnd.shuffle(acl)
+    return acl
+
+
+def random_lineage(rnd, depth, deny_first=True):
+    node = None
+    for i in range(depth):
+        cls = rnd.choice([Node, CallableAclNode, MaskedNode])
+        if rnd.random() < 0.2:
+            node = Node('n{}'.format(i), node, None)
+            del node.__acl__
+        else:
+            node = cls('n{}'.format(i), node, random_acl(rnd, deny_first))
+    return node
+
+
+class AuthnPolicy():
+
+    def __init__(self, principals):
+        self.principals = principals
+
+    def effective_principals(self, request):
+        return self.principals
+
+
+class Registry():
+
+    def __init__(self, **utilities):
+        self.utilities = utilities
+
+    def queryUtility(self, iface):
+        return self.utilities.get(iface.__name__)
+
+
+class Request():
+
+    def __init__(self, principals, authz_policy):
+        self.registry = Registry(
+            IAuthenticationPolicy=AuthnPolicy(principals),
+            IAuthorizationPolicy=authz_policy
+        )
+
+
+def random_tree(rnd, size):
+    nodes = [MaskedNode('root', None, random_acl(rnd))]
+    for i in range(size):
+        parent = rnd.choice(nodes)
+        cls = rnd.choice([Node, CallableAclNode, MaskedNode])
+        nodes.append(cls('n{}'.format(i), parent, random_acl(rnd)))
+    return nodes
+
+
+class TestBitmaskAuthorizationPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.acl_pol = ACLAuthorizationPolicy()
+        self.bm_pol = BitmaskAuthorizationPolicy()
+
+    def assert_equivalent(self, context, seed):
+        rnd = random.Random(seed)
+        for _ in range(20):
+            principals = rnd.sample(PRINCIPALS, rnd.randint(1, 4))
+            for perm in PERMISSIONS + ['unknown']:
+                expected = self.acl_pol.permits(context, principals, perm)
+                actual = self.bm_pol.permits(context, principals, perm)
+                self.assertEqual(bool(expected), bool(actual),
+                    "seed {}, principals {}, permission {}: {} != {}".format(
+                        seed, principals, perm, expected, actual))
+
+    def test_deny_first_lineages(self):
+        for seed in range(300):
+            rnd = random.Random(seed)
+            ctx = random_lineage(rnd, rnd.randint(1, 6))
+            self.assert_equivalent(ctx, seed)
+
+    def test_unordered_lineages(self):
+        for seed in range(300):
+            rnd = random.Random(seed)
+            ctx = random_lineage(rnd, rnd.randint(1, 6), deny_first=False)
+            self.assert_equivalent(ctx, seed)
+
+    def test_no_acl(self):
+        ctx = Node('n', None, None)
+        del ctx.__acl__
+        self.assertFalse(self.bm_pol.permits(ctx, [Everyone], 'view'))
+
+    def test_all_permissions(self):
+        ctx = Node('n', None, [(Allow, 'g:1', ALL_PERMISSIONS)])
+        self.assertTrue(self.bm_pol.permits(ctx, ['g:1'], 'anything'))
+        self.assertFalse(self.bm_pol.permits(ctx, ['g:2'], 'anything'))
+        # Pyramid does not match ALL_PERMISSIONS inside a list
+        ctx = Node('n', None, [(Allow, 'g:1', [ALL_PERMISSIONS])])
+        self.assertFalse(self.bm_pol.permits(ctx, ['g:1'], 'view'))
+
+    def test_deny_on_child_overrides_allow_on_parent(self):
+        root = Node('root', None, [(Allow, 'g:1', 'view')])
+        child = Node('child', root, [(Deny, 'u:1', 'view')])
+        self.assertFalse(self.bm_pol.permits(child, ['u:1', 'g:1'], 'view'))
+        self.assertTrue(self.bm_pol.permits(child, ['u:2', 'g:1'], 'view'))
+
+    def test_masks_of_masked_nodes_are_reused(self):
+        root = MaskedNode('root', None, [(Allow, 'g:1', 'view')])
+        child = MaskedNode('child', root, [(Deny, 'u:1', 'edit')])
+        for _ in range(3):
+            self.assertTrue(self.bm_pol.permits(child, ['g:1'], 'view'))
+        self.assertEqual(root.masks_built, 1)
+        self.assertEqual(child.masks_built, 1)
+
+    def test_from_acl_rejects_allow_before_deny(self):
+        acl = [(Allow, 'g:1', 'view'), (Deny, 'g:2', 'view')]
+        self.assertIsNone(AclMasks.from_acl(acl))
+        acl.reverse()
+        self.assertIsNotNone(AclMasks.from_acl(acl))
+
+    def test_permission_bits(self):
+        bits = PermissionBits()
+        self.assertEqual(bits.bit('a'), 1)
+        self.assertEqual(bits.bit('b'), 2)
+        self.assertEqual(bits.bit('a'), 1)
+        self.assertEqual(bits.mask(['a', 'b']), 3)
+        self.assertEqual(bits.mask(ALL_PERMISSIONS), PermissionBits.ALL)
+
+    def test_principals_allowed_by_permission(self):
+        root = Node('root', None, [(Allow, 'g:1', 'view'),
+            (Allow, 'g:2', 'edit')])
+        self.assertEqual(
+            self.bm_pol.principals_allowed_by_permission(root, 'view'),
+            self.acl_pol.principals_allowed_by_permission(root, 'view'))
+
+
+class TestHasPermissions(unittest.TestCase):
+
+    def test_equivalent_to_single_checks(self):
+        acl_pol = ACLAuthorizationPolicy()
+        for authz_pol in (acl_pol, BitmaskAuthorizationPolicy()):
+            for seed in range(100):
+                rnd = random.Random(seed)
+                nodes = random_tree(rnd, 30)
+                principals = rnd.sample(PRINCIPALS, rnd.randint(1, 4))
+                request = Request(principals, authz_pol)
+                for perm in PERMISSIONS:
+                    expected = [bool(acl_pol.permits(n, principals, perm))
+                        for n in nodes]
+                    self.assertEqual(
+                        has_permissions(request, nodes, perm), expected,
+                        "seed {}, permission {}".format(seed, perm))
+
+    def test_masks_of_shared_ancestors_are_built_once(self):
+        root = MaskedNode('root', None, [(Allow, 'g:1', 'visit')])
+        nodes = [MaskedNode('n{}'.format(i), root, []) for i in range(10)]
+        request = Request(['g:1'], BitmaskAuthorizationPolicy())
+        self.assertEqual(has_permissions(request, nodes, 'visit'),
+            [True] * 10)
+        self.assertEqual(root.masks_built, 1)
+
+    def test_without_authentication_policy(self):
+        request = Request([], BitmaskAuthorizationPolicy())
+        request.registry = Registry()
+        nodes = [Node('n', None, [])]
+        self.assertEqual(has_permissions(request, nodes, 'visit'), [True])
+
+
+class TestResourceNodeAcl(unittest.TestCase):
+    """
+    Needs the testing DB, see :mod:`pym.testing`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        pym.testing.init_app(pym.testing.TestingArgs, setup_logging=True)
+
+    def setUp(self):
+        self.sess = pym.models.DbSession()
+        self.root = ResourceNode.create_root(self.sess, UNIT_TESTER_UID,
+            name='unittest-authz', kind='res')
+        self.sess.flush()
+        self.acl_pol = ACLAuthorizationPolicy()
+        self.bm_pol = BitmaskAuthorizationPolicy()
+        self.principal = 'u:{}'.format(UNIT_TESTER_UID)
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_deny_before_allow_on_same_principal(self):
+        n = self.root
+        # Allow is set first, relationship ``acl`` must still load deny first
+        n.allow(self.sess, UNIT_TESTER_UID, 'read', user=UNIT_TESTER_UID)
+        n.deny(self.sess, UNIT_TESTER_UID, 'read', user=UNIT_TESTER_UID)
+        self.sess.flush()
+        self.sess.expire(n, ['acl'])
+        self.assertEqual([ace.allow for ace in n.acl], [False, True])
+        acl = n.__acl__()
+        self.assertEqual(acl[0], (Deny, self.principal, 'read'))
+        self.assertIn((Allow, self.principal, 'read'), acl)
+        self.assertIsNotNone(n.__acl_masks__())
+        principals = [Everyone, Authenticated, self.principal]
+        for perm in ('read', 'visit', 'write'):
+            expected = self.acl_pol.permits(n, principals, perm)
+            actual = self.bm_pol.permits(n, principals, perm)
+            self.assertEqual(bool(expected), bool(actual), perm)
+        self.assertFalse(self.bm_pol.permits(n, principals, 'read'))
+        # Allowed as parent of 'read'
+        self.assertTrue(self.bm_pol.permits(n, principals, 'visit'))
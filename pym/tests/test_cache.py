@@ -0,0 +1,334 @@
+import pickle
+import threading
+import unittest
+
+import sqlalchemy as sa
+import sqlalchemy.orm
+from sqlalchemy.ext.declarative import declarative_base
+import transaction
+# noinspection PyPackageRequirements
+from dogpile.cache import make_region
+# noinspection PyPackageRequirements
+from dogpile.cache.api import NO_VALUE
+
+import pym.cache
+from pym.cache import CompactRows, FromCache, RelationshipCache
+
+
+DbBase = declarative_base()
+
+
+class Parent(DbBase):
+    __tablename__ = 'parent'
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    name = sa.Column(sa.Unicode(255), nullable=False)
+    kind = sa.Column(sa.Unicode(255), nullable=False)
+    children = sa.orm.relationship('Child', order_by='Child.id')
+
+
+class Child(DbBase):
+    __tablename__ = 'child'
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    parent_id = sa.Column(sa.Integer(), sa.ForeignKey('parent.id'),
+        nullable=False)
+    name = sa.Column(sa.Unicode(255), nullable=False)
+
+
+def setup_db(regions):
+    engine = sa.create_engine('sqlite://')
+    DbBase.metadata.create_all(engine)
+    Session = sa.orm.sessionmaker(bind=engine,
+        query_cls=pym.cache.query_callable(regions))
+    sess = Session()
+    for i in range(1, 4):
+        sess.add(Parent(id=i, name='p{}'.format(i), kind='k'))
+        sess.add_all([Child(id=i * 10 + j, parent_id=i,
+            name='c{}'.format(j)) for j in range(2)])
+    sess.commit()
+    sess.close()
+    return engine, Session
+
+
+class TestCompactRows(unittest.TestCase):
+
+    def setUp(self):
+        self.region = make_region().configure('dogpile.cache.memory')
+        self.engine, self.Session = setup_db({'default': self.region})
+        self.statements = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+            self.count_statement)
+
+    # noinspection PyUnusedLocal
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def query(self, sess):
+        return sess.query(Parent).options(
+            FromCache('default', shape='parents', compact=True),
+            RelationshipCache(Parent.children, 'default', compact=True)
+        ).order_by(Parent.id)
+
+    def test_round_trip(self):
+        sess = self.Session()
+        pp = sess.query(Parent).order_by(Parent.id).all()
+        cr = pickle.loads(pickle.dumps(CompactRows.encode(pp)))
+        self.assertIsInstance(cr, CompactRows)
+        # Column with equal values is stored once
+        self.assertEqual(cr.constants, {'kind': 'k'})
+        decoded = cr.decode()
+        self.assertEqual([(p.id, p.name, p.kind) for p in decoded],
+            [(p.id, p.name, p.kind) for p in pp])
+        self.assertEqual([sa.inspect(p).key for p in decoded],
+            [sa.inspect(p).key for p in pp])
+        sess.close()
+
+    def test_mixed_lists_are_not_encoded(self):
+        sess = self.Session()
+        value = [sess.query(Parent).first(), sess.query(Child).first()]
+        self.assertIs(CompactRows.encode(value), value)
+        self.assertEqual(CompactRows.encode([]), [])
+        sess.close()
+
+    def test_lazy_load_after_hit_uses_relationship_cache(self):
+        sess = self.Session()
+        expected = [[c.name for c in p.children] for p in self.query(sess)]
+        sess.close()
+        del self.statements[:]
+
+        sess = self.Session()
+        pp = self.query(sess).all()
+        self.assertEqual([[c.name for c in p.children] for p in pp],
+            expected)
+        self.assertEqual(self.statements, [])
+        sess.close()
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+
+    def setUp(self):
+        self.region = make_region()
+        pym.cache.configure_region(self.region, {
+            'backend': 'dogpile.cache.memory',
+            'expiration_time': 60,
+            'stale.grace': 600,
+            'stats.enabled': False
+        })
+        self.revalidator = pym.cache.get_revalidator(self.region)
+
+    def expire(self, key):
+        backend = pym.cache._actual_backend(self.region.backend)
+        backend.get(key).metadata['ct'] -= 120
+
+    def test_stale_served_to_all_while_one_revalidates(self):
+        self.region.set('k', 'old')
+        self.expire('k')
+        release = threading.Event()
+        done = threading.Event()
+
+        def creator():
+            release.wait(5)
+            done.set()
+            return 'new'
+
+        for _ in range(3):
+            self.assertEqual(self.region.get_or_create('k', creator), 'old')
+        release.set()
+        self.assertTrue(done.wait(5))
+        for t in threading.enumerate():
+            if t.name == 'pym-cache-revalidate':
+                t.join(5)
+        self.assertEqual(self.region.get_or_create('k', creator), 'new')
+        self.assertEqual(self.revalidator.stats, {
+            'stale_served': 3,
+            'revalidations': 1,
+            'revalidation_errors': 0
+        })
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.region = make_region(name='test')
+        pym.cache.configure_region(self.region, {
+            'backend': 'dogpile.cache.memory',
+            'stats.enabled': True
+        })
+        self.proxy = pym.cache.get_stats_proxy(self.region)
+        self.engine, self.Session = setup_db({'default': self.region})
+
+    def test_key_prefix(self):
+        key_prefix = pym.cache.key_prefix
+        self.assertEqual(key_prefix('auth:user:alice'), 'auth:user')
+        self.assertEqual(key_prefix('resource:5:None'), 'resource')
+        self.assertEqual(key_prefix('q:Parent:abc:def'), 'q:Parent')
+        self.assertEqual(key_prefix('q:-:abc:def'), 'q')
+        self.assertEqual(key_prefix('SELECT x FROM y'), '*')
+
+    def test_query_keys_are_counted_by_entity(self):
+        sess = self.Session()
+        for i in range(1, 4):
+            sess.query(Parent).options(FromCache('default', shape='by_id')) \
+                .filter(Parent.id == i).all()
+            sess.query(Parent).options(FromCache('default')) \
+                .filter(Parent.id == i).all()
+        sess.close()
+        stats = self.proxy.stats()
+        self.assertEqual(list(stats), ['q:Parent'])
+        self.assertEqual(stats['q:Parent']['hits'], 0)
+        self.assertEqual(stats['q:Parent']['sets'], 6)
+
+    def test_set_sizes_are_sampled(self):
+        rate = self.proxy.SET_SAMPLE_RATE
+        for i in range(2 * rate + 1):
+            self.region.set('k:{}'.format(i), 'x' * 100)
+        cc = self.proxy.stats()['k']
+        self.assertEqual(cc['sets'], 2 * rate + 1)
+        self.assertEqual(cc['set_samples'], 3)
+        self.assertGreater(cc['avg_set_bytes'], 100)
+
+
+class TestLocalLruProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.region = make_region()
+        pym.cache.configure_region(self.region, {
+            'backend': 'dogpile.cache.memory',
+            'local.max_size': 3,
+            'local.ttl': 60,
+            'stats.enabled': False
+        })
+        self.tier = pym.cache.get_local_tier(self.region)
+        self.remote = self.tier.proxied
+        self.remote_calls = []
+        get_multi = self.remote.get_multi
+
+        def counting_get_multi(keys):
+            self.remote_calls.append(list(keys))
+            return get_multi(keys)
+        self.remote.get_multi = counting_get_multi
+
+    def test_get_multi_fetches_misses_at_once(self):
+        self.region.set_multi({'a': 1, 'b': 2, 'c': 3})
+        # As if another worker had set it
+        self.tier._delete_local('c')
+        self.assertEqual(self.region.get_multi(['a', 'c', 'x', 'b']),
+            [1, 3, NO_VALUE, 2])
+        self.assertEqual(self.remote_calls, [['c', 'x']])
+        self.assertEqual(self.tier.stats, {
+            'local_hits': 2,
+            'local_misses': 2,
+            'remote_hits': 1,
+            'remote_misses': 1
+        })
+        # Now served locally
+        self.assertEqual(self.region.get('c'), 3)
+        self.assertEqual(self.tier.stats['local_hits'], 3)
+
+    def test_lru_is_bounded(self):
+        for k in 'abcd':
+            self.region.set(k, k)
+        self.assertEqual(list(self.tier._data), ['b', 'c', 'd'])
+
+
+class TestTags(unittest.TestCase):
+
+    def setUp(self):
+        self.region = pym.cache.region_default
+        if not self.region.is_configured:
+            self.region.configure('dogpile.cache.memory')
+        self.region.invalidate()
+        self.engine, self.Session = setup_db({'default': self.region})
+        self.statements = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+            self.count_statement)
+
+    # noinspection PyUnusedLocal
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_only_tagged_keys_are_deleted(self):
+        for k in ('a', 'b', 'c'):
+            self.region.set(k, k)
+        pym.cache.tag_key('default', 'a', 'user:1')
+        pym.cache.tag_key('default', 'b', 'user:1', 'group:2')
+        pym.cache.tag_key('default', 'c', 'group:3')
+        pym.cache.invalidate_tags('user:1')
+        self.assertEqual([self.region.get(k) for k in ('a', 'b', 'c')],
+            [NO_VALUE, NO_VALUE, 'c'])
+        # Tag was consumed
+        self.region.set('a', 'a')
+        pym.cache.invalidate_tags('user:1')
+        self.assertEqual(self.region.get('a'), 'a')
+
+    def test_query_tags(self):
+        def load(sess):
+            return sess.query(Parent).options(FromCache('default',
+                shape='tagged', tags=lambda pp: ['parent:{}'.format(p.id)
+                    for p in pp])).filter(Parent.id == 1).all()
+        sess = self.Session()
+        load(sess)
+        load(sess)
+        self.assertEqual(len(self.statements), 1)
+        pym.cache.invalidate_tags('parent:2')
+        load(sess)
+        self.assertEqual(len(self.statements), 1)
+        pym.cache.invalidate_tags('parent:1')
+        load(sess)
+        self.assertEqual(len(self.statements), 2)
+        sess.close()
+
+    def test_invalidate_on_commit(self):
+        self.region.set('a', 'a')
+        pym.cache.tag_key('default', 'a', 'user:1')
+        transaction.begin()
+        pym.cache.invalidate_tags_on_commit('user:1')
+        self.assertEqual(self.region.get('a'), 'a')
+        transaction.abort()
+        self.assertEqual(self.region.get('a'), 'a')
+        transaction.begin()
+        pym.cache.invalidate_tags_on_commit('user:1')
+        transaction.commit()
+        self.assertIs(self.region.get('a'), NO_VALUE)
+
+
+class TestShapeKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.engine, self.Session = setup_db({})
+        self.sess = self.Session()
+
+    def tearDown(self):
+        self.sess.close()
+
+    def key(self, qry, shape='s'):
+        # noinspection PyProtectedMember
+        return pym.cache._shape_key_from_query(qry, shape)
+
+    def test_keys_differ_by_params_only(self):
+        q = self.sess.query(Parent)
+        k1 = self.key(q.filter(Parent.id == 1))
+        self.assertEqual(k1, self.key(q.filter(Parent.id == 1)))
+        self.assertNotEqual(k1, self.key(q.filter(Parent.id == 2)))
+        self.assertNotEqual(k1, self.key(q.filter(Parent.id == 1).limit(5)))
+        # Same fingerprint
+        self.assertEqual(k1.rsplit(':', 1)[0],
+            self.key(q.filter(Parent.id == 2)).rsplit(':', 1)[0])
+
+    def test_misused_shape_gets_own_fingerprint(self):
+        q = self.sess.query(Parent)
+        k1 = self.key(q.filter(Parent.id == 1))
+        k2 = self.key(q.filter(Parent.name == 1))
+        self.assertNotEqual(k1.rsplit(':', 1)[0], k2.rsplit(':', 1)[0])
+
+    def test_same_key_as_compiled_query(self):
+        # Each shape key stands for exactly one statement and its params
+        q = self.sess.query(Parent)
+        keys = {}
+        for i in (1, 2, 1, 3, 2):
+            qq = q.filter(Parent.id == i)
+            keys.setdefault(self.key(qq), set()).add(
+                pym.cache._key_from_query(qq))
+        self.assertEqual(len(keys), 3)
+        self.assertTrue(all(len(v) == 1 for v in keys.values()))
@@ -0,0 +1,185 @@
+import datetime
+import json
+import unittest
+
+import sqlalchemy as sa
+import sqlalchemy.orm
+from sqlalchemy.ext.declarative import declarative_base
+
+import pym.cache
+from pym.tk.grid import Grid, GridError, RowCounter
+
+
+DbBase = declarative_base()
+
+
+class Item(DbBase):
+    __tablename__ = 'item'
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    name = sa.Column(sa.Unicode(255), nullable=False)
+
+
+ROWS = 95
+PAGE_SIZE = 20
+FIELDS = ['id', 'name']
+
+
+def setup_db():
+    engine = sa.create_engine('sqlite://')
+    DbBase.metadata.create_all(engine)
+    sess = sa.orm.Session(bind=engine)
+    # Few distinct names, so that the ID must break ties
+    sess.add_all([Item(id=i, name='n{:02d}'.format(i * 7 % 10))
+        for i in range(1, ROWS + 1)])
+    sess.commit()
+    return sess
+
+
+class TestKeysetPagination(unittest.TestCase):
+
+    def setUp(self):
+        self.sess = setup_db()
+
+    def tearDown(self):
+        self.sess.close()
+
+    def grid(self, order_dir):
+        gr = Grid('grid')
+        gr.limit = PAGE_SIZE
+        gr.order_field = 'name'
+        gr.order_dir = order_dir
+        gr.keyset_id_field = 'id'
+        return gr
+
+    def fetch(self, gr):
+        qry = self.sess.query(Item.id, Item.name)
+        qry = gr.apply_limit(gr.apply_order(qry))
+        rows = [dict(zip(FIELDS, r)) for r in qry]
+        return gr.get_data_response(rows, FIELDS, 'id')
+
+    def test_pages_by_keyset_equal_sorted_rows(self):
+        for order_dir in ('asc', 'desc'):
+            gr = self.grid(order_dir)
+            ids = []
+            for page in range(1, 6):
+                gr.page = page
+                self.assertEqual(gr.use_keyset, page > 1)
+                resp = self.fetch(gr)
+                ids.extend(r['id'] for r in resp['rows'])
+                # Client sends back the keyset as JSON
+                gr.keyset = json.loads(json.dumps(resp['keyset']))
+            order = sa.desc if order_dir == 'desc' else sa.asc
+            expected = [r[0] for r in self.sess.query(Item.id).order_by(
+                order(Item.name), order(Item.id))]
+            self.assertEqual(ids, expected)
+
+    def test_jump_uses_offset(self):
+        gr = self.grid('asc')
+        gr.page = 1
+        gr.keyset = self.fetch(gr)['keyset']
+        gr.page = 3
+        self.assertFalse(gr.use_keyset)
+        ids = [r['id'] for r in self.fetch(gr)['rows']]
+        expected = [r[0] for r in self.sess.query(Item.id).order_by(
+            Item.name, Item.id).offset(2 * PAGE_SIZE).limit(PAGE_SIZE)]
+        self.assertEqual(ids, expected)
+
+    def test_qualified_sort_fields(self):
+        gr = self.grid('asc')
+        gr.order_field = 'item.name'
+        gr.keyset_id_field = 'item.id'
+        ids = []
+        for page in range(1, 4):
+            gr.page = page
+            self.assertEqual(gr.use_keyset, page > 1)
+            resp = self.fetch(gr)
+            ids.extend(r['id'] for r in resp['rows'])
+            gr.keyset = resp['keyset']
+        expected = [r[0] for r in self.sess.query(Item.id).order_by(
+            Item.name, Item.id).limit(3 * PAGE_SIZE)]
+        self.assertEqual(ids, expected)
+
+
+class TestStreamDataResponse(unittest.TestCase):
+
+    def test_same_as_data_response(self):
+        gr = Grid('grid')
+        gr.limit = PAGE_SIZE
+        rows = [
+            {'id': 1, 'name': 'a "quoted" name', 'flag': True,
+                'ctime': datetime.datetime(2014, 12, 24, 18, 0)},
+            {'id': 2, 'name': None, 'flag': False, 'ctime': None},
+            {'id': 3, 'name': 'ü', 'flag': None,
+                'ctime': datetime.datetime(2015, 1, 1)}
+        ]
+        fields = ['id', 'name', 'flag', 'ctime']
+        expected = gr.get_data_response(rows, fields, 'id')
+        for chunk_rows in (1, 2, 100):
+            chunks = list(gr.iter_data_response(rows, fields, 'id',
+                chunk_rows=chunk_rows))
+            self.assertTrue(all(isinstance(c, bytes) for c in chunks))
+            self.assertEqual(
+                json.loads(b''.join(chunks).decode('utf-8')), expected)
+
+    def test_no_rows(self):
+        gr = Grid('grid')
+        gr.limit = PAGE_SIZE
+        self.assertEqual(
+            json.loads(b''.join(gr.iter_data_response([], FIELDS, 'id'))
+                .decode('utf-8')),
+            gr.get_data_response([], FIELDS, 'id'))
+
+
+class TestRowCounter(unittest.TestCase):
+
+    def setUp(self):
+        if not pym.cache.region_default.is_configured:
+            pym.cache.region_default.configure('dogpile.cache.memory')
+        pym.cache.region_default.invalidate()
+        self.sess = setup_db()
+
+    def tearDown(self):
+        self.sess.close()
+
+    def grid(self, strategy):
+        gr = Grid('grid')
+        gr.limit = PAGE_SIZE
+        gr.counter = RowCounter(strategy)
+        return gr
+
+    def test_exact_is_cached_per_filter(self):
+        gr = self.grid('exact')
+        qry = self.sess.query(Item).filter(Item.name == 'n01')
+        gr.apply_count(qry)
+        self.assertEqual(gr.total_rows, 10)
+        self.assertEqual(gr.total_pages, 1)
+        self.sess.add(Item(id=ROWS + 1, name='n01'))
+        self.sess.commit()
+        gr.apply_count(qry)
+        self.assertEqual(gr.total_rows, 10)
+        gr.apply_count(self.sess.query(Item).filter(Item.name == 'n02'))
+        self.assertEqual(gr.total_rows, 9)
+        gr.apply_count(self.sess.query(Item))
+        self.assertEqual(gr.total_rows, ROWS + 1)
+        self.assertEqual(gr.total_pages, 5)
+
+    def test_estimate_counts_exactly_on_other_dialects(self):
+        gr = self.grid('estimate')
+        gr.apply_count(self.sess.query(Item).order_by(Item.id).limit(5))
+        self.assertEqual(gr.total_rows, ROWS)
+
+    def test_probe(self):
+        gr = self.grid('probe')
+        for page, n, total in ((1, PAGE_SIZE, PAGE_SIZE + 1),
+                (4, PAGE_SIZE, 4 * PAGE_SIZE + 1), (5, 15, ROWS)):
+            gr.page = page
+            gr.apply_count(self.sess.query(Item))
+            qry = gr.apply_limit(self.sess.query(Item).order_by(Item.id))
+            rows = gr.probe_rows(qry)
+            self.assertEqual(len(rows), n)
+            self.assertEqual(gr.total_rows, total)
+            self.assertEqual(gr.total_pages, min(page + 1, 5))
+
+    def test_invalid_strategy(self):
+        self.assertRaises(GridError, RowCounter, 'guess')
@@ -0,0 +1,166 @@
+import datetime
+import unittest
+
+import colander
+from sqlalchemy.dialects import postgresql
+
+from pym.tk.grid import Grid, GridError
+
+
+DD = {
+    'pym.user.principal': {'type': colander.String()},
+    'pym.user.login_cnt': {'type': colander.Int()},
+    'pym.user.is_enabled': {'type': colander.Boolean()},
+    'pym.user.ctime': {'type': colander.DateTime()}
+}
+
+
+class TestFilterCompilation(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = Grid('grid')
+        self.grid.build_colmodel(DD, list(DD))
+
+    def compile(self, field, op, data=''):
+        self.grid.filter = {
+            'groupOp': 'AND',
+            'rules': [{'field': field, 'op': op, 'data': data}]
+        }
+        self.grid.parse_filter()
+        return self.sql()
+
+    def sql(self):
+        # Positional params, their names differ between SA versions. So
+        # does the quoting of the backslash in ESCAPE.
+        compiled = self.grid.filter_expr.compile(
+            dialect=postgresql.dialect(paramstyle='format'))
+        params = [compiled.params[k] for k in compiled.positiontup]
+        sql = str(compiled).replace('"', '').replace('\\\\', '\\')
+        return sql, params
+
+    def assert_sql(self, field, op, data, sql, params):
+        actual_sql, actual_params = self.compile(field, op, data)
+        self.assertEqual(actual_sql, sql)
+        self.assertEqual(actual_params, params)
+
+    def test_eq(self):
+        self.assert_sql('pym.user.principal', 'eq', 'root',
+            'pym.user.principal = %s', ['root'])
+        self.assert_sql('pym.user.login_cnt', 'eq', '5',
+            'pym.user.login_cnt = %s', [5])
+
+    def test_ne(self):
+        self.assert_sql('pym.user.login_cnt', 'ne', '5',
+            'pym.user.login_cnt != %s', [5])
+
+    def test_ranges(self):
+        for op, sql_op in (('lt', '<'), ('le', '<='), ('gt', '>'),
+                ('ge', '>=')):
+            self.assert_sql('pym.user.login_cnt', op, '5',
+                'pym.user.login_cnt {} %s'.format(sql_op), [5])
+
+    def test_bw(self):
+        self.assert_sql('pym.user.principal', 'bw', 'ro_%t',
+            "pym.user.principal LIKE %s ESCAPE '\\'",
+            ['ro\\_\\%t%'])
+
+    def test_bn(self):
+        self.assert_sql('pym.user.principal', 'bn', 'ro',
+            "pym.user.principal NOT LIKE %s ESCAPE '\\'",
+            ['ro%'])
+
+    def test_ew(self):
+        self.assert_sql('pym.user.principal', 'ew', 'ot',
+            "pym.user.principal ILIKE %s ESCAPE '\\'",
+            ['%ot'])
+
+    def test_en(self):
+        self.assert_sql('pym.user.principal', 'en', 'ot',
+            "pym.user.principal NOT ILIKE %s ESCAPE '\\'",
+            ['%ot'])
+
+    def test_cn(self):
+        self.assert_sql('pym.user.principal', 'cn', 'oo',
+            "pym.user.principal ILIKE %s ESCAPE '\\'",
+            ['%oo%'])
+
+    def test_nc(self):
+        self.assert_sql('pym.user.principal', 'nc', 'oo',
+            "pym.user.principal NOT ILIKE %s ESCAPE '\\'",
+            ['%oo%'])
+
+    def test_in(self):
+        self.assert_sql('pym.user.login_cnt', 'in', '1, 2,3',
+            'pym.user.login_cnt IN (%s, %s, %s)',
+            [1, 2, 3])
+
+    def test_ni(self):
+        self.assert_sql('pym.user.principal', 'ni', 'a,b',
+            'pym.user.principal NOT IN (%s, %s)',
+            ['a', 'b'])
+
+    def test_nu_nn(self):
+        self.assert_sql('pym.user.principal', 'nu', '',
+            'pym.user.principal IS NULL', [])
+        self.assert_sql('pym.user.principal', 'nn', '',
+            'pym.user.principal IS NOT NULL', [])
+
+    def test_boolean(self):
+        sql, params = self.compile('pym.user.is_enabled', 'eq', 'false')
+        # Newer SA renders the boolean as literal
+        self.assertIn((sql, params), [
+            ('pym.user.is_enabled = %s', [False]),
+            ('pym.user.is_enabled = false', [])
+        ])
+
+    def test_date_matches_whole_day(self):
+        self.assert_sql('pym.user.ctime', 'eq', '2014-12-24',
+            'pym.user.ctime >= %s AND pym.user.ctime < %s',
+            [datetime.datetime(2014, 12, 24), datetime.datetime(2014, 12, 25)])
+
+    def test_cast_only_if_value_does_not_fit(self):
+        self.assert_sql('pym.user.login_cnt', 'eq', 'x',
+            'CAST(pym.user.login_cnt AS VARCHAR) = %s', ['x'])
+        self.assert_sql('pym.user.login_cnt', 'bw', '12',
+            "CAST(pym.user.login_cnt AS VARCHAR) LIKE %s "
+            "ESCAPE '\\'", ['12%'])
+
+    def test_default_op(self):
+        sql, _ = self.compile('pym.user.principal', None, 'oo')
+        self.assertIn('ILIKE', sql)
+        sql, _ = self.compile('pym.user.login_cnt', None, '5')
+        self.assertEqual(sql, 'pym.user.login_cnt = %s')
+
+    def test_default_op_of_other_types(self):
+        self.assert_sql('pym.user.ctime', None, '12-24',
+            "CAST(pym.user.ctime AS VARCHAR) ILIKE %s ESCAPE '\\'",
+            ['%12-24%'])
+        self.assert_sql('pym.user.is_enabled', None, 'tr',
+            "CAST(pym.user.is_enabled AS VARCHAR) ILIKE %s ESCAPE '\\'",
+            ['%tr%'])
+
+    def test_invalid(self):
+        self.assertRaises(GridError, self.compile, 'pym.user.principal',
+            'xx', 'a')
+        self.assertRaises(GridError, self.compile, 'pym.user.unknown',
+            'eq', 'a')
+
+    def test_groups(self):
+        self.grid.filter = {
+            'groupOp': 'OR',
+            'rules': [{'field': 'pym.user.login_cnt', 'op': 'gt',
+                'data': '5'}],
+            'groups': [{
+                'groupOp': 'AND',
+                'rules': [
+                    {'field': 'pym.user.principal', 'op': 'bw', 'data': 'a'},
+                    {'field': 'pym.user.login_cnt', 'op': 'lt', 'data': '2'}
+                ]
+            }]
+        }
+        self.grid.parse_filter()
+        sql, params = self.sql()
+        self.assertEqual(params, [5, 'a%', 2])
+        self.assertEqual(sql,
+            "pym.user.login_cnt > %s OR pym.user.principal LIKE %s "
+            "ESCAPE '\\' AND pym.user.login_cnt < %s")
@@ -0,0 +1,166 @@
+import unittest
+
+import sqlalchemy as sa
+import transaction
+from pyramid.security import Allow
+
+import pym.testing
+import pym.models
+from pym.auth.const import UNIT_TESTER_UID
+from pym.res.models import NodeCache, ResourceNode
+
+
+class TestMaterializedPath(unittest.TestCase):
+    """
+    Needs the testing DB, see :mod:`pym.testing`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        pym.testing.init_app(pym.testing.TestingArgs, setup_logging=True)
+
+    def setUp(self):
+        self.sess = pym.models.DbSession()
+        self.root = ResourceNode.create_root(self.sess, UNIT_TESTER_UID,
+            name='unittest-paths', kind='res')
+        self.a = self.root.add_child(self.sess, UNIT_TESTER_UID, 'res', 'a')
+        self.b = self.root.add_child(self.sess, UNIT_TESTER_UID, 'res', 'b')
+        self.a1 = self.a.add_child(self.sess, UNIT_TESTER_UID, 'res', 'a1')
+        self.a11 = self.a1.add_child(self.sess, UNIT_TESTER_UID, 'doc',
+            'a11')
+        self.sess.flush()
+
+    def tearDown(self):
+        transaction.abort()
+
+    def path_in_db(self, n):
+        t = ResourceNode.__table__
+        return self.sess.execute(
+            sa.select([t.c.path]).where(t.c.id == n.id)
+        ).scalar()
+
+    def test_insert(self):
+        self.assertEqual(self.root.path, '/{}/'.format(self.root.id))
+        self.assertEqual(self.a11.path, '/{}/{}/{}/{}/'.format(self.root.id,
+            self.a.id, self.a1.id, self.a11.id))
+        for n in (self.root, self.a, self.b, self.a1, self.a11):
+            self.assertEqual(self.path_in_db(n), n.path)
+        self.assertEqual(self.a11.path_ids(),
+            [self.root.id, self.a.id, self.a1.id, self.a11.id])
+
+    def test_ancestors_and_descendants(self):
+        self.assertEqual(self.a11.ancestors(), [self.root, self.a, self.a1])
+        self.assertEqual(set(self.root.descendants()),
+            {self.a, self.b, self.a1, self.a11})
+        self.assertEqual(self.root.descendants(kind='doc'), [self.a11])
+        self.assertEqual(self.a11.descendants(), [])
+
+    def test_move_updates_subtree(self):
+        self.a1.parent = self.b
+        self.sess.flush()
+        expected = '/{}/{}/{}/{}/'.format(self.root.id, self.b.id,
+            self.a1.id, self.a11.id)
+        self.assertEqual(self.a11.path, expected)
+        self.assertEqual(self.path_in_db(self.a11), expected)
+        self.assertEqual(self.path_in_db(self.a1), '/{}/{}/{}/'.format(
+            self.root.id, self.b.id, self.a1.id))
+        self.assertEqual(set(self.b.descendants()), {self.a1, self.a11})
+        self.assertEqual(self.a.descendants(), [])
+
+    def test_without_path(self):
+        for n in (self.root, self.a, self.a1):
+            sa.orm.attributes.set_committed_value(n, 'path', None)
+        self.assertEqual(self.a1.ancestors(), [self.root, self.a])
+        self.assertEqual(set(self.root.descendants()),
+            {self.a, self.b, self.a1, self.a11})
+        self.assertEqual(self.root.descendants(kind='doc'), [self.a11])
+
+
+class TestNodeCache(unittest.TestCase):
+    """
+    Needs the testing DB, see :mod:`pym.testing`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        pym.testing.init_app(pym.testing.TestingArgs, setup_logging=True)
+
+    def setUp(self):
+        self.sess = pym.models.DbSession()
+        self.root = ResourceNode.create_root(self.sess, UNIT_TESTER_UID,
+            name='unittest-nodecache', kind='res')
+        self.a = self.root.add_child(self.sess, UNIT_TESTER_UID, 'res', 'a')
+        self.sess.flush()
+        self.nc = NodeCache()
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_get_by_id_and_name(self):
+        self.nc.add(self.a, fetched=True)
+        self.assertIs(self.nc.get(self.sess, self.a.id), self.a)
+        self.assertIs(self.nc.get(self.sess, 'a', parent_id=self.root.id),
+            self.a)
+        self.assertIsNone(self.nc.get(self.sess, 'b',
+            parent_id=self.root.id))
+        self.assertEqual(self.nc.stats, {'hits': 2, 'fetches': 1})
+
+    def test_nodes_of_other_sessions_are_not_returned(self):
+        self.nc.add(self.a)
+        other = sa.orm.Session(bind=pym.models.DbEngine)
+        try:
+            self.assertIsNone(self.nc.get(other, self.a.id))
+        finally:
+            other.close()
+
+    def test_discard(self):
+        self.nc.add(self.a)
+        self.nc.discard(self.a)
+        self.assertIsNone(self.nc.get(self.sess, self.a.id))
+        self.assertIsNone(self.nc.get(self.sess, 'a',
+            parent_id=self.root.id))
+
+    def test_root_has_no_parent(self):
+        self.assertIsNone(self.root.__parent__)
+
+
+class TestAclCache(unittest.TestCase):
+    """
+    Needs the testing DB, see :mod:`pym.testing`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        pym.testing.init_app(pym.testing.TestingArgs, setup_logging=True)
+
+    def setUp(self):
+        self.sess = pym.models.DbSession()
+        self.root = ResourceNode.create_root(self.sess, UNIT_TESTER_UID,
+            name='unittest-acl', kind='res')
+        self.sess.flush()
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_effective_acl_is_cached_by_acl_version(self):
+        n = self.root
+        acl = n.__acl__()
+        self.assertIs(n.__acl__(), acl)
+        self.assertIs(n.__acl_masks__(), n.__acl_masks__())
+        version = n.acl_version
+        n.allow(self.sess, UNIT_TESTER_UID, 'read', user=UNIT_TESTER_UID)
+        self.sess.flush()
+        self.assertEqual(n.acl_version, version + 1)
+        new_acl = n.__acl__()
+        self.assertIsNot(new_acl, acl)
+        self.assertIn((Allow, 'u:{}'.format(UNIT_TESTER_UID), 'read'),
+            new_acl)
+
+    def test_acl_masks_of_many_nodes(self):
+        n = self.root.add_child(self.sess, UNIT_TESTER_UID, 'res', 'a')
+        n.allow(self.sess, UNIT_TESTER_UID, 'visit', user=UNIT_TESTER_UID)
+        self.sess.flush()
+        self.sess.expire_all()
+        nodes = [self.root, n]
+        self.assertEqual(ResourceNode.acl_masks_of(nodes),
+            [x.__acl_masks__() for x in nodes])
@@ -0,0 +1,85 @@
+import os
+import unittest
+from unittest import mock
+
+import redis
+
+from pym.auth.throttle import LoginThrottle
+from pym.exc import ThrottledError
+
+
+REDIS_URL = os.environ.get('PYM_TEST_REDIS_URL', 'redis://localhost:6379')
+REDIS_DB = 15
+
+
+def redis_available():
+    try:
+        return redis.StrictRedis.from_url(REDIS_URL, db=REDIS_DB).ping()
+    except redis.RedisError:
+        return False
+
+
+@unittest.skipUnless(redis_available(), "Needs Redis at " + REDIS_URL)
+class TestLoginThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000000.0
+        patcher = mock.patch('pym.auth.throttle.time')
+        self.addCleanup(patcher.stop)
+        patcher.start().time.side_effect = lambda: self.now
+        self.throttle = LoginThrottle(enabled=True, window=300,
+            max_per_login=3, max_per_ip=5, redis_url=REDIS_URL,
+            redis_db=REDIS_DB)
+        self.throttle.client.flushdb()
+
+    def fail(self, login, addr='10.0.0.1', n=1):
+        for _ in range(n):
+            self.throttle.add_failure(login, addr)
+            self.now += 1
+
+    def test_login_is_throttled_within_window(self):
+        self.fail('alice', n=2)
+        self.throttle.check('alice', '10.0.0.1')
+        self.fail('Alice ')
+        self.assertRaises(ThrottledError, self.throttle.check, 'alice',
+            '10.0.0.2')
+        # Other logins from other addresses are not affected
+        self.throttle.check('bob', '10.0.0.2')
+
+    def test_window_slides(self):
+        self.fail('alice', n=3)
+        self.assertRaises(ThrottledError, self.throttle.check, 'alice', None)
+        # The oldest failure leaves the window, one attempt is free again
+        self.now = 1000000.0 + 300.5
+        self.throttle.check('alice', None)
+        self.fail('alice')
+        self.assertRaises(ThrottledError, self.throttle.check, 'alice', None)
+
+    def test_blocked_login_does_not_ask_redis(self):
+        self.fail('alice', n=3)
+        self.assertRaises(ThrottledError, self.throttle.check, 'alice', None)
+        self.throttle.client.flushdb()
+        self.assertRaises(ThrottledError, self.throttle.check, 'alice', None)
+        self.now = 1000000.0 + 301
+        self.throttle.check('alice', None)
+
+    def test_address_is_throttled_across_logins(self):
+        for i in range(5):
+            self.fail('user{}'.format(i), '10.0.0.9')
+        self.assertRaises(ThrottledError, self.throttle.check, 'other',
+            '10.0.0.9')
+        self.throttle.check('other', '10.0.0.8')
+
+    def test_reset_keeps_address_counter(self):
+        self.fail('alice', '10.0.0.9', n=3)
+        self.fail('bob', '10.0.0.9', n=2)
+        self.throttle.reset('alice')
+        self.throttle.check('alice', '10.0.0.8')
+        self.assertRaises(ThrottledError, self.throttle.check, 'alice',
+            '10.0.0.9')
+
+    def test_disabled_without_redis_url(self):
+        throttle = LoginThrottle(enabled=True, redis_url=None)
+        for _ in range(10):
+            throttle.add_failure('alice', '10.0.0.1')
+        throttle.check('alice', '10.0.0.1')
@@ -0,0 +1,69 @@
+import datetime
+import logging
+import time
+import unittest
+
+import sqlalchemy as sa
+import transaction
+
+import pym.testing
+import pym.models
+import pym.auth.models as pam
+from pym.auth.stats import UserStatsBuffer
+
+
+mlgg = logging.getLogger(__name__)
+
+
+class TestUserStatsBuffer(unittest.TestCase):
+    """
+    Needs the testing DB, see :mod:`pym.testing`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        pym.testing.init_app(pym.testing.TestingArgs, setup_logging=True)
+
+    def setUp(self):
+        sess = pym.models.DbSession()
+        self.uid = pym.testing.create_unit_tester(mlgg, sess).id
+        # The buffer writes by its own connection
+        transaction.commit()
+
+    def load(self):
+        t = pam.User.__table__
+        with pym.models.DbEngine.connect() as conn:
+            return conn.execute(
+                sa.select([t]).where(t.c.id == self.uid)
+            ).first()
+
+    def test_flush_writes_last_values(self):
+        before = self.load()
+        buf = UserStatsBuffer(flush_interval=3600)
+        t1 = datetime.datetime(2014, 12, 24, 18, 0)
+        t2 = datetime.datetime(2014, 12, 24, 19, 0)
+        buf.update(self.uid, login_time=t1, login_ip='10.0.0.1')
+        buf.update(self.uid, login_time=t2)
+        buf.touch(self.uid)
+        # Nothing written before the flush
+        self.assertEqual(self.load().login_time, before.login_time)
+        buf.flush()
+        row = self.load()
+        self.assertEqual(row.login_time, t2)
+        self.assertEqual(row.login_ip, '10.0.0.1')
+        self.assertIsNotNone(row.access_time)
+        self.assertEqual(row.mtime, before.mtime)
+        self.assertEqual(row.editor_id, before.editor_id)
+
+    def test_flush_without_values(self):
+        buf = UserStatsBuffer(flush_interval=3600)
+        buf.flush()
+
+    def test_flushed_by_timer_thread(self):
+        buf = UserStatsBuffer(flush_interval=0.1)
+        ip = '10.0.0.{}'.format(int(time.time()) % 250 + 2)
+        buf.update(self.uid, login_ip=ip)
+        deadline = time.time() + 5
+        while self.load().login_ip != ip and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.load().login_ip, ip)
@@ -1,23 +1,149 @@
 # -*- coding_ utf-8 -*-
 
+import datetime
+import hashlib
 import json
+import logging
+import math
+import operator
 import re
 import sqlalchemy as sa
 import sqlalchemy.sql as sasql
 import colander
 from collections import OrderedDict
+import pym.cache
+import pym.lib
+import pym.search
+
+
+mlgg = logging.getLogger(__name__)
 
 
 class GridError(Exception):
     pass
 
 
+class RowCounter(object):
+    """
+    Counts the rows of a filtered grid query.
+
+    Strategies:
+
+    ``exact``
+        ``COUNT(*)`` of the query with the current filter. The result is
+        cached in region ``default`` for ``expiration_time`` seconds, keyed by
+        a fingerprint of the SQL and its parameters, so that flipping pages
+        of the same filter does not count again.
+
+    ``estimate``
+        On PostgreSQL, the planner's estimate: ``pg_class.reltuples`` if the
+        query selects from a single table without filter, else the estimated
+        rows of ``EXPLAIN``. Estimates below ``exact_below`` are replaced by
+        an exact count, which is cheap and precise for small results. Other
+        dialects count exactly.
+
+    ``probe``
+        No count at all. The page is fetched with one extra row to tell
+        whether there are more rows, see :meth:`Grid.probe_rows`.
+    """
+
+    STRATEGIES = ('exact', 'estimate', 'probe')
+
+    def __init__(self, strategy='exact', expiration_time=60,
+            exact_below=1000):
+        if strategy not in self.__class__.STRATEGIES:
+            raise GridError("Invalid count strategy: '{0}'".format(strategy))
+        self.strategy = strategy
+        self.expiration_time = expiration_time
+        self.exact_below = exact_below
+
+    def count(self, qry):
+        """
+        Returns number of rows of given query, or None for strategy
+        ``probe``.
+
+        :param qry: ORM query with filter applied, order, limit and offset
+            are ignored.
+        """
+        if self.strategy == 'probe':
+            return None
+        # Query refuses order_by() while limit or offset are set
+        qry = qry.limit(None).offset(None).order_by(None)
+        if self.strategy == 'estimate' \
+                and qry.session.connection().dialect.name == 'postgresql':
+            n = self.estimate(qry)
+            if n is not None and n >= self.exact_below:
+                return n
+        return self.exact(qry)
+
+    def exact(self, qry):
+        """
+        Returns cached exact number of rows of given query.
+        """
+        # noinspection PyProtectedMember
+        fingerprint = hashlib.md5(
+            pym.cache._key_from_query(qry).encode('utf-8')).hexdigest()
+        return pym.cache.region_default.get_or_create(
+            'grid:count:' + fingerprint, qry.count,
+            expiration_time=self.expiration_time)
+
+    def estimate(self, qry):
+        """
+        Returns PostgreSQL's estimated number of rows of given query, or
+        None if there is no estimate.
+        """
+        stmt = qry.statement
+        conn = qry.session.connection()
+        froms = stmt.froms
+        try:
+            if stmt._whereclause is None and len(froms) == 1 \
+                    and isinstance(froms[0], sa.Table):
+                name = conn.dialect.identifier_preparer.format_table(froms[0])
+                n = conn.execute(
+                    sa.text("SELECT CAST(reltuples AS BIGINT) FROM pg_class"
+                        " WHERE oid = CAST(:name AS REGCLASS)"),
+                    name=name
+                ).scalar()
+                # Never analyzed tables have reltuples 0 (or -1)
+                return n if n and n > 0 else None
+            compiled = stmt.compile(dialect=conn.dialect)
+            plan = conn.execute('EXPLAIN (FORMAT JSON) ' + str(compiled),
+                compiled.params).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+        except sa.exc.DBAPIError as exc:
+            mlgg.warning("Failed to estimate row count: {}".format(exc))
+            return None
+
+
 class Grid(object):
 
     RE_CHECK_FLD = re.compile('^[\w.]+$')
     """RegEx to check that field names have only valid chars
     """
 
+    FILTER_CMP_OPS = {
+        'eq': operator.eq,
+        'ne': operator.ne,
+        'lt': operator.lt,
+        'le': operator.le,
+        'gt': operator.gt,
+        'ge': operator.ge
+    }
+    """Comparison operators of filter rules"""
+
+    FILTER_LIKE_OPS = {
+        # op: (pattern, negate, case_sensitive)
+        'bw': ('{0}%', False, True),
+        'bn': ('{0}%', True, True),
+        'ew': ('%{0}', False, False),
+        'en': ('%{0}', True, False),
+        'cn': ('%{0}%', False, False),
+        'nc': ('%{0}%', True, False)
+    }
+    """Pattern operators of filter rules"""
+
     EVENTS = (
         # form events
         'afterclickPgButtons',
@@ -123,6 +249,22 @@ class Grid(object):
         """
         self._total_rows = 9999
         self._total_pages = 9999
+        self.counter = None
+        """
+        Instance of :class:`RowCounter`. If set, :meth:`apply_count` sets the
+        total rows of the query, else the pager shows a fake 9999.
+        """
+        self.keyset_id_field = None
+        """
+        Name of the unique field that completes the sort key. If set, pages
+        that directly follow the previous page are fetched by keyset
+        pagination instead of LIMIT/OFFSET, see :meth:`apply_limit`.
+        """
+        self.keyset = None
+        """
+        Keyset of the previous page as sent by the client, a dict with keys
+        ``pg`` (page number) and ``key`` (sort key of last row).
+        """
         self.opts = {
             'url'         : '',
             'datatype'    : 'json',
@@ -295,6 +437,12 @@ class Grid(object):
         if '_search' in oo and oo['_search'] == 'true':
             if 'filters' in oo:
                 self.filter = json.loads(oo['filters'])
+        # Keyset of previous page
+        if oo.get('ka'):
+            ka = json.loads(oo['ka'])
+            if not isinstance(ka, dict) or not isinstance(ka.get('key'), list):
+                raise GridError("Invalid keyset: '{0}'".format(oo['ka']))
+            self.keyset = ka
 
     def parse_filter(self):
         """Parses datastruct of filter.
@@ -354,49 +502,235 @@ class Grid(object):
             raise GridError("Invalid groupOp: '{0}'".format(fil['groupOp']))
         rules = []
         for rule in fil['rules']:
-            ty = self._dd[rule['field']]['type']
-            if isinstance(ty, colander.String):
-                r = sasql.column(rule['field']).ilike('%' + rule['data'] + '%')
-            elif isinstance(ty, (colander.Int, colander.Float, colander.Decimal)):
-                r = sasql.column(rule['field']) == rule['data']
-            else:
-                r = sa.cast(sasql.column(rule['field']), sa.Unicode).ilike(
-                    '%' + rule['data'] + '%')
-            rules.append(r)
+            rules.append(self._parse_filter_rule(rule))
         if 'groups' in fil:
             for group in fil['groups']:
                 rules.append(self._parse_filter_level(group))
         return group_op(*rules)
 
+    def _parse_filter_rule(self, rule):
+        """
+        Returns SQL expression of a single filter rule.
+
+        Honours the jqGrid operator in ``op`` and builds predicates that let
+        the DB use an index of the field: The search value is converted to the
+        field's type and compared with the bare column (``=``, ``<``,
+        ``IN``...), and "begins with" is a case-sensitive prefix ``LIKE``.
+        Only if the value does not fit the type, or a pattern operator is
+        applied to a non-string field, the column is cast to text.
+
+        "Ends with" and "contains" cannot use a B-tree index anyway and match
+        case-insensitively by ``ILIKE``. If the data dictionary marks the field
+        with ``search``, "contains" is routed through the configured search
+        backend, see :mod:`pym.search`.
+
+        A rule without ``op`` means "equal" for numbers and "contains" for
+        all other types, which are then cast to text.
+        """
+        fld = rule['field']
+        try:
+            ty = self._dd[fld]['type']
+        except KeyError:
+            raise GridError("Invalid filter field: '{0}'".format(fld))
+        is_str = isinstance(ty, colander.String)
+        is_num = isinstance(ty, (colander.Int, colander.Float,
+            colander.Decimal))
+        op = rule.get('op') or ('eq' if is_num else 'cn')
+        data = rule.get('data', '')
+        col = sasql.column(fld)
+        if op == 'nu':
+            return col.is_(None)
+        if op == 'nn':
+            return col.isnot(None)
+        if op in ('cn', 'nc') and is_str and self._dd[fld].get('search') \
+                and pym.search.search_backend.backend != 'none':
+            r = pym.search.search_backend.filter(col, data)
+            return ~r if op == 'nc' else r
+        if op in self.__class__.FILTER_LIKE_OPS:
+            pattern, negate, case_sensitive = \
+                self.__class__.FILTER_LIKE_OPS[op]
+            if not is_str:
+                col = sa.cast(col, sa.Unicode)
+            v = pattern.format(self._escape_like(data))
+            r = col.like(v, escape='\\') if case_sensitive \
+                else col.ilike(v, escape='\\')
+            return ~r if negate else r
+        if op in ('in', 'ni'):
+            vv = [x.strip() for x in data.split(',')]
+            try:
+                vv = [self._filter_value(ty, x) for x in vv]
+            except colander.Invalid:
+                col = sa.cast(col, sa.Unicode)
+            return col.in_(vv) if op == 'in' else col.notin_(vv)
+        if op not in self.__class__.FILTER_CMP_OPS:
+            raise GridError("Invalid filter op: '{0}'".format(op))
+        cmp = self.__class__.FILTER_CMP_OPS[op]
+        if isinstance(ty, colander.DateTime) and op in ('eq', 'ne'):
+            # Let a date match all the day
+            try:
+                day = self._filter_value(colander.Date(), data)
+            except colander.Invalid:
+                pass
+            else:
+                start = datetime.datetime.combine(day, datetime.time())
+                end = start + datetime.timedelta(days=1)
+                if op == 'eq':
+                    return sasql.and_(col >= start, col < end)
+                return sasql.or_(col < start, col >= end)
+        try:
+            v = self._filter_value(ty, data)
+        except colander.Invalid:
+            col = sa.cast(col, sa.Unicode)
+            v = data
+        return cmp(col, v)
+
+    @staticmethod
+    def _filter_value(ty, data):
+        """
+        Converts search value into the Python type of given colander type.
+
+        :raise colander.Invalid: If value does not fit.
+        """
+        if isinstance(ty, colander.String):
+            return data
+        node = colander.SchemaNode(ty)
+        v = ty.deserialize(node, data)
+        if v is colander.null:
+            raise colander.Invalid(node, 'Missing value')
+        return v
+
+    @staticmethod
+    def _escape_like(s):
+        return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
     def apply_limit(self, qry):
         """
         Applies limit and offset to given query
+
+        In keyset mode, the page that directly follows the previous page is
+        filtered by the sort key of that page's last row instead of an
+        offset. Then the DB seeks to the page by index, and e.g. infinite
+        scrolling costs the same for each page. Other pages, e.g. after
+        jumping, still use the offset.
         """
-        if self.limit is not None:
-            qry = qry.limit(self.limit)
-        if self.offset is not None:
+        # Query refuses filter() after limit() or offset()
+        if self.use_keyset:
+            cols = [sasql.literal_column(f) for f in self._keyset_fields()]
+            qry = qry.filter(pym.lib.keyset_filter(cols, self.keyset['key'],
+                self.order_dir or 'asc'))
+        elif self.offset is not None:
             qry = qry.offset(self.offset)
+        if self.limit is not None:
+            qry = qry.limit(self.limit + 1 if self.probing else self.limit)
+        return qry
+
+    def apply_count(self, qry):
+        """
+        Sets total rows and pages of given query according to :attr:`counter`.
+
+        Call with the filtered query before its limit is applied. With
+        strategy ``probe``, totals are set later by :meth:`probe_rows`.
+        """
+        if self.counter is not None:
+            n = self.counter.count(qry)
+            if n is not None:
+                self.total_rows = n
         return qry
 
+    @property
+    def probing(self):
+        """
+        Tells whether pages are fetched with an extra row to probe for more.
+        """
+        return self.counter is not None and self.counter.strategy == 'probe' \
+            and self.limit is not None
+
+    def probe_rows(self, data):
+        """
+        Returns rows of current page and sets total rows and pages.
+
+        With strategy ``probe``, :meth:`apply_limit` fetches one row more than
+        the page size. If that row exists, the totals tell the pager there is
+        a next page. The extra row is dropped.
+
+        :param data: Rows as fetched by the limited query.
+        :return: List of rows.
+        """
+        rows = list(data)
+        if self.probing:
+            more = len(rows) > self.limit
+            rows = rows[:self.limit]
+            self.total_rows = self.offset + len(rows) + (1 if more else 0)
+        return rows
+
     def apply_order(self, qry):
         """
         Applies sort order (ORDER BY clause) to given query
+
+        In keyset mode, the sort key is completed by the keyset ID field.
         """
         oo = []
-        if self.order_field is not None:
+        if self.order_field:
             if not self.__class__.RE_CHECK_FLD.match(self.order_field):
                 raise GridError("Invalid order field: '{0}'".format(
                     self.order_field))
-            oo.append(self.order_field)
-            if self.order_dir is not None:
-                if self.order_dir.lower() not in ['asc', 'desc']:
-                    raise GridError("Invalid order dir: '{0}'".format(
-                        self.order_dir))
-                oo.append(self.order_dir)
+        if self.order_dir is not None:
+            if self.order_dir.lower() not in ['asc', 'desc']:
+                raise GridError("Invalid order dir: '{0}'".format(
+                    self.order_dir))
+        fields = self._keyset_fields() if self.keyset_id_field \
+            else [self.order_field] if self.order_field else []
+        for f in fields:
+            oo.append(" ".join([f, self.order_dir]) if self.order_dir else f)
         if len(oo):
-            qry = qry.order_by(" ".join(oo))
+            qry = qry.order_by(sasql.text(", ".join(oo)))
         return qry
 
+    @property
+    def use_keyset(self):
+        """
+        Tells whether the current page is fetched by keyset pagination.
+        """
+        if not self.keyset_id_field or not self.keyset:
+            return False
+        key = self.keyset['key']
+        return self.keyset.get('pg') == self.page - 1 \
+            and len(key) == len(self._keyset_fields()) \
+            and None not in key
+
+    def _keyset_fields(self):
+        ff = [self.order_field] if self.order_field \
+            and self.order_field != self.keyset_id_field else []
+        if not self.__class__.RE_CHECK_FLD.match(self.keyset_id_field):
+            raise GridError("Invalid keyset id field: '{0}'".format(
+                self.keyset_id_field))
+        return ff + [self.keyset_id_field]
+
+    @staticmethod
+    def _row_key(fld):
+        """
+        Returns key of a sort field in a result row.
+
+        :meth:`apply_order` puts the field as is into the SQL, where it may be
+        qualified by schema and table, e.g. ``pym.user.principal``. The row
+        holds the value by the column name only.
+        """
+        return fld.rsplit('.', 1)[-1]
+
+    def _keyset_of(self, row):
+        """
+        Returns keyset of given row for the client, or None.
+        """
+        if not self.keyset_id_field or row is None:
+            return None
+        key = []
+        for f in self._keyset_fields():
+            v = row[self._row_key(f)]
+            if not isinstance(v, (str, int, float, bool)) and v is not None:
+                v = str(v)
+            key.append(v)
+        return {'pg': self.page, 'key': key}
+
     def apply_filter(self, qry):
         """
         Applies filter (WHERE clause) to given query.
@@ -443,6 +777,7 @@ class Grid(object):
             }
         """
         rows = []
+        row = None
         for row in data:
             cell = []
             for f in fieldlist:
@@ -463,8 +798,99 @@ class Grid(object):
         resp['records'] = self._total_rows
         resp['total'] = self._total_pages
         resp['rows'] = rows
+        keyset = self._keyset_of(row)
+        if keyset:
+            resp['keyset'] = keyset
         return resp
 
+    def stream_data_response(self, response, data, fieldlist, id_field,
+            chunk_rows=100):
+        """Streams reponse to client grid.
+
+        Same JSON as :meth:`get_data_response`, but written incrementally
+        to the response body by :meth:`iter_data_response`, instead of
+        building and rendering the complete structure.
+
+        Iteration of ``data`` happens after the view has returned, when the
+        transaction may already have ended. So pass rows that are already
+        fetched, or rows from a connection that outlives the transaction.
+
+        :param response: The response, its ``app_iter`` is set.
+        :param data: Iterable of rows.
+        :param fieldlist: Fields of a row that make up the cells.
+        :param id_field: Field of a row that holds its ID.
+        :param chunk_rows: Number of rows per written chunk.
+        :return: The response.
+        """
+        response.content_type = 'application/json'
+        response.charset = 'utf-8'
+        response.app_iter = self.iter_data_response(data, fieldlist, id_field,
+            chunk_rows)
+        return response
+
+    def iter_data_response(self, data, fieldlist, id_field, chunk_rows=100):
+        """Generates JSON of reponse to client grid in chunks of bytes.
+
+        Each value is serialized by a converter chosen per column from the
+        data dictionary, see :meth:`_build_converters`.
+        """
+        dumps = json.dumps
+        converters = self._build_converters(fieldlist)
+        cols = list(zip(fieldlist, converters))
+        yield '{{"page": {}, "records": {}, "total": {}, "rows": ['.format(
+            dumps(self.page), dumps(self._total_rows),
+            dumps(self._total_pages)).encode('utf-8')
+        buf = []
+        sep = ''
+        row = None
+        for row in data:
+            buf.append('{}{{"id": {}, "cell": [{}]}}'.format(
+                sep, dumps(row[id_field]),
+                ', '.join([conv(row[f]) for f, conv in cols])))
+            sep = ', '
+            if len(buf) >= chunk_rows:
+                yield ''.join(buf).encode('utf-8')
+                buf = []
+        buf.append(']')
+        keyset = self._keyset_of(row)
+        if keyset:
+            buf.append(', "keyset": ' + dumps(keyset))
+        buf.append('}')
+        yield ''.join(buf).encode('utf-8')
+
+    def _build_converters(self, fieldlist):
+        """Returns a JSON converter per field.
+
+        Values are converted as in :meth:`get_data_response`: booleans and
+        strings as is, everything else as string. The type is taken from the
+        data dictionary; for fields without it, the value is checked per cell.
+        """
+        dumps = json.dumps
+
+        def conv_bool(v):
+            return 'null' if v is None else ('true' if v else 'false')
+
+        def conv_str(v):
+            return 'null' if v is None else dumps(str(v))
+
+        def conv_any(v):
+            if v is None:
+                return 'null'
+            if not isinstance(v, (str, bool)):
+                v = str(v)
+            return dumps(v)
+
+        converters = []
+        for f in fieldlist:
+            d = self._dd.get(f) if self._dd else None
+            if d is None:
+                converters.append(conv_any)
+            elif isinstance(d['type'], colander.Boolean):
+                converters.append(conv_bool)
+            else:
+                converters.append(conv_str)
+        return converters
+
     def _opts2json(self, opts):
         """
         JSON-encodes opts, renders event handlers as unquoted string.
@@ -604,6 +1030,8 @@ class Grid(object):
                 pager_id=self.pager_id,
                 opts=self._opts2json(self.columnchooser_opts)
             )
+        if self.keyset_id_field:
+            other += "\n" + TPL_KEYSET
 
         if after_hook:
             after_hook += '(gr);'
@@ -777,7 +1205,6 @@ class Grid(object):
 
     @total_rows.setter
     def total_rows(self, v):
-        import math
         self._total_rows = v
         self._total_pages = int(math.ceil(v / self.limit))
 
@@ -814,6 +1241,13 @@ TPL_FLUID = """
     $(window).resize(function () {{ PYM.grid.resize($('#{grid_id}')); }});
 """
 
+TPL_KEYSET = """
+    gr.on('jqGridLoadComplete', function (evt, data) {
+        gr.jqGrid('setGridParam', {postData: {
+            ka: data && data.keyset ? JSON.stringify(data.keyset) : ''
+        }});
+    });"""
+
 TPL_COLUMNCHOOSER = """
 gr.jqGrid('navButtonAdd', '#{pager_id}', {{
     caption: ""
@@ -3,7 +3,8 @@ import re
 import sqlalchemy as sa
 import sqlalchemy.sql.expression
 from pym.exc import ValidationError
-from pym.lib import json_deserializer
+from pym.lib import json_deserializer, keyset_filter
+import pym.search
 
 
 class PagerValidator(object):
@@ -14,6 +15,8 @@ class PagerValidator(object):
 
         We tell which page is the current page and the page size (e.g. in rows).
         Hence the input MultiDict is expected to have keys ``pg`` and ``ps``.
+        For keyset pagination, key ``ka`` holds the sort key of the last row
+        of the previous page, see :attr:`keyset`.
 
         *Public properties*
 
@@ -71,6 +74,50 @@ class PagerValidator(object):
             ps = ub
         return ps
 
+    @property
+    def keyset(self):
+        """
+        Fetches sort key of last seen row from key ``ka`` (optional, single).
+
+        The key is a JSON list with the values of the sort fields and, last,
+        the ID of the row. Use it with :func:`pym.lib.keyset_filter` instead
+        of an offset.
+
+        :return: List of values, or None if keyset is missing.
+        :raise ValidationError: If keyset is not a non-empty list
+        """
+        v = self.parent.fetch('ka', default=None, required=False,
+            multiple=False)
+        if v is None:
+            return None
+        try:
+            ka = json_deserializer(v)
+        except ValueError:
+            raise ValidationError("Invalid JSON: 'ka'")
+        if not isinstance(ka, list) or not ka:
+            raise ValidationError('Invalid ka: {}'.format(v))
+        return ka
+
+    def apply_keyset(self, qry, cols, direction='asc'):
+        """
+        Applies keyset pagination to given query.
+
+        If the request has a keyset, filters rows after it, else applies the
+        offset of the current page. Limits to the page size in both cases.
+        The query must be ordered by ``cols``.
+
+        :param qry: The query.
+        :param cols: Columns of the sort key, last one must be unique.
+        :param direction: Sort direction.
+        :return: The query.
+        """
+        ka = self.keyset
+        if ka is not None:
+            qry = qry.filter(keyset_filter(cols, ka, direction))
+        else:
+            qry = qry.offset(self.page * self.page_size)
+        return qry.limit(self.page_size)
+
 
 class SorterValidator(object):
 
@@ -289,6 +336,9 @@ class FilterValidator(object):
         prevent SQL errors in case column is not a string, we cast all fields
         to UnicodeText.
 
+        Columns marked as searchable are filtered by the configured search
+        backend instead, see :mod:`pym.search`.
+
         :param entity: Object to pull the SA fields from
         :return: List of SA filter expressions, may be empty
         """
@@ -298,9 +348,9 @@ class FilterValidator(object):
         fil = []
         for thing in fil_struct[1]:
             fld, op, case, val = thing
-            f = sa.sql.expression.cast(col_map[fld], sa.UnicodeText)
-            v = '%' + val.strip().replace(' ', '%') + '%'
-            fil.append(f.ilike(v))
+            col = col_map[fld]
+            fil.append(pym.search.search_backend.filter(col, val,
+                searchable=pym.search.is_searchable(col)))
         return fil
 
     def build_filter(self, fil, allowed_fields, col_map):
@@ -64,12 +64,12 @@ def main(context, request):
     permission=NO_PERMISSION_REQUIRED
 )
 def xhr_main_menu(context, request):
-    # TODO Build different menus for un/authenticated users
     resp = pym.resp.JsonResp()
     resp.data = pym.menu.main_menu(
         root_node=request.root,
         url_to=request.resource_url,
         tenant=DEFAULT_TENANT_NAME,
-        translate=request.localizer.translate
+        translate=request.localizer.translate,
+        request=request
     )
     return json_serializer(resp.resp)